@@ -2,6 +2,7 @@
 # --- Imports
 # ==================================================================================================
 import copy
+import importlib.util
 import itertools
 import json
 import os
@@ -18,6 +19,18 @@ from user_defined_functions import (
     reformat_filling_scheme_from_lpc_alt,
 )
 
+# The particle distribution module of the first generation (also used for the cost model) is loaded
+# from its job folder, which is not a python package
+spec = importlib.util.spec_from_file_location(
+    "particle_distribution",
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "master_jobs/1_build_distr_and_collider/particle_distribution.py",
+    ),
+)
+particle_distribution = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(particle_distribution)
+
 # ==================================================================================================
 # --- Initial particle distribution parameters (generation 1)
 #
@@ -37,8 +50,28 @@ d_config_particles["n_r"] = 2 * 16 * (d_config_particles["r_max"] - d_config_par
 # Number of angles for the initial particle distribution
 d_config_particles["n_angles"] = 5
 
-# Number of split for parallelization
+# Number of split for parallelization. Set to "auto" to get jobs tracking for about
+# target_job_duration seconds, given the number of turns and the context of the generation that
+# tracks (3 for two-stage studies, 2 otherwise). The default tracking throughput of the context can
+# be overridden with d_config_particles["throughput"] (in particle-turns per second).
 d_config_particles["n_split"] = 4
+target_job_duration = 3600.0
+
+# Split the particles with the same number of particles per job ("count"), or with the same
+# estimated cost per job ("cost"), since low-amplitude particles survive much longer
+d_config_particles["split_method"] = "count"
+
+# Model for the cost of the particles, used by the "cost" split and the "auto" number of splits
+d_config_particles["cost_model"] = {"da_estimate": 6.0, "da_width": 0.5}
+
+# Generator of the distribution ("polar_grid", "quasi_random" or "non_uniform_radial", see
+# master_study/master_jobs/1_build_distr_and_collider/particle_distribution.py for the parameters)
+d_config_particles["distribution"] = "polar_grid"
+
+# Storage of the distribution: one parquet file per split ("split_files"), a single parquet file with
+# one row group per split ("single_file"), or only the generator parameters ("generator"), in which
+# case each job regenerates its own chunk
+d_config_particles["storage"] = "split_files"
 
 # ==================================================================================================
 # --- Optics collider parameters (generation 1)
@@ -273,6 +306,44 @@ d_config_simulation["beam"] = "lhcb1"
 dump_collider = False
 dump_config_in_collider = False
 
+# Format of the dumped collider: "full" (complete collider json) or "snapshot" (variables changed
+# with respect to the base collider and beam-beam configuration only, a few kB per job)
+dump_collider_format = "full"
+
+# Format of the base collider file ("json" or "binary", the latter being faster to load)
+collider_format = "json"
+
+# If two_stage is True, the collider is configured once per working point (generation 2), and saved
+# for the tracking of the particle splits (generation 3), instead of being configured for each split
+two_stage = False
+
+# If warm_start is True, the matching of each working point is initialised with the knobs of the
+# nearest working point already solved (stored in the study folder)
+warm_start = False
+
+# If use_response_matrix is True, the tune and chromaticity knobs are predicted from a response
+# matrix computed once per study, and a full matching is only done if the prediction is not accurate
+use_response_matrix = False
+
+# If reuse_leveling_jacobian is True, the jacobians of the IP2/IP8 leveling are computed once per
+# study and reused by all the working points
+reuse_leveling_jacobian = False
+
+# If reuse_stages is True, the outputs of the configuration stages (tuning, leveling, coupling and
+# rematch) are shared between the working points, and only the stages depending on the scanned
+# parameters are re-run
+reuse_stages = False
+
+# ==================================================================================================
+# --- Machine imperfection seeds (generation 1)
+#
+# Below, the user can define a list of seeds for the machine imperfections. One base collider is
+# then built per seed (each with its own generation 2), and the sliced sequences and optics, which
+# don't depend on the seed, are built once and shared between the seeds through a cache in the
+# study folder. Set to None to build a single base collider without imperfections.
+# ==================================================================================================
+l_seeds = None  # e.g. list(range(1, 61))
+
 # ==================================================================================================
 # --- Machine parameters being scanned (generation 2)
 #
@@ -304,6 +375,42 @@ children["base_collider"]["config_particles"] = d_config_particles
 # Add base machine parameters to the first generation
 children["base_collider"]["config_mad"] = d_config_mad
 
+# Set the format of the base collider file
+children["base_collider"]["collider_format"] = collider_format
+
+# One base collider per seed if requested (the configuration is mutated after the second generation
+# has been built, below)
+l_base_colliders = (
+    ["base_collider"] if l_seeds is None else [f"base_collider_seed{seed:03}" for seed in l_seeds]
+)
+
+# ==================================================================================================
+# --- Splitting of the particle distribution
+#
+# The cost of the particles depends on the number of turns tracked. If requested, the number of
+# splits is set automatically from the target job duration and the context of the generation that
+# tracks. In two-stage studies, the tracking jobs only load the configured collider.
+# ==================================================================================================
+d_config_particles["n_turns"] = d_config_simulation["n_turns"]
+if d_config_particles["n_split"] == "auto":
+    generation_tracking = 3 if two_stage else 2
+    with open("config.yaml", "r") as fid:
+        context_tracking = yaml.safe_load(fid)["root"]["generations"][generation_tracking][
+            "context"
+        ]
+    d_config_particles["n_split"] = particle_distribution.get_n_split(
+        particle_distribution.generate_particle_distribution(d_config_particles),
+        d_config_particles,
+        context=context_tracking,
+        target_job_duration=target_job_duration,
+        job_overhead=(
+            particle_distribution.TRACK_JOB_OVERHEAD
+            if two_stage
+            else particle_distribution.JOB_OVERHEAD
+        ),
+    )
+    print(f"Number of splits set to {d_config_particles['n_split']}")
+
 
 # ==================================================================================================
 # --- Complete tree for the simulations (generation 2)
@@ -332,17 +439,79 @@ for idx_job, (track, qx, qy) in enumerate(itertools.product(track_array, array_q
         d_config_collider["config_knobs_and_tuning"]["qy"][beam] = float(qy)
 
     # Complete the dictionnary for the tracking
-    d_config_simulation["particle_file"] = f"../particles/{track:02}.parquet"
-    d_config_simulation["collider_file"] = f"../collider/collider.json"
+    if d_config_particles["storage"] == "split_files":
+        d_config_simulation["particle_file"] = f"../particles/{track:02}.parquet"
+    else:
+        d_config_simulation["particle_file"] = (
+            "../particles/particles.parquet"
+            if d_config_particles["storage"] == "single_file"
+            else "../particles/distribution.yaml"
+        )
+        d_config_simulation["particle_split"] = int(track)
+    d_config_simulation["collider_file"] = (
+        "../collider/collider.json" if collider_format == "json" else "../collider/collider.npz"
+    )
 
     # Add a child to the second generation, with all the parameters for the collider and tracking
-    children["base_collider"]["children"][f"xtrack_{idx_job:04}"] = {
-        "config_simulation": copy.deepcopy(d_config_simulation),
-        "config_collider": copy.deepcopy(d_config_collider),
-        "log_file": "tree_maker.log",
-        "dump_collider": dump_collider,
-        "dump_config_in_collider": dump_config_in_collider,
-    }
+    if not two_stage:
+        children["base_collider"]["children"][f"xtrack_{idx_job:04}"] = {
+            "config_simulation": copy.deepcopy(d_config_simulation),
+            "config_collider": copy.deepcopy(d_config_collider),
+            "log_file": "tree_maker.log",
+            "dump_collider": dump_collider,
+            "dump_config_in_collider": dump_config_in_collider,
+            "dump_collider_format": dump_collider_format,
+        }
+
+    # Or add a child to the second generation for the working point (only once, the splits being
+    # the outer loop), and a child to the third generation for the tracking of the split
+    else:
+        idx_working_point = idx_job % (len(array_qx) * len(array_qy))
+
+        # The configuration stage doesn't track any particle, only its children do (the particle
+        # file is explicitly unset as the template configuration defines one)
+        d_config_simulation_configure = {
+            key: value for key, value in d_config_simulation.items() if key != "particle_split"
+        }
+        d_config_simulation_configure["particle_file"] = None
+        node_working_point = children["base_collider"]["children"].setdefault(
+            f"xtrack_{idx_working_point:04}",
+            {
+                "config_simulation": copy.deepcopy(d_config_simulation_configure),
+                "config_collider": copy.deepcopy(d_config_collider),
+                "log_file": "tree_maker.log",
+                "dump_collider": dump_collider,
+                "dump_config_in_collider": dump_config_in_collider,
+                "dump_collider_format": dump_collider_format,
+                "mode": "configure",
+                "children": {},
+            },
+        )
+        d_config_simulation_track = copy.deepcopy(d_config_simulation)
+        d_config_simulation_track["particle_file"] = "../" + d_config_simulation["particle_file"]
+        d_config_simulation_track["collider_file"] = (
+            "../collider.json" if dump_collider_format == "full" else "../collider_snapshot.json"
+        )
+        node_working_point["children"][f"track_{track:02}"] = {
+            "config_simulation": d_config_simulation_track,
+            "log_file": "tree_maker.log",
+            "dump_collider": False,
+            "dump_config_in_collider": False,
+            "mode": "track",
+        }
+
+# Duplicate the first generation (and its second generation) for each seed
+if l_seeds is not None:
+    with open("master_jobs/1_build_distr_and_collider/config.yaml", "r") as fid:
+        pars_for_imperfections = yaml.safe_load(fid)["config_mad"]["pars_for_imperfections"]
+    base_collider = children.pop("base_collider")
+    for seed, name_base_collider in zip(l_seeds, l_base_colliders):
+        children[name_base_collider] = copy.deepcopy(base_collider)
+        children[name_base_collider]["config_mad"]["enable_imperfections"] = True
+        children[name_base_collider]["config_mad"]["pars_for_imperfections"] = {
+            **pars_for_imperfections,
+            "par_myseed": seed,
+        }
 
 # ==================================================================================================
 # --- Simulation configuration
@@ -376,6 +545,38 @@ study_name = "example_tunescan"
 if not os.path.exists("scans/" + study_name):
     os.makedirs("scans/" + study_name)
 
+# Share the sequences and optics between the seeds, through a cache in the study folder
+if l_seeds is not None:
+    for name_base_collider in l_base_colliders:
+        children[name_base_collider]["sequence_cache"] = {
+            "path": f"{os.getcwd()}/scans/{study_name}/sequence_cache"
+        }
+
+# Share the knob solutions between the working points, through a cache in the study folder
+if warm_start:
+    for name_base_collider in l_base_colliders:
+        for child in children[name_base_collider]["children"].values():
+            child["knob_cache_path"] = f"{os.getcwd()}/scans/{study_name}/knob_cache"
+
+# Share the knob response matrices between the working points
+if use_response_matrix:
+    for name_base_collider in l_base_colliders:
+        for child in children[name_base_collider]["children"].values():
+            child["response_matrix_path"] = f"{os.getcwd()}/scans/{study_name}/response_matrix"
+
+# Share the leveling jacobians between the working points
+if reuse_leveling_jacobian:
+    for name_base_collider in l_base_colliders:
+        for child in children[name_base_collider]["children"].values():
+            child["reuse_leveling_jacobian"] = True
+            child["leveling_jacobian_path"] = f"{os.getcwd()}/scans/{study_name}/leveling_jacobian"
+
+# Share the outputs of the configuration stages between the working points
+if reuse_stages:
+    for name_base_collider in l_base_colliders:
+        for child in children[name_base_collider]["children"].values():
+            child["stage_cache_path"] = f"{os.getcwd()}/scans/{study_name}/stage_cache"
+
 # Move to the folder that will contain the tree
 os.chdir("scans/" + study_name)
 
@@ -2,24 +2,168 @@
 # --- Imports
 # ==================================================================================================
 import copy
+import importlib.util
 import os
 import subprocess
 import time
 from pathlib import Path
 
+import numpy as np
+import pandas as pd
 import psutil
 import tree_maker
 import yaml
 
+# The particle distribution module of the first generation (also used for the cost model) is loaded
+# from its job folder, which is not a python package
+spec = importlib.util.spec_from_file_location(
+    "particle_distribution",
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "master_jobs/1_build_distr_and_collider/particle_distribution.py",
+    ),
+)
+particle_distribution = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(particle_distribution)
+
+
+# ==================================================================================================
+# --- Functions to estimate the cost of the jobs (used to submit the longest jobs first)
+# ==================================================================================================
+def get_node_tag_time(node, tag):
+    # Read the time at which a node has been tagged (in s), or None if it has not been tagged yet
+    path_log = f"{node.get_abs_path()}/tree_maker.log"
+    if not os.path.isfile(path_log):
+        return None
+    try:
+        dic_tags = tree_maker.tag_json.read_json(path_log)
+    except Exception:
+        return None
+    if tag not in dic_tags:
+        return None
+    # tree_maker stores unix time in ns
+    return dic_tags[tag]["unix_time"] / 1e9
+
+
+def get_node_runtime(node):
+    # Get the runtime (in s) of a completed node from its tree_maker log
+    time_started = get_node_tag_time(node, "started")
+    time_completed = get_node_tag_time(node, "completed")
+    if time_started is None or time_completed is None or time_completed < time_started:
+        return None
+    return time_completed - time_started
+
+
+def _get_particle_amplitudes(node, dic_amplitudes):
+    # Load (and cache) the amplitudes of the particles tracked by the node, if any
+    if "config_simulation" not in node.parameters:
+        return None
+    particle_file = node.parameters["config_simulation"].get("particle_file")
+    if particle_file is None:
+        return None
+    if not os.path.isabs(particle_file):
+        particle_file = os.path.normpath(f"{node.get_abs_path()}/{particle_file}")
+
+    # Distributions only stored as generator parameters are not read
+    if not particle_file.endswith(".parquet"):
+        return None
+
+    # Distributions stored in a single file are read once, and split afterwards
+    idx_split = node.parameters["config_simulation"].get("particle_split")
+    if particle_file not in dic_amplitudes:
+        try:
+            columns = ["normalized amplitude in xy-plane"]
+            if idx_split is not None:
+                columns.append("split")
+            dic_amplitudes[particle_file] = pd.read_parquet(particle_file, columns=columns)
+        except Exception:
+            # The particle distribution might not exist yet (generation 1 not completed)
+            dic_amplitudes[particle_file] = None
+    particle_df = dic_amplitudes[particle_file]
+    if particle_df is None:
+        return None
+    if idx_split is not None:
+        particle_df = particle_df[particle_df["split"] == idx_split]
+    return particle_df["normalized amplitude in xy-plane"].values
+
+
+def estimate_node_cost(node, config_cost_model, dic_amplitudes):
+    # Model cost of a node (in arbitrary units), from the number of turns and the amplitudes tracked
+    if "config_simulation" not in node.parameters:
+        return 0.0
+    n_turns = node.parameters["config_simulation"].get("n_turns", 0)
+    r_vect = _get_particle_amplitudes(node, dic_amplitudes)
+    if r_vect is None:
+        return float(n_turns)
+    return float(
+        np.sum(
+            particle_distribution.estimate_particles_cost(
+                r_vect,
+                n_turns,
+                da_estimate=config_cost_model.get("da_estimate", 6.0),
+                da_width=config_cost_model.get("da_width", 0.5),
+            )
+        )
+    )
+
+
+def sort_nodes_by_cost(list_of_nodes, config_generation):
+    # Sort the nodes such that the most expensive ones are submitted first. The model cost is
+    # calibrated (converted to seconds) with the runtime of the sibling nodes already completed.
+    config_cost_model = config_generation.get("cost_model", {})
+    dic_amplitudes = {}
+
+    # Model cost for all nodes
+    dic_cost = {
+        node.get_abs_path(): estimate_node_cost(node, config_cost_model, dic_amplitudes)
+        for node in list_of_nodes
+    }
+
+    # Ratio runtime/cost for completed nodes, grouped by parent
+    dic_ratios_parent = {}
+    for node in list_of_nodes:
+        if not node.has_been("completed") or dic_cost[node.get_abs_path()] == 0:
+            continue
+        runtime = get_node_runtime(node)
+        if runtime is not None:
+            dic_ratios_parent.setdefault(node.parent.get_abs_path(), []).append(
+                runtime / dic_cost[node.get_abs_path()]
+            )
+    l_all_ratios = [ratio for l_ratios in dic_ratios_parent.values() for ratio in l_ratios]
+    global_ratio = np.median(l_all_ratios) if len(l_all_ratios) > 0 else 1.0
+
+    # Estimated runtime for the nodes to be submitted (siblings first, then whole generation)
+    dic_estimated_runtime = {}
+    for node in list_of_nodes:
+        path_node = node.get_abs_path()
+        path_parent = node.parent.get_abs_path()
+        if path_parent in dic_ratios_parent:
+            ratio = np.median(dic_ratios_parent[path_parent])
+        else:
+            ratio = global_ratio
+        dic_estimated_runtime[path_node] = dic_cost[path_node] * ratio
+
+    # Sort is stable, so the tree order is kept for nodes with identical cost
+    return sorted(list_of_nodes, key=lambda node: -dic_estimated_runtime[node.get_abs_path()])
+
 
 # ==================================================================================================
 # --- Class for job submission
 # ==================================================================================================
 class ClusterSubmission:
-    def __init__(self, config, path_root):
-        # Configuration of the current generation
+    def __init__(self, config, path_root, path_dic_id_to_job=None, setup_env_script=None):
+        # Configuration of the current generation, and script setting the environment (only needed
+        # for the submissions that don't go through the run.sh of the nodes)
         self.config = config
-        if config["run_on"] in ["local_pc", "htc", "slurm", "htc_docker", "slurm_docker"]:
+        self.setup_env_script = setup_env_script
+        if config["run_on"] in [
+            "local_pc",
+            "htc",
+            "slurm",
+            "htc_docker",
+            "slurm_docker",
+            "slurm_mpi",
+        ]:
             self.run_on = self.config["run_on"]
         else:
             raise ("Error: Submission mode specified is not yet implemented")
@@ -30,6 +174,7 @@ class ClusterSubmission:
             "htc_docker",
             "slurm",
             "slurm_docker",
+            "slurm_mpi",
         ]:
             self.request_GPUs = 1
             self.slurm_queue_statement = ""
@@ -39,7 +184,10 @@ class ClusterSubmission:
 
         # Path to store the association between job path and job id after submission
         self.path_root = path_root
-        self.path_dic_id_to_job = f"{self.path_root}/id_job.yaml"
+        if path_dic_id_to_job is None:
+            self.path_dic_id_to_job = f"{self.path_root}/id_job.yaml"
+        else:
+            self.path_dic_id_to_job = path_dic_id_to_job
 
         # Path to singularity image
         if "singularity_image" in self.config:
@@ -58,6 +206,7 @@ class ClusterSubmission:
                 "body": lambda path_node: f"bash {path_node}/run.sh &\n",
                 "tail": f"#{self.run_on}\n",
                 "submit_command": lambda filename: f"bash {filename}",
+                "cancel_command": None,
             },
             "slurm": {
                 "head": "# Running on SLURM \n",
@@ -70,6 +219,7 @@ class ClusterSubmission:
                 ),
                 "tail": f"#{self.run_on}\n",
                 "submit_command": lambda filename: f"bash {filename}",
+                "cancel_command": lambda id_job: f"scancel {id_job}",
             },
             "slurm_docker": {
                 "head": lambda path_node: (
@@ -87,6 +237,31 @@ class ClusterSubmission:
                 ),
                 "tail": f"#{self.run_on}\n",
                 "submit_command": lambda filename: f"sbatch {filename}",
+                "cancel_command": lambda id_job: f"scancel {id_job}",
+            },
+            "slurm_mpi": {
+                "head": lambda path_sub_file: (
+                    "#!/bin/bash\n"
+                    + "# This is a SLURM submission file running all the jobs in one MPI allocation\n"
+                    + self.slurm_queue_statement
+                    + "\n"
+                    + f"#SBATCH --output={path_sub_file}.output.txt\n"
+                    + f"#SBATCH --error={path_sub_file}.error.txt\n"
+                    + f"#SBATCH --ntasks={self.config.get('mpi_ntasks', 4)}\n"
+                    + f"#SBATCH --gres=gpu:{self.request_GPUs}\n"
+                    + (
+                        f"source {self.setup_env_script}\n"
+                        if self.setup_env_script is not None
+                        else ""
+                    )
+                ),
+                "body": lambda path_nodes_file: (
+                    f"mpirun python {os.path.dirname(os.path.abspath(__file__))}/mpi_runner.py"
+                    f" --nodes-file {path_nodes_file}\n"
+                ),
+                "tail": f"#{self.run_on}\n",
+                "submit_command": lambda filename: f"sbatch {filename}",
+                "cancel_command": lambda id_job: f"scancel {id_job}",
             },
             "htc": {
                 "head": (
@@ -103,6 +278,7 @@ class ClusterSubmission:
                 ),
                 "tail": f"#{self.run_on}\n",
                 "submit_command": lambda filename: f"condor_submit {filename}",
+                "cancel_command": lambda id_job: f"condor_rm {id_job}",
             },
             "htc_docker": {
                 "head": (
@@ -122,6 +298,7 @@ class ClusterSubmission:
                 ),
                 "tail": f"#{self.run_on}\n",
                 "submit_command": lambda filename: f"condor_submit {filename}",
+                "cancel_command": lambda id_job: f"condor_rm {id_job}",
             },
         }
 
@@ -197,7 +374,9 @@ class ClusterSubmission:
             return True
         return False
 
-    def _write_sub_files_slurm(self, filename, running_jobs, queuing_jobs, list_of_nodes):
+    def _write_sub_files_slurm(
+        self, filename, running_jobs, queuing_jobs, list_of_nodes, force=False
+    ):
         l_filenames = []
         l_path_jobs = []
         for idx_node, node in enumerate(list_of_nodes):
@@ -207,8 +386,8 @@ class ClusterSubmission:
             # Get corresponding path job
             path_job = self._get_path_job(path_node)
 
-            # Test if node is running, queuing or completed
-            if self._test_node(node, path_job, running_jobs, queuing_jobs):
+            # Test if node is running, queuing or completed (unless a new copy is forced)
+            if force or self._test_node(node, path_job, running_jobs, queuing_jobs):
                 filename_node = f"{filename.split('.sub')[0]}_{idx_node}.sub"
 
                 # Write the submission files
@@ -240,7 +419,13 @@ class ClusterSubmission:
         return l_filenames, l_path_jobs
 
     def _write_sub_file(
-        self, filename, running_jobs, queuing_jobs, list_of_nodes, write_htc_job_flavour=False
+        self,
+        filename,
+        running_jobs,
+        queuing_jobs,
+        list_of_nodes,
+        write_htc_job_flavour=False,
+        force=False,
     ):
         # Get submission instructions
         str_head = self.dic_submission[self.run_on]["head"]
@@ -263,8 +448,8 @@ class ClusterSubmission:
                 # Get corresponding path job
                 path_job = self._get_path_job(path_node)
 
-                # Test if node is running, queuing or completed
-                if self._test_node(node, path_job, running_jobs, queuing_jobs):
+                # Test if node is running, queuing or completed (unless a new copy is forced)
+                if force or self._test_node(node, path_job, running_jobs, queuing_jobs):
                     print('Writing submission command for node "' + path_node + '"')
                     # Write instruction for submission
                     fid.write(str_body(path_node))
@@ -295,10 +480,47 @@ class ClusterSubmission:
 
         return ([filename], l_path_jobs) if ok_to_submit else ([], [])
 
-    def _write_sub_files(self, filename, running_jobs, queuing_jobs, list_of_nodes):
+    def _write_sub_file_mpi(self, filename, running_jobs, queuing_jobs, list_of_nodes, force=False):
+        # All the jobs are run in a single allocation, identified by the submission file
+        path_sub_file = os.path.abspath(filename)
+        path_batch = f"mpi_batch:{path_sub_file}"
+        if path_batch in running_jobs + queuing_jobs:
+            print(f"MPI batch {path_sub_file} is already running or queuing.")
+            return [], []
+
+        # Write the list of nodes to run
+        l_path_nodes = []
+        for node in list_of_nodes:
+            path_node = node.get_abs_path()
+            path_job = self._get_path_job(path_node)
+            if force or self._test_node(node, path_job, running_jobs, queuing_jobs):
+                l_path_nodes.append(path_node)
+        if len(l_path_nodes) == 0:
+            return [], []
+        with open(f"{path_sub_file}.nodes", "w") as fid:
+            fid.write("\n".join(l_path_nodes) + "\n")
+
+        # Write the submission file
+        print(f"Writing MPI submission file for {len(l_path_nodes)} nodes")
+        with open(filename, "w") as fid:
+            fid.write(self.dic_submission[self.run_on]["head"](path_sub_file))
+            fid.write(self.dic_submission[self.run_on]["body"](f"{path_sub_file}.nodes"))
+            fid.write(self.dic_submission[self.run_on]["tail"])
+
+        return [filename], [path_batch]
+
+    def _write_sub_files(self, filename, running_jobs, queuing_jobs, list_of_nodes, force=False):
+        # Slurm MPI runs all the jobs in a single allocation
+        if self.run_on == "slurm_mpi":
+            return self._write_sub_file_mpi(
+                filename, running_jobs, queuing_jobs, list_of_nodes, force=force
+            )
+
         # Slurm docker is a peculiar case as one submission file must be created per job
-        if self.run_on == "slurm_docker":
-            return self._write_sub_files_slurm(filename, running_jobs, queuing_jobs, list_of_nodes)
+        elif self.run_on == "slurm_docker":
+            return self._write_sub_files_slurm(
+                filename, running_jobs, queuing_jobs, list_of_nodes, force=force
+            )
 
         # htcondor, local_pc, etc.
         else:
@@ -308,15 +530,34 @@ class ClusterSubmission:
                 queuing_jobs,
                 list_of_nodes,
                 write_htc_job_flavour=True if self.run_on in ["htc", "htc_docker"] else False,
+                force=force,
             )
 
-    def write_sub_files(self, list_of_nodes, filename="file.sub"):
+    def write_sub_files(self, list_of_nodes, filename="file.sub", force=False):
         running_jobs, queuing_jobs = self._get_state_jobs(verbose=False)
         l_filenames, l_path_jobs = self._write_sub_files(
-            filename, running_jobs, queuing_jobs, list_of_nodes
+            filename, running_jobs, queuing_jobs, list_of_nodes, force=force
         )
         return l_filenames, l_path_jobs
 
+    def cancel(self, l_id_jobs):
+        # Cancel the given jobs and remove them from the id-job file
+        if self.dic_submission[self.run_on]["cancel_command"] is None:
+            print(f"Cancelling jobs is not implemented for submission mode {self.run_on}.")
+            return
+        for id_job in l_id_jobs:
+            print(f"Cancelling job {id_job}")
+            subprocess.run(
+                self.dic_submission[self.run_on]["cancel_command"](id_job).split(" "),
+                capture_output=True,
+            )
+
+        dic_id_to_job = self.dic_id_to_job
+        if dic_id_to_job is not None:
+            for id_job in l_id_jobs:
+                dic_id_to_job.pop(id_job, None)
+            self.dic_id_to_job = dic_id_to_job
+
     def submit(self, l_filenames, l_jobs):
         # Check that the submission file(s) is/are appropriate for the submission mode
         if len(l_filenames) > 1 and self.run_on != "slurm_docker":
@@ -531,7 +772,7 @@ class ClusterSubmission:
         elif self.run_on == "htc" or self.run_on == "htc_docker":
             l_jobs = self._get_condor_jobs(status, dic_id_to_job)
 
-        elif self.run_on == "slurm" or self.run_on == "slurm_docker":
+        elif self.run_on in ["slurm", "slurm_docker", "slurm_mpi"]:
             l_jobs = self._get_slurm_jobs(status, dic_id_to_job)
 
         else:
@@ -539,10 +780,290 @@ class ClusterSubmission:
         return l_jobs
 
 
+# ==================================================================================================
+# --- Class for federated job submission (several backends at once)
+# ==================================================================================================
+class FederatedSubmission:
+    def __init__(self, config, path_root, setup_env_script=None):
+        # Configuration of the current generation, with one entry per backend. Each backend can
+        # override the submission parameters of the generation (e.g. htc_job_flavor,
+        # singularity_image, etc.), and must define the maximum number of jobs it can run or queue
+        # at the same time (max_jobs). The context can't be overridden, as it is written in the
+        # configuration of the jobs when the study is created.
+        self.config = config
+        self.path_root = path_root
+        self.dic_max_jobs = {}
+        self.dic_cluster_submission = {}
+        for backend, config_backend in config["backends"].items():
+            # The backend name is used as run_on, unless explicitly given
+            config_backend = {
+                **{
+                    key: value for key, value in config.items() if key not in ["backends", "run_on"]
+                },
+                "run_on": backend,
+                **config_backend,
+            }
+            if config_backend["run_on"] == "federated":
+                raise ValueError("Error: A backend of a federated submission can't be federated")
+            if config_backend["context"] != config["context"]:
+                raise ValueError(
+                    f"Error: The context of the generation can't be overridden by backend {backend}"
+                )
+            self.dic_max_jobs[backend] = int(config_backend.get("max_jobs", 100))
+
+            # Each backend has its own id-job file, as ids are only unique within a backend
+            self.dic_cluster_submission[backend] = ClusterSubmission(
+                config_backend,
+                path_root,
+                path_dic_id_to_job=f"{path_root}/id_job_{backend}.yaml",
+                setup_env_script=setup_env_script,
+            )
+
+        # Path to the job store, recording the backend on which each job has been placed
+        self.path_job_store = f"{self.path_root}/job_store.yaml"
+
+    # Getter for the job store
+    @property
+    def job_store(self):
+        if os.path.isfile(self.path_job_store):
+            with open(self.path_job_store, "r") as fid:
+                return yaml.load(fid, Loader=yaml.FullLoader)
+        else:
+            return {}
+
+    # Setter for the job store
+    @job_store.setter
+    def job_store(self, job_store):
+        assert isinstance(job_store, dict)
+        with open(self.path_job_store, "w") as fid:
+            yaml.dump(job_store, fid)
+
+    _get_path_job = staticmethod(ClusterSubmission._get_path_job)
+
+    def _get_state_jobs_backends(self):
+        dic_state = {}
+        for backend, cluster_submission in self.dic_cluster_submission.items():
+            dic_state[backend] = cluster_submission._get_state_jobs(verbose=False)
+        return dic_state
+
+    def _get_state_jobs(self, verbose=True):
+        running_jobs = []
+        queuing_jobs = []
+        for running_jobs_backend, queuing_jobs_backend in self._get_state_jobs_backends().values():
+            running_jobs += running_jobs_backend
+            queuing_jobs += queuing_jobs_backend
+        if verbose:
+            print(f"Running: \n" + "\n".join(running_jobs))
+            print(f"queuing: \n" + "\n".join(queuing_jobs))
+        return running_jobs, queuing_jobs
+
+    def _get_throughputs(self, list_of_nodes, job_store):
+        # Observed throughput (completed jobs per second and per slot) of each backend
+        dic_runtimes = {backend: [] for backend in self.dic_cluster_submission}
+        for node in list_of_nodes:
+            path_job = self._get_path_job(node.get_abs_path())
+            if path_job in job_store and node.has_been("completed"):
+                runtime = get_node_runtime(node)
+                if runtime is not None and job_store[path_job]["backend"] in dic_runtimes:
+                    dic_runtimes[job_store[path_job]["backend"]].append(runtime)
+        dic_throughput = {
+            backend: 1 / np.mean(l_runtimes)
+            for backend, l_runtimes in dic_runtimes.items()
+            if len(l_runtimes) > 0 and np.mean(l_runtimes) > 0
+        }
+
+        # Backends without history are assumed to be as fast as the median backend
+        default_throughput = (
+            np.median(list(dic_throughput.values())) if len(dic_throughput) > 0 else 1.0
+        )
+        return {
+            backend: dic_throughput.get(backend, default_throughput)
+            for backend in self.dic_cluster_submission
+        }
+
+    def split_nodes(self, list_of_nodes, l_pending_nodes, dic_state):
+        # Split the pending nodes between the backends in proportion to their free capacity
+        # weighted by their observed throughput
+        job_store = self.job_store
+        dic_throughput = self._get_throughputs(list_of_nodes, job_store)
+        dic_free = {
+            backend: max(
+                0,
+                self.dic_max_jobs[backend]
+                - len(dic_state[backend][0])
+                - len(dic_state[backend][1]),
+            )
+            for backend in self.dic_cluster_submission
+        }
+        n_to_submit = min(len(l_pending_nodes), sum(dic_free.values()))
+        dic_share = {backend: dic_free[backend] * dic_throughput[backend] for backend in dic_free}
+        total_share = sum(dic_share.values())
+        if n_to_submit == 0 or total_share == 0:
+            return {backend: [] for backend in self.dic_cluster_submission}
+
+        # Largest remainder allocation, capped by the free capacity of each backend
+        dic_n_jobs = {
+            backend: min(dic_free[backend], int(n_to_submit * share / total_share))
+            for backend, share in dic_share.items()
+        }
+        l_backends_by_remainder = sorted(
+            dic_share,
+            key=lambda backend: (n_to_submit * dic_share[backend] / total_share) % 1,
+            reverse=True,
+        )
+        while sum(dic_n_jobs.values()) < n_to_submit:
+            for backend in l_backends_by_remainder:
+                if (
+                    dic_n_jobs[backend] < dic_free[backend]
+                    and sum(dic_n_jobs.values()) < n_to_submit
+                ):
+                    dic_n_jobs[backend] += 1
+
+        # The most expensive nodes (first in the list) go to the fastest backends
+        dic_nodes = {}
+        idx_node = 0
+        for backend in sorted(dic_n_jobs, key=lambda backend: -dic_throughput[backend]):
+            dic_nodes[backend] = l_pending_nodes[idx_node : idx_node + dic_n_jobs[backend]]
+            idx_node += dic_n_jobs[backend]
+        return dic_nodes
+
+    def submit_nodes(self, list_of_nodes, filename="file.sub", max_jobs=None):
+        # Get pending nodes, i.e. not completed, and not running or queuing on any backend
+        dic_state = self._get_state_jobs_backends()
+        set_current_jobs = set()
+        for running_jobs, queuing_jobs in dic_state.values():
+            set_current_jobs.update(running_jobs + queuing_jobs)
+        l_pending_nodes = [
+            node
+            for node in list_of_nodes
+            if not node.has_been("completed")
+            and self._get_path_job(node.get_abs_path()) not in set_current_jobs
+        ]
+        if max_jobs is not None:
+            l_pending_nodes = l_pending_nodes[:max_jobs]
+
+        # Split and submit
+        dic_nodes = self.split_nodes(list_of_nodes, l_pending_nodes, dic_state)
+        job_store = self.job_store
+        for backend, l_nodes in dic_nodes.items():
+            if len(l_nodes) == 0:
+                continue
+            print(f"Submitting {len(l_nodes)} jobs on backend {backend}")
+            cluster_submission = self.dic_cluster_submission[backend]
+            l_filenames, l_path_jobs = cluster_submission.write_sub_files(
+                l_nodes, filename.replace(".sub", f"_{backend}.sub")
+            )
+            cluster_submission.submit(l_filenames, l_path_jobs)
+
+            # Record placement
+            for path_job in l_path_jobs:
+                job_store[path_job] = {
+                    "backend": backend,
+                    "run_on": cluster_submission.run_on,
+                    "submission_time": time.time(),
+                }
+        self.job_store = job_store
+
+
+def get_submission(config_generation, path_root, setup_env_script=None):
+    # Get the object handling the submission of a generation
+    if config_generation["run_on"] == "federated":
+        return FederatedSubmission(config_generation, path_root, setup_env_script)
+    else:
+        return ClusterSubmission(config_generation, path_root, setup_env_script=setup_env_script)
+
+
+# ==================================================================================================
+# --- Functions to handle stragglers (speculative re-execution of slow jobs)
+# ==================================================================================================
+def _get_copies_of_jobs(cluster_submission):
+    # Get all the copies (ids) of each job currently running or queuing
+    running_jobs, queuing_jobs = cluster_submission._get_state_jobs(verbose=False)
+    dic_job_to_ids = {}
+    dic_id_to_job = cluster_submission.dic_id_to_job
+    if dic_id_to_job is not None:
+        for id_job, job in dic_id_to_job.items():
+            dic_job_to_ids.setdefault(job, []).append(id_job)
+    return running_jobs, queuing_jobs, dic_job_to_ids
+
+
+def cancel_redundant_copies(root, generation, cluster_submission):
+    # The first copy of a job to complete is kept, the other ones are cancelled
+    running_jobs, queuing_jobs, dic_job_to_ids = _get_copies_of_jobs(cluster_submission)
+    set_current_jobs = set(running_jobs + queuing_jobs)
+    l_ids_to_cancel = []
+    for node in root.generation(generation):
+        path_job = cluster_submission._get_path_job(node.get_abs_path())
+        if node.has_been("completed") and path_job in set_current_jobs:
+            l_ids_to_cancel += dic_job_to_ids.get(path_job, [])
+    if len(l_ids_to_cancel) > 0:
+        cluster_submission.cancel(l_ids_to_cancel)
+
+
+def handle_stragglers(
+    root,
+    generation,
+    cluster_submission,
+    path_file,
+    straggler_factor=3.0,
+    min_siblings=3,
+    max_duplicates=None,
+):
+    # Jobs can only be tracked (and cancelled) through their id
+    if cluster_submission.dic_id_to_job is None or cluster_submission.run_on == "local_pc":
+        print("Straggler handling requires job ids, which are not available for this submission.")
+        return
+
+    # Cancel the copies of the jobs that have already been completed
+    cancel_redundant_copies(root, generation, cluster_submission)
+
+    # Look for running jobs much slower than their siblings
+    running_jobs, _, dic_job_to_ids = _get_copies_of_jobs(cluster_submission)
+    l_nodes_to_duplicate = []
+    for node in root.generation(generation):
+        if node.has_been("completed"):
+            continue
+        path_job = cluster_submission._get_path_job(node.get_abs_path())
+        l_ids = dic_job_to_ids.get(path_job, [])
+
+        # Only consider running jobs that have not been duplicated yet
+        if path_job not in running_jobs or len(l_ids) != 1:
+            continue
+        time_started = get_node_tag_time(node, "started")
+        if time_started is None:
+            continue
+
+        # Compare elapsed time with the median runtime of the completed siblings
+        l_runtimes = [
+            get_node_runtime(sibling)
+            for sibling in node.parent.children
+            if sibling.has_been("completed")
+        ]
+        l_runtimes = [runtime for runtime in l_runtimes if runtime is not None]
+        if len(l_runtimes) < min_siblings:
+            continue
+        elapsed = time.time() - time_started
+        if elapsed > straggler_factor * np.median(l_runtimes):
+            print(
+                f"{path_job} is a straggler (running for {elapsed:.0f} s, median runtime of"
+                f" siblings is {np.median(l_runtimes):.0f} s). Submitting a duplicate."
+            )
+            l_nodes_to_duplicate.append(node)
+
+    # Submit duplicates of the stragglers, within the budget of jobs if any
+    if max_duplicates is not None:
+        l_nodes_to_duplicate = l_nodes_to_duplicate[:max_duplicates]
+    if len(l_nodes_to_duplicate) > 0:
+        l_filenames, l_path_jobs = cluster_submission.write_sub_files(
+            l_nodes_to_duplicate, path_file.replace(".sub", "_stragglers.sub"), force=True
+        )
+        cluster_submission.submit(l_filenames, l_path_jobs)
+
+
 # ==================================================================================================
 # --- Main submission function
 # ==================================================================================================
-def submit_jobs_generation(root, generation=1):
+def submit_jobs_generation(root, generation=1, max_jobs=None):
     # Define a dictionnary that associates a name to each generation number
     dic_int_to_str = {1: "first", 2: "second", 3: "third", 4: "fourth", 5: "fifth"}
     if generation not in dic_int_to_str:
@@ -550,13 +1071,73 @@ def submit_jobs_generation(root, generation=1):
 
     # Submit all the pending jobs of a given generation
     config_generation = root.parameters["generations"][f"{generation}"]
-    cluster_submission = ClusterSubmission(config_generation, root.get_abs_path())
-    path_file = f"submission_files/{dic_int_to_str[generation]}_generation.sub"
-    l_filenames, l_path_jobs = cluster_submission.write_sub_files(
-        root.generation(generation), path_file
+    cluster_submission = get_submission(
+        config_generation, root.get_abs_path(), root.parameters["setup_env_script"]
     )
+    path_file = f"submission_files/{dic_int_to_str[generation]}_generation.sub"
+
+    # Submit the most expensive jobs first to reduce the tail of the study
+    list_of_nodes = get_ready_nodes(root, generation)
+    if config_generation.get("order_by_cost", True):
+        list_of_nodes = sort_nodes_by_cost(list_of_nodes, config_generation)
+
+    # Federated submission splits the jobs between several backends
+    if isinstance(cluster_submission, FederatedSubmission):
+        cluster_submission.submit_nodes(list_of_nodes, path_file, max_jobs=max_jobs)
+        return
+
+    # Only submit a limited number of jobs if requested (e.g. when sharing a budget between studies)
+    if max_jobs is not None:
+        list_of_nodes = get_pending_nodes(list_of_nodes, cluster_submission)[:max_jobs]
+
+    l_filenames, l_path_jobs = cluster_submission.write_sub_files(list_of_nodes, path_file)
     cluster_submission.submit(l_filenames, l_path_jobs)
 
+    # Speculatively re-execute the jobs that are much slower than their siblings, if requested
+    if "straggler_factor" in config_generation:
+        handle_stragglers(
+            root,
+            generation,
+            cluster_submission,
+            path_file,
+            straggler_factor=config_generation["straggler_factor"],
+            min_siblings=config_generation.get("straggler_min_siblings", 3),
+            max_duplicates=None if max_jobs is None else max(max_jobs - len(list_of_nodes), 0),
+        )
+
+
+def get_pending_nodes(list_of_nodes, cluster_submission):
+    # Get the nodes that are not completed, running or queuing
+    running_jobs, queuing_jobs = cluster_submission._get_state_jobs(verbose=False)
+    set_current_jobs = set(running_jobs + queuing_jobs)
+    return [
+        node
+        for node in list_of_nodes
+        if not node.has_been("completed")
+        and cluster_submission._get_path_job(node.get_abs_path()) not in set_current_jobs
+    ]
+
+
+def get_ready_nodes(root, generation):
+    # Get the nodes of a generation whose parent is completed (the first generation is always ready)
+    list_of_nodes = list(root.generation(generation))
+    if generation == 1:
+        return list_of_nodes
+    return [node for node in list_of_nodes if node.parent.has_been("completed")]
+
+
+def get_generations_to_submit(root):
+    # Get the generations that are not completed yet and have nodes ready to be submitted. A node
+    # only waits for its own parent, e.g. the tracking of a working point (generation 3) starts as
+    # soon as its collider is configured, even if other working points (generation 2) are not done.
+    # The list is empty if all generations are completed.
+    return [
+        generation
+        for generation in sorted(int(generation) for generation in root.parameters["generations"])
+        if not all([node.has_been("completed") for node in root.generation(generation)])
+        and len(get_ready_nodes(root, generation)) > 0
+    ]
+
 
 def submit_jobs(study_name, print_uncompleted_jobs=False):
     # Add suffix to the root node path to handle scans that are not in the root directory
@@ -568,26 +1149,29 @@ def submit_jobs(study_name, print_uncompleted_jobs=False):
     if root.has_been("completed"):
         print("All descendants of root are completed!")
     else:
-        # Check generation 1
-        gen_1_completed = all([node.has_been("completed") for node in root.generation(1)])
-        if not gen_1_completed:
-            print("######## Taking care of generation 1 ########")
-            submit_jobs_generation(root, generation=1)
-        else:
-            print("Generation 1 is already completed.")
-
-        # Check generation 2
-        gen_2_completed = all([node.has_been("completed") for node in root.generation(2)])
-        if gen_1_completed and not gen_2_completed:
-            print("######## Taking care of generation 2 ########")
-            submit_jobs_generation(root, generation=2)
-        else:
-            if not gen_1_completed:
-                pass
-            else:
-                print("Generation 2 is already completed.")
-
-        # We assume there's no generation 3
+        # Each node can only be submitted once its parent is completed
+        l_generations_to_submit = get_generations_to_submit(root)
+        for generation in sorted(int(generation) for generation in root.parameters["generations"]):
+            list_of_nodes = list(root.generation(generation))
+            if not list_of_nodes or not all([node.has_been("completed") for node in list_of_nodes]):
+                continue
+            print(f"Generation {generation} is already completed.")
+
+            # Cancel the remaining copies of the stragglers, if any
+            config_generation = root.parameters["generations"][f"{generation}"]
+            if (
+                "straggler_factor" in config_generation
+                and config_generation["run_on"] != "federated"
+            ):
+                cancel_redundant_copies(
+                    root, generation, ClusterSubmission(config_generation, root.get_abs_path())
+                )
+
+        for generation in l_generations_to_submit:
+            print(f"######## Taking care of generation {generation} ########")
+            submit_jobs_generation(root, generation=generation)
+
+        # Check if all generations are completed
         if all([descendant.has_been("completed") for descendant in root.descendants]):
             root.tag_as("completed")
             print("All descendants of root are completed!")
@@ -599,6 +1183,150 @@ def submit_jobs(study_name, print_uncompleted_jobs=False):
                     print("To be completed: " + descendant.get_abs_path())
 
 
+# ==================================================================================================
+# --- Multi-study submission, sharing a budget of jobs in flight
+# ==================================================================================================
+def load_studies(dic_studies=None, path_scans="scans"):
+    # Load the trees of the requested studies (all the studies in path_scans by default), along
+    # with their scheduling parameters
+    if dic_studies is None:
+        dic_studies = {
+            study_name: {}
+            for study_name in sorted(os.listdir(path_scans))
+            if os.path.isfile(f"{path_scans}/{study_name}/tree_maker.json")
+        }
+
+    dic_roots = {}
+    for study_name, config_study in dic_studies.items():
+        fix = f"/{path_scans}/{study_name}"
+        root = tree_maker.tree_from_json(fix[1:] + "/tree_maker.json")
+        root.add_suffix(suffix=fix)
+        weight = float(config_study.get("weight", 1.0))
+        if weight <= 0:
+            raise ValueError(f"The weight of study {study_name} must be positive, got {weight}")
+        dic_roots[study_name] = {
+            "root": root,
+            "weight": weight,
+            "priority": int(config_study.get("priority", 0)),
+        }
+    return dic_roots
+
+
+def get_backends(cluster_submission):
+    # Get the single-backend submissions of a (possibly federated) submission
+    if isinstance(cluster_submission, FederatedSubmission):
+        return list(cluster_submission.dic_cluster_submission.values())
+    return [cluster_submission]
+
+
+def count_jobs_in_flight(l_jobs, study_name):
+    # Count the jobs of a study in flight. Each copy of a job (e.g. duplicated straggler) counts, and
+    # an MPI batch counts for the number of nodes of the study it runs.
+    n_jobs = 0
+    for job in l_jobs:
+        if job.startswith("mpi_batch:"):
+            path_nodes = f"{job[len('mpi_batch:'):]}.nodes"
+            if os.path.isfile(path_nodes):
+                with open(path_nodes, "r") as fid:
+                    n_jobs += len([line for line in fid if f"/scans/{study_name}/" in line])
+        elif job.startswith(f"/scans/{study_name}/"):
+            n_jobs += 1
+    return n_jobs
+
+
+def share_budget(dic_in_flight, dic_pending, dic_weights, dic_priorities, max_jobs_in_flight):
+    # Distribute the free slots between the studies. Studies with a higher priority are served
+    # first, and studies with the same priority share the slots in proportion to their weight.
+    n_free = max_jobs_in_flight - sum(dic_in_flight.values())
+    dic_allocated = {study_name: 0 for study_name in dic_pending}
+    for priority in sorted(set(dic_priorities.values()), reverse=True):
+        l_studies = [
+            study_name for study_name in dic_pending if dic_priorities[study_name] == priority
+        ]
+        while n_free > 0:
+            # Give the next slot to the study that is the most behind its fair share
+            l_candidates = [
+                study_name
+                for study_name in l_studies
+                if dic_allocated[study_name] < dic_pending[study_name]
+            ]
+            if len(l_candidates) == 0:
+                break
+            study_name = min(
+                l_candidates,
+                key=lambda study_name: (dic_in_flight[study_name] + dic_allocated[study_name])
+                / dic_weights[study_name],
+            )
+            dic_allocated[study_name] += 1
+            n_free -= 1
+    return dic_allocated
+
+
+def submit_jobs_multi_study(dic_studies=None, max_jobs_in_flight=1000):
+    dic_roots = load_studies(dic_studies)
+
+    # Get the number of jobs in flight and pending (per generation) for each study
+    dic_pending_per_generation = {}
+    dic_in_flight = {}
+    dic_pending = {}
+    for study_name, dic_study in dic_roots.items():
+        root = dic_study["root"]
+        l_generations = get_generations_to_submit(root)
+        dic_pending_per_generation[study_name] = {}
+        if len(l_generations) == 0:
+            print(f"All descendants of {study_name} are completed!")
+            root.tag_as("completed")
+            dic_in_flight[study_name] = 0
+            dic_pending[study_name] = 0
+            continue
+
+        # The jobs of each backend are only queried once, even if it's used by several generations
+        dic_jobs_backends = {}
+        for generation in l_generations:
+            config_generation = root.parameters["generations"][f"{generation}"]
+            cluster_submission = get_submission(
+                config_generation, root.get_abs_path(), root.parameters["setup_env_script"]
+            )
+            for backend in get_backends(cluster_submission):
+                key = (backend.run_on, backend.path_dic_id_to_job)
+                if key not in dic_jobs_backends:
+                    running_jobs, queuing_jobs = backend._get_state_jobs(verbose=False)
+                    dic_jobs_backends[key] = running_jobs + queuing_jobs
+            dic_pending_per_generation[study_name][generation] = len(
+                get_pending_nodes(get_ready_nodes(root, generation), cluster_submission)
+            )
+
+        # Only count the jobs of the current study (local jobs of all studies are seen otherwise)
+        dic_in_flight[study_name] = sum(
+            count_jobs_in_flight(l_jobs, study_name) for l_jobs in dic_jobs_backends.values()
+        )
+        dic_pending[study_name] = sum(dic_pending_per_generation[study_name].values())
+
+    # Share the budget and submit
+    dic_allocated = share_budget(
+        dic_in_flight,
+        dic_pending,
+        {study_name: dic_roots[study_name]["weight"] for study_name in dic_roots},
+        {study_name: dic_roots[study_name]["priority"] for study_name in dic_roots},
+        max_jobs_in_flight,
+    )
+    for study_name, n_jobs in dic_allocated.items():
+        print(
+            f"{study_name}: {dic_in_flight[study_name]} jobs in flight,"
+            f" {dic_pending[study_name]} pending, {n_jobs} being submitted."
+        )
+        # Fill the allocated slots starting with the earliest generation
+        for generation, n_pending in dic_pending_per_generation[study_name].items():
+            n_jobs_generation = min(n_jobs, n_pending)
+            if n_jobs_generation <= 0:
+                continue
+            print(f"######## Taking care of generation {generation} ########")
+            submit_jobs_generation(
+                dic_roots[study_name]["root"], generation=generation, max_jobs=n_jobs_generation
+            )
+            n_jobs -= n_jobs_generation
+
+
 # ==================================================================================================
 # --- Submission
 # ==================================================================================================
@@ -607,5 +1335,15 @@ if __name__ == "__main__":
     # Define study
     study_name = "example_tunescan"
 
+    # Set to True to submit several studies sharing the same budget of jobs in flight. Studies are
+    # given with an optional weight (share of the budget) and priority (higher is served first). If
+    # dic_studies is None, all the studies in the scans folder are submitted with the same weight.
+    multi_study = False
+    dic_studies = {study_name: {"weight": 1.0, "priority": 0}}
+    max_jobs_in_flight = 1000
+
     # Submit jobs
-    submit_jobs(study_name)
+    if multi_study:
+        submit_jobs_multi_study(dic_studies, max_jobs_in_flight)
+    else:
+        submit_jobs(study_name)
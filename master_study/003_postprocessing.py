@@ -32,33 +32,46 @@ l_df_to_merge = []
 for node in root.generation(1):
     with open(f"{node.get_abs_path()}/config.yaml", "r") as fid:
         config_parent = yaml.safe_load(fid)
-    for node_child in node.children:
-        with open(f"{node_child.get_abs_path()}/config.yaml", "r") as fid:
+    # In two-stage studies, the tracking is done by the children of the working point nodes
+    l_nodes = [
+        (node_child, node_sim)
+        for node_child in node.children
+        for node_sim in (node_child.children if len(node_child.children) > 0 else [node_child])
+    ]
+    for node_child, node_sim in l_nodes:
+        with open(f"{node_sim.get_abs_path()}/config.yaml", "r") as fid:
             config_child = yaml.safe_load(fid)
 
         try:
-            # Read the particle path as relative
-            try:
-                particle = pd.read_parquet(
-                    f"{node_child.get_abs_path()}/{config_child['config_simulation']['particle_file']}"
-                )
+            df_sim = pd.read_parquet(f"{node_sim.get_abs_path()}/output_particles.parquet")
 
-            # If it doesn't work, try to read it as absolute
-            except:
-                particle = pd.read_parquet(f"{config_child['config_simulation']['particle_file']}")
+            # Initial amplitudes and angles are already in the output of recent jobs
+            if "normalized amplitude in xy-plane" in df_sim.columns:
+                particle = None
 
-            df_sim = pd.read_parquet(f"{node_child.get_abs_path()}/output_particles.parquet")
+            # Read the particle path as relative
+            else:
+                try:
+                    particle = pd.read_parquet(
+                        f"{node_sim.get_abs_path()}/{config_child['config_simulation']['particle_file']}"
+                    )
+
+                # If it doesn't work, try to read it as absolute
+                except:
+                    particle = pd.read_parquet(
+                        f"{config_child['config_simulation']['particle_file']}"
+                    )
 
         except Exception as e:
             print(e)
-            l_problematic_sim.append(node_child.get_abs_path())
+            l_problematic_sim.append(node_sim.get_abs_path())
             continue
 
         # Register paths and names of the nodes
         df_sim["path base collider"] = f"{node.get_abs_path()}"
         df_sim["name base collider"] = f"{node.name}"
-        df_sim["path simulation"] = f"{node_child.get_abs_path()}"
-        df_sim["name simulation"] = f"{node_child.name}"
+        df_sim["path simulation"] = f"{node_sim.get_abs_path()}"
+        df_sim["name simulation"] = f"{node_sim.name}"
 
         # Get node parameters as dictionnaries for parameter assignation
         dic_child_collider = node_child.parameters["config_collider"]
@@ -72,6 +85,12 @@ for node in root.generation(1):
         # Get which beam is being tracked
         df_sim["beam"] = dic_child_simulation["beam"]
 
+        # Get the seed of the machine imperfections, if any
+        try:
+            df_sim["seed"] = dic_parent_collider["pars_for_imperfections"]["par_myseed"]
+        except:
+            df_sim["seed"] = None
+
         # Get scanned parameters (complete with the requested scanned parameters)
         df_sim["qx"] = dic_child_collider["config_knobs_and_tuning"]["qx"]["lhcb1"]
         df_sim["qy"] = dic_child_collider["config_knobs_and_tuning"]["qy"]["lhcb1"]
@@ -97,8 +116,9 @@ for node in root.generation(1):
         )
 
         # Merge with particle data
-        df_sim_with_particle = pd.merge(df_sim, particle, on=["particle_id"])
-        l_df_to_merge.append(df_sim_with_particle)
+        if particle is not None:
+            df_sim = pd.merge(df_sim, particle, on=["particle_id"])
+        l_df_to_merge.append(df_sim)
 
 # ==================================================================================================
 # --- # Merge all jobs outputs in one dataframe and save it
@@ -128,6 +148,7 @@ l_parameters_to_keep = [
     "i_bunch_b2",
     "num_particles_per_bunch",
     "crossing_angle",
+    "seed",
 ]
 
 # Min is computed in the groupby function, but values should be identical
@@ -0,0 +1,69 @@
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import xtrack as xt
+
+# Make the job scripts importable
+path_master_jobs = os.path.join(os.path.dirname(os.path.abspath(__file__)), "master_jobs")
+sys.path.insert(0, f"{path_master_jobs}/1_build_distr_and_collider")
+from collider_binary import load_collider_binary, save_collider_binary
+
+
+# ==================================================================================================
+# --- Functions to benchmark the collider formats
+# ==================================================================================================
+def time_load(path_collider, n_repeat):
+    l_durations = []
+    for _ in range(n_repeat):
+        start = time.time()
+        if path_collider.endswith(".npz"):
+            collider = load_collider_binary(path_collider)
+        else:
+            collider = xt.Multiline.from_json(path_collider)
+        l_durations.append(time.time() - start)
+    return collider, np.median(l_durations)
+
+
+def benchmark_collider_format(path_collider_json, n_repeat=3):
+    # Convert the json collider to the binary format
+    path_collider_binary = path_collider_json.replace(".json", ".npz")
+    collider, duration_json = time_load(path_collider_json, n_repeat)
+    start = time.time()
+    save_collider_binary(collider, path_collider_binary)
+    duration_write = time.time() - start
+    collider_binary, duration_binary = time_load(path_collider_binary, n_repeat)
+
+    print(
+        f"json:   {os.path.getsize(path_collider_json)/1e6:.1f} MB, loaded in {duration_json:.2f} s"
+    )
+    print(
+        f"binary: {os.path.getsize(path_collider_binary)/1e6:.1f} MB, loaded in"
+        f" {duration_binary:.2f} s (written in {duration_write:.2f} s)"
+    )
+
+    # Check that both colliders are identical
+    for line_name in collider.lines:
+        collider[line_name].build_tracker()
+        collider_binary[line_name].build_tracker()
+        tw = collider[line_name].twiss(method="4d")
+        tw_binary = collider_binary[line_name].twiss(method="4d")
+        print(f"{line_name}: qx {tw.qx:.6f}/{tw_binary.qx:.6f}, qy {tw.qy:.6f}/{tw_binary.qy:.6f}")
+
+
+# ==================================================================================================
+# --- Script for execution
+# ==================================================================================================
+# Compare the size and loading time of the json and binary colliders, e.g. with:
+# python benchmark_collider_format.py scans/example_tunescan/base_collider/collider/collider.json
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the json and binary collider formats")
+    parser.add_argument("path_collider", help="Path to a collider saved as json")
+    parser.add_argument("--n-repeat", type=int, default=3, help="Number of loads to time")
+    args = parser.parse_args()
+    benchmark_collider_format(args.path_collider, args.n_repeat)
@@ -6,23 +6,30 @@ in this script are called sequentially."""
 # ==================================================================================================
 
 # Import standard library modules
-import itertools
+import fcntl
+import hashlib
 import json
 import logging
 import os
 import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 # Import third-party modules
 import numpy as np
+import pandas as pd
 
 # Import user-defined modules
 import optics_specific_tools as ost
-import pandas as pd
+import particle_distribution
 import tree_maker
 import xmask as xm
 import xmask.lhc as xlhc
 import xobjects as xo
+import xpart as xp
+import xtrack as xt
 import yaml
+from collider_binary import load_collider_binary, save_collider_binary
 from cpymad.madx import Madx
 
 
@@ -56,62 +63,121 @@ def load_configuration(config_path="config.yaml"):
 # --- Function to build particle distribution and write it to file
 # ==================================================================================================
 def build_particle_distribution(config_particles):
-    # Define radius distribution
-    r_min = config_particles["r_min"]
-    r_max = config_particles["r_max"]
-    n_r = config_particles["n_r"]
-    radial_list = np.linspace(r_min, r_max, n_r, endpoint=False)
-
-    # Filter out particles with low and high amplitude to accelerate simulation
-    # radial_list = radial_list[(radial_list >= 4.5) & (radial_list <= 7.5)]
-
-    # Define angle distribution
-    n_angles = config_particles["n_angles"]
-    theta_list = np.linspace(0, 90, n_angles + 2)[1:-1]
-
-    # Define particle distribution as a cartesian product of the above
-    particle_list = [
-        (particle_id, ii[1], ii[0])
-        for particle_id, ii in enumerate(itertools.product(theta_list, radial_list))
-    ]
+    # Build the distribution with the generator set in the configuration (polar grid by default)
+    particle_df = particle_distribution.generate_particle_distribution(config_particles)
 
     # Split distribution into several chunks for parallelization
-    n_split = config_particles["n_split"]
-    particle_list = list(np.array_split(particle_list, n_split))
+    particle_list = particle_distribution.split_particle_distribution(particle_df, config_particles)
 
     # Return distribution
     return particle_list
 
 
-def write_particle_distribution(particle_list):
-    # Write distribution to parquet files
+def write_particle_distribution(particle_list, config_particles):
+    # Write distribution to file(s), according to the storage mode
     distributions_folder = "particles"
     os.makedirs(distributions_folder, exist_ok=True)
-    for idx_chunk, my_list in enumerate(particle_list):
-        pd.DataFrame(
-            my_list,
-            columns=["particle_id", "normalized amplitude in xy-plane", "angle in xy-plane [deg]"],
-        ).to_parquet(f"{distributions_folder}/{idx_chunk:02}.parquet")
+    storage = config_particles.get("storage", "split_files")
+    if storage == "split_files":
+        # One parquet file per split
+        for idx_chunk, particle_df in enumerate(particle_list):
+            particle_df.to_parquet(f"{distributions_folder}/{idx_chunk:02}.parquet")
+    elif storage == "single_file":
+        # A single parquet file, with one row group per split, such that each job only reads its
+        # own row group
+        particle_df = pd.concat(
+            [df.assign(split=idx_chunk) for idx_chunk, df in enumerate(particle_list)],
+            ignore_index=True,
+        )
+        row_group_offsets = np.cumsum([0] + [len(df) for df in particle_list[:-1]]).tolist()
+        particle_df.to_parquet(
+            f"{distributions_folder}/particles.parquet",
+            engine="fastparquet",
+            row_group_offsets=row_group_offsets,
+        )
+    elif storage == "generator":
+        # Only the parameters of the generator are stored, each job regenerates its own chunk
+        with open(f"{distributions_folder}/distribution.yaml", "w") as fid:
+            yaml.dump(config_particles, fid)
+    else:
+        raise ValueError(f"Unknown particle storage {storage}")
 
 
 # ==================================================================================================
-# --- Function to build collider from mad model
+# --- Functions to build the MAD-X sequences, sequentially or in parallel
 # ==================================================================================================
-def build_collider_from_mad(config_mad, sanity_checks=True):
-    # Make mad environment
-    xm.make_mad_environment(links=config_mad["links"])
-
+def get_sequence_cache_key(mylhcbeam, **kwargs_build):
+    # Sliced sequences only depend on the beam, the build options, the sequence files and the
+    # build function itself (the links have been made by make_mad_environment at this point)
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps([mylhcbeam, kwargs_build], sort_keys=True).encode())
+    for path in L_SEQUENCE_FILES:
+        _update_hash_with_file(hasher, path)
+    _update_hash_with_file(hasher, ost.__file__)
+    return hasher.hexdigest()
+
+
+def build_sequence_cached(mad, mylhcbeam, path_sequence_cache=None, **kwargs_build):
+    # Build the sliced sequence, or load it from the cache if it has already been built
+    if path_sequence_cache is None:
+        ost.build_sequence(mad, mylhcbeam=mylhcbeam, **kwargs_build)
+        return
+
+    key = get_sequence_cache_key(mylhcbeam, **kwargs_build)
+    path_sequence = f"{path_sequence_cache}/sequence_b{mylhcbeam}_{key}.madx"
+    if os.path.isfile(path_sequence):
+        print(f"Sliced sequence for beam {mylhcbeam} loaded from {path_sequence}")
+        ost.load_sequence(mad, path_sequence, mylhcbeam)
+        return
+
+    ost.build_sequence(mad, mylhcbeam=mylhcbeam, **kwargs_build)
+
+    # Save through a temporary file, such that concurrent jobs never load a partial sequence
+    os.makedirs(path_sequence_cache, exist_ok=True)
+    path_temp = f"{path_sequence}.tmp{os.getpid()}"
+    ost.save_sequence(mad, path_temp, mylhcbeam)
+    os.replace(path_temp, path_sequence)
+
+
+def build_sequence_and_optics_cached(mad, mylhcbeam, optics_file, path_sequence_cache=None):
+    # Build the sliced sequence and apply the optics, or load the result from the cache. This stage
+    # doesn't depend on the machine imperfections, so it can be shared between seeds. A lock
+    # ensures that concurrent jobs (e.g. one per seed) build it only once.
+    if path_sequence_cache is None:
+        build_sequence_cached(mad, mylhcbeam=mylhcbeam)
+        ost.apply_optics(mad, optics_file=optics_file)
+        return
+
+    hasher = hashlib.sha256(get_sequence_cache_key(mylhcbeam).encode())
+    _update_hash_with_file(hasher, optics_file)
+    path_optics = f"{path_sequence_cache}/optics_b{mylhcbeam}_{hasher.hexdigest()}.madx"
+    os.makedirs(path_sequence_cache, exist_ok=True)
+    with open(f"{path_optics}.lock", "w") as fid_lock:
+        fcntl.flock(fid_lock, fcntl.LOCK_EX)
+        try:
+            if os.path.isfile(path_optics):
+                print(f"Sequence with optics for beam {mylhcbeam} loaded from {path_optics}")
+                ost.load_sequence(mad, path_optics, mylhcbeam)
+                return
+            build_sequence_cached(mad, mylhcbeam=mylhcbeam, path_sequence_cache=path_sequence_cache)
+            ost.apply_optics(mad, optics_file=optics_file)
+            path_temp = f"{path_optics}.tmp{os.getpid()}"
+            ost.save_sequence(mad, path_temp, mylhcbeam)
+            os.replace(path_temp, path_optics)
+        finally:
+            fcntl.flock(fid_lock, fcntl.LOCK_UN)
+
+
+def build_madx_sequences(config_mad, sanity_checks=True, path_sequence_cache=None):
     # Start mad
     mad_b1b2 = Madx(command_log="mad_collider.log")
 
     mad_b4 = Madx(command_log="mad_b4.log")
 
-    # Build sequences
-    ost.build_sequence(mad_b1b2, mylhcbeam=1)
-    ost.build_sequence(mad_b4, mylhcbeam=4)
-
-    # Apply optics (only for b1b2, b4 will be generated from b1b2)
-    ost.apply_optics(mad_b1b2, optics_file=config_mad["optics_file"])
+    # Build sequences and apply optics (b4 will be generated from b1b2, it's only built for check)
+    build_sequence_and_optics_cached(
+        mad_b1b2, 1, config_mad["optics_file"], path_sequence_cache=path_sequence_cache
+    )
 
     if sanity_checks:
         mad_b1b2.use(sequence="lhcb1")
@@ -121,13 +187,87 @@ def build_collider_from_mad(config_mad, sanity_checks=True):
         mad_b1b2.twiss()
         ost.check_madx_lattices(mad_b1b2)
 
-    # Apply optics (only for b4, just for check)
-    ost.apply_optics(mad_b4, optics_file=config_mad["optics_file"])
+    build_sequence_and_optics_cached(
+        mad_b4, 4, config_mad["optics_file"], path_sequence_cache=path_sequence_cache
+    )
     if sanity_checks:
         mad_b4.use(sequence="lhcb2")
         mad_b4.twiss()
         ost.check_madx_lattices(mad_b1b2)
 
+    return mad_b1b2, mad_b4
+
+
+def _build_and_save_madx_sequence(
+    mylhcbeam, optics_file, sanity_checks, path_sequence, path_sequence_cache=None
+):
+    # Build a sequence and apply the optics in a separate process, and save the result to file
+    mad = Madx(command_log="mad_collider.log" if mylhcbeam < 3 else "mad_b4.log")
+    build_sequence_and_optics_cached(
+        mad, mylhcbeam, optics_file, path_sequence_cache=path_sequence_cache
+    )
+
+    if sanity_checks:
+        for sequence in ["lhcb1", "lhcb2"] if mylhcbeam < 3 else ["lhcb2"]:
+            mad.use(sequence=sequence)
+            mad.twiss()
+            ost.check_madx_lattices(mad)
+
+    ost.save_sequence(mad, path_sequence, mylhcbeam)
+    return path_sequence
+
+
+def build_madx_sequences_parallel(config_mad, sanity_checks=True, path_sequence_cache=None):
+    # The b1/b2 and b4 MAD-X instances are independent until the collider is built, so they can be
+    # built in parallel processes (Madx instances can't be sent between processes, the sequences
+    # are therefore saved to file and reloaded)
+    os.makedirs("temp", exist_ok=True)
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        future_b1b2 = executor.submit(
+            _build_and_save_madx_sequence,
+            1,
+            config_mad["optics_file"],
+            sanity_checks,
+            "temp/sequence_b1b2.madx",
+            path_sequence_cache,
+        )
+        future_b4 = executor.submit(
+            _build_and_save_madx_sequence,
+            4,
+            config_mad["optics_file"],
+            sanity_checks,
+            "temp/sequence_b4.madx",
+            path_sequence_cache,
+        )
+        path_sequence_b1b2 = future_b1b2.result()
+        path_sequence_b4 = future_b4.result()
+
+    # Reload the sequences
+    mad_b1b2 = Madx(command_log="mad_collider_load.log")
+    ost.load_sequence(mad_b1b2, path_sequence_b1b2, mylhcbeam=1)
+    mad_b4 = Madx(command_log="mad_b4_load.log")
+    ost.load_sequence(mad_b4, path_sequence_b4, mylhcbeam=4)
+
+    return mad_b1b2, mad_b4
+
+
+# ==================================================================================================
+# --- Function to build collider from mad model
+# ==================================================================================================
+def build_collider_from_mad(
+    config_mad, sanity_checks=True, parallel_build=False, path_sequence_cache=None
+):
+    # Make mad environment
+    xm.make_mad_environment(links=config_mad["links"])
+
+    # Build sequences and apply optics
+    if parallel_build:
+        mad_b1b2, mad_b4 = build_madx_sequences_parallel(
+            config_mad, sanity_checks, path_sequence_cache
+        )
+    else:
+        mad_b1b2, mad_b4 = build_madx_sequences(config_mad, sanity_checks, path_sequence_cache)
+
     # Build xsuite collider
     collider = xlhc.build_xsuite_collider(
         sequence_b1=mad_b1b2.sequence.lhcb1,
@@ -179,15 +319,187 @@ def activate_RF_and_twiss(collider, config_mad, sanity_checks=True):
     return collider
 
 
+def install_beam_beam_lenses(collider, config_lenses):
+    # Install the beam-beam lenses (inactive and not configured), and store their parameters in the
+    # metadata such that the second generation can check them
+    collider.discard_trackers()
+    collider.install_beambeam_interactions(
+        clockwise_line="lhcb1",
+        anticlockwise_line="lhcb2",
+        ip_names=["ip1", "ip2", "ip5", "ip8"],
+        delay_at_ips_slots=[0, 891, 0, 2670],
+        num_long_range_encounters_per_side=config_lenses["num_long_range_encounters_per_side"],
+        num_slices_head_on=config_lenses["num_slices_head_on"],
+        harmonic_number=35640,
+        bunch_spacing_buckets=config_lenses["bunch_spacing_buckets"],
+        sigmaz=config_lenses["sigma_z"],
+    )
+    collider.metadata["beam_beam_lenses"] = json.loads(json.dumps(config_lenses))
+    return collider
+
+
+def _check_line_from_file(path_collider, line_name):
+    # Load the collider in a separate process and run the xsuite checks on a single line
+    if path_collider.endswith(".npz"):
+        collider = load_collider_binary(path_collider)
+    else:
+        collider = xt.Multiline.from_json(path_collider)
+    collider.build_trackers()
+    try:
+        return line_name, {"passed": True, **ost.get_xsuite_lattice_report(collider[line_name])}
+    except Exception as e:
+        return line_name, {"passed": False, "error": str(e)}
+
+
+def run_deferred_sanity_checks(
+    path_collider="collider/collider.json", path_report="sanity_checks.json"
+):
+    # Run the checks of both beams in parallel, once the collider is on disk
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        l_futures = [
+            executor.submit(_check_line_from_file, path_collider, line_name)
+            for line_name in ["lhcb1", "lhcb2"]
+        ]
+        dic_report = dict(future.result() for future in l_futures)
+    dic_report["passed"] = all(dic_report[line_name]["passed"] for line_name in ["lhcb1", "lhcb2"])
+    dic_report["duration"] = time.time() - start
+
+    # Write report
+    with open(f"{path_report}.tmp", "w") as fid:
+        json.dump(dic_report, fid, indent=4)
+    os.replace(f"{path_report}.tmp", path_report)
+    if not dic_report["passed"]:
+        print(f"WARNING: Some deferred sanity checks have failed, see {path_report}")
+    return dic_report
+
+
 def clean():
     # Remove all the temporaty files created in the process of building collider
-    os.remove("mad_collider.log")
-    os.remove("mad_b4.log")
+    for log_file in ["mad_collider.log", "mad_b4.log", "mad_collider_load.log", "mad_b4_load.log"]:
+        if os.path.exists(log_file):
+            os.remove(log_file)
     shutil.rmtree("temp")
     os.unlink("errors")
     os.unlink("acc-models-lhc")
 
 
+# ==================================================================================================
+# --- Function to save the collider
+# ==================================================================================================
+def save_collider(collider, collider_format="json"):
+    # Save collider to the collider folder, in the requested format
+    os.makedirs("collider", exist_ok=True)
+    if collider_format == "json":
+        path_collider = "collider/collider.json"
+        collider.to_json(path_collider)
+    elif collider_format == "binary":
+        path_collider = "collider/collider.npz"
+        save_collider_binary(collider, path_collider)
+    else:
+        raise ValueError(f"Unknown collider format {collider_format}")
+    return path_collider
+
+
+# ==================================================================================================
+# --- Functions to cache the base collider across studies
+# ==================================================================================================
+# Files (on top of the optics file) used to build the sequences
+L_SEQUENCE_FILES = [
+    "acc-models-lhc/lhc.seq",
+    "acc-models-lhc/lhcb4.seq",
+    "acc-models-lhc/hllhc_sequence.madx",
+    "acc-models-lhc/toolkit/macro.madx",
+    "acc-models-lhc/toolkit/enable_crabcavities.madx",
+]
+
+
+def _resolve_linked_path(path, links):
+    # Resolve a path relative to one of the links made for MAD-X (e.g. acc-models-lhc/...)
+    for link_name, link_target in links.items():
+        if path == link_name or path.startswith(link_name + "/"):
+            return link_target + path[len(link_name) :]
+    return path
+
+
+def _update_hash_with_file(hasher, path):
+    # Hash the content of a file (or the fact that it's missing)
+    if not os.path.isfile(path):
+        hasher.update(f"missing:{path}".encode())
+        return
+    with open(path, "rb") as fid:
+        for chunk in iter(lambda: fid.read(2**20), b""):
+            hasher.update(chunk)
+
+
+def get_collider_cache_key(config_mad):
+    # The links are ignored as they depend on the location of the node, only the content of the
+    # files they point to matter
+    hasher = hashlib.sha256()
+    config_mad_no_links = {key: value for key, value in config_mad.items() if key != "links"}
+    hasher.update(json.dumps(config_mad_no_links, sort_keys=True, default=str).encode())
+    # The collider built (and its serialization) depends on the versions of the xsuite packages
+    for module in [xm, xt, xo, xp]:
+        hasher.update(f"{module.__name__}={getattr(module, '__version__', '')}".encode())
+    for path in [config_mad["optics_file"]] + L_SEQUENCE_FILES:
+        _update_hash_with_file(hasher, _resolve_linked_path(path, config_mad["links"]))
+    _update_hash_with_file(hasher, ost.__file__)
+    return hasher.hexdigest()
+
+
+def get_collider_from_cache(path_cache, key, path_collider):
+    # Hard link (or copy if not possible) the cached collider, if any
+    path_cached_collider = f"{path_cache}/{key}/{os.path.basename(path_collider)}"
+    if not os.path.isfile(path_cached_collider):
+        return False
+    os.makedirs(os.path.dirname(path_collider), exist_ok=True)
+    if os.path.exists(path_collider):
+        os.remove(path_collider)
+    try:
+        os.link(path_cached_collider, path_collider)
+    except OSError:
+        shutil.copy(path_cached_collider, path_collider)
+
+    # Update access time for LRU eviction
+    os.utime(f"{path_cache}/{key}")
+    return True
+
+
+def add_collider_to_cache(path_cache, key, path_collider, max_size_gb=None):
+    # Copy through a temporary file, such that concurrent jobs never read a partial collider
+    os.makedirs(f"{path_cache}/{key}", exist_ok=True)
+    path_cached_collider = f"{path_cache}/{key}/{os.path.basename(path_collider)}"
+    path_temp = f"{path_cached_collider}.tmp{os.getpid()}"
+    shutil.copy(path_collider, path_temp)
+    os.replace(path_temp, path_cached_collider)
+    os.utime(f"{path_cache}/{key}")
+
+    # Evict least recently used colliders if the cache is too large
+    if max_size_gb is not None:
+        evict_collider_cache(path_cache, max_size_gb)
+
+
+def evict_collider_cache(path_cache, max_size_gb):
+    l_entries = []
+    for key in os.listdir(path_cache):
+        path_entry = f"{path_cache}/{key}"
+        if not os.path.isdir(path_entry):
+            continue
+        size = sum(
+            os.path.getsize(f"{path_entry}/{filename}") for filename in os.listdir(path_entry)
+        )
+        l_entries.append((os.path.getmtime(path_entry), size, path_entry))
+
+    # Remove oldest entries first
+    total_size = sum(size for _, size, _ in l_entries)
+    for _, size, path_entry in sorted(l_entries):
+        if total_size <= max_size_gb * 1e9:
+            break
+        print(f"Evicting {path_entry} from the collider cache")
+        shutil.rmtree(path_entry, ignore_errors=True)
+        total_size -= size
+
+
 # ==================================================================================================
 # --- Main function for building distribution and collider
 # ==================================================================================================
@@ -195,8 +507,19 @@ def build_distr_and_collider(config_file="config.yaml"):
     # Get configuration
     configuration, config_particles, config_mad = load_configuration(config_file)
 
-    # Get sanity checks flag
-    sanity_checks = configuration["sanity_checks"]
+    # Get sanity checks flag. In deferred mode, the checks are run once the collider is saved and
+    # the job is tagged as completed, such that the next generation can already be submitted.
+    deferred_sanity_checks = configuration["sanity_checks"] == "deferred"
+    sanity_checks = configuration["sanity_checks"] is True
+
+    # Get parallel build flag (build the MAD-X sequences of b1/b2 and b4 in parallel processes)
+    parallel_build = configuration.get("parallel_build", False)
+
+    # Get the format of the collider file ("json" or "binary")
+    collider_format = configuration.get("collider_format", "json")
+    path_collider = (
+        "collider/collider.json" if collider_format == "json" else "collider/collider.npz"
+    )
 
     # Tag start of the job
     tree_maker_tagging(configuration, tag="started")
@@ -205,24 +528,54 @@ def build_distr_and_collider(config_file="config.yaml"):
     particle_list = build_particle_distribution(config_particles)
 
     # Write particle distribution to file
-    write_particle_distribution(particle_list)
+    write_particle_distribution(particle_list, config_particles)
+
+    # Get the collider from the cache if it has already been built with the same configuration
+    config_cache = configuration.get("collider_cache")
+    if config_cache is not None and config_cache["path"] is not None:
+        cache_key = get_collider_cache_key(config_mad)
+        if get_collider_from_cache(config_cache["path"], cache_key, path_collider):
+            print(f"Base collider loaded from cache (key {cache_key})")
+            tree_maker_tagging(configuration, tag="completed")
+            return
 
     # Build collider from mad model
-    collider = build_collider_from_mad(config_mad, sanity_checks)
+    collider = build_collider_from_mad(
+        config_mad,
+        sanity_checks,
+        parallel_build,
+        path_sequence_cache=configuration.get("sequence_cache", {}).get("path"),
+    )
 
     # Twiss to ensure eveyrthing is ok
     collider = activate_RF_and_twiss(collider, config_mad, sanity_checks)
 
+    # Install the beam-beam lenses if requested
+    if config_mad.get("beam_beam_lenses") is not None:
+        collider = install_beam_beam_lenses(collider, config_mad["beam_beam_lenses"])
+
     # Clean temporary files
     clean()
 
-    # Save collider to json
-    os.makedirs("collider", exist_ok=True)
-    collider.to_json("collider/collider.json")
+    # Save collider to file
+    path_collider = save_collider(collider, collider_format)
+
+    # Store the collider in the cache
+    if config_cache is not None and config_cache["path"] is not None:
+        add_collider_to_cache(
+            config_cache["path"],
+            cache_key,
+            path_collider,
+            max_size_gb=config_cache.get("max_size_gb"),
+        )
 
     # Tag end of the job
     tree_maker_tagging(configuration, tag="completed")
 
+    # Run the checks now that the collider is on disk
+    if deferred_sanity_checks:
+        run_deferred_sanity_checks(path_collider)
+
 
 # ==================================================================================================
 # --- Script for execution
@@ -0,0 +1,119 @@
+"""This module contains the functions to save and load the collider in a binary format: a json
+skeleton (vars, expressions, metadata, etc.) and array-backed element tables, stored in a single
+compressed npz file. It is used by the first generation to write the base collider, and by the
+second generation (misc.load_collider) to read it."""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+import json
+
+import numpy as np
+import xobjects as xo
+import xtrack as xt
+
+
+# ==================================================================================================
+# --- Functions to save and load the collider in a binary format
+# ==================================================================================================
+def _get_numeric_array(value):
+    # Return the value as a numeric numpy array if possible, None otherwise
+    if isinstance(value, (dict, str)) or value is None:
+        return None
+    try:
+        array = np.asarray(value)
+    except ValueError:
+        return None
+    return array if array.dtype.kind in "biuf" else None
+
+
+def _get_element_owners(dic_collider):
+    # Dictionnaries holding the elements of the collider, along with the prefix of their tables.
+    # Depending on the xtrack version, the elements are shared by the lines (environment) or stored
+    # per line.
+    l_owners = []
+    if isinstance(dic_collider.get("elements"), dict):
+        l_owners.append(("elements", dic_collider))
+    for line_name, dic_line in dic_collider.get("lines", {}).items():
+        if isinstance(dic_line.get("elements"), dict):
+            l_owners.append((f"lines.{line_name}", dic_line))
+    return l_owners
+
+
+def _group_elements(dic_elements):
+    # Group the elements by class and by type and shape of the numerical fields
+    dic_groups = {}
+    for element_name, dic_element in dic_elements.items():
+        dic_numeric = {}
+        dic_other = {}
+        for key, value in dic_element.items():
+            array = _get_numeric_array(value)
+            if array is None:
+                dic_other[key] = value
+            else:
+                dic_numeric[key] = array
+
+        signature = (
+            dic_element.get("__class__"),
+            tuple((key, array.dtype.str, array.shape) for key, array in dic_numeric.items()),
+        )
+        group = dic_groups.setdefault(
+            signature, {"names": [], "others": [], "columns": {key: [] for key in dic_numeric}}
+        )
+        group["names"].append(element_name)
+        group["others"].append(dic_other)
+        for key, array in dic_numeric.items():
+            group["columns"][key].append(array)
+    return list(dic_groups.values())
+
+
+def save_collider_binary(collider, path_collider):
+    # The collider dictionnary is split into a json skeleton (vars, expressions, metadata, etc.)
+    # and array-backed element tables, with one table per group of elements sharing the same class
+    # and numerical fields. Everything is stored in a single compressed npz file. If the layout of
+    # the dictionnary is not the expected one (no elements found), the skeleton holds everything.
+    dic_collider = collider.to_dict()
+    dic_arrays = {}
+    l_owners = _get_element_owners(dic_collider)
+    if len(l_owners) == 0:
+        print("Elements not found in the collider dictionnary, saving it as a json skeleton only.")
+    for prefix, dic_owner in l_owners:
+        # Keep only the names and the non-numerical fields in the skeleton
+        dic_owner["element_groups"] = []
+        for idx_group, group in enumerate(_group_elements(dic_owner.pop("elements"))):
+            dic_owner["element_groups"].append(
+                {"names": group["names"], "others": group["others"], "keys": list(group["columns"])}
+            )
+            for key, l_arrays in group["columns"].items():
+                dic_arrays[f"{prefix}__{idx_group}__{key}"] = np.stack(l_arrays)
+
+    skeleton = json.dumps(dic_collider, cls=xo.JEncoder).encode()
+    np.savez_compressed(
+        path_collider, skeleton=np.frombuffer(skeleton, dtype=np.uint8), **dic_arrays
+    )
+
+
+def load_collider_binary(path_collider):
+    # Rebuild the collider dictionnary from the skeleton and the element tables. Each table is
+    # decompressed once, and the elements are rebuilt from its columns without any json parsing.
+    with np.load(path_collider) as data:
+        dic_collider = json.loads(data["skeleton"].tobytes())
+        l_owners = [("elements", dic_collider)] + [
+            (f"lines.{line_name}", dic_line)
+            for line_name, dic_line in dic_collider.get("lines", {}).items()
+        ]
+        for prefix, dic_owner in l_owners:
+            if "element_groups" not in dic_owner:
+                continue
+            dic_elements = {}
+            for idx_group, group in enumerate(dic_owner.pop("element_groups")):
+                dic_columns = {key: data[f"{prefix}__{idx_group}__{key}"] for key in group["keys"]}
+                for idx, (element_name, dic_other) in enumerate(
+                    zip(group["names"], group["others"])
+                ):
+                    dic_element = dict(dic_other)
+                    for key, column in dic_columns.items():
+                        dic_element[key] = column[idx].item() if column.ndim == 1 else column[idx]
+                    dic_elements[element_name] = dic_element
+            dic_owner["elements"] = dic_elements
+    return xt.Multiline.from_dict(dic_collider)
@@ -35,6 +35,29 @@ def check_xsuite_lattices(my_line):
     print(tw.qx, tw.qy)
 
 
+def get_xsuite_lattice_report(my_line):
+    # Same checks as check_xsuite_lattices, returned as a dictionnary (4D and 6D twiss)
+    dic_report = {}
+    for method in ["4d", "6d"]:
+        tw = my_line.twiss(method=method, matrix_stability_tol=100)
+        dic_report[method] = {
+            "qx": float(tw.qx),
+            "qy": float(tw.qy),
+            "dqx": float(tw.dqx),
+            "dqy": float(tw.dqy),
+            "ips": {
+                ip: {
+                    "betx": float(tw["betx", ip]),
+                    "bety": float(tw["bety", ip]),
+                    "x": float(tw["x", ip]),
+                    "y": float(tw["y", ip]),
+                }
+                for ip in ["ip1", "ip2", "ip5", "ip8"]
+            },
+        }
+    return dic_report
+
+
 def build_sequence(
     mad,
     mylhcbeam,
@@ -129,3 +152,25 @@ def apply_optics(mad, optics_file):
     # A knob redefinition
     mad.input("on_alice := on_alice_normalized * 7000./nrj;")
     mad.input("on_lhcb := on_lhcb_normalized * 7000./nrj;")
+
+
+def save_sequence(mad, path_sequence, mylhcbeam):
+    # Save the sequence(s), along with the beams and the variables (including deferred expressions)
+    sequences = "lhcb1,lhcb2" if mylhcbeam < 3 else "lhcb2"
+    mad.input(f'save, sequence={sequences}, file="{path_sequence}", beam;')
+
+
+def load_sequence(mad, path_sequence, mylhcbeam):
+    # Load a sequence saved with save_sequence, along with the toolkit macros (which are not saved)
+    mad.input(f"mylhcbeam = {mylhcbeam}")
+    mad.input("""
+      option, -echo,-warn,-info;
+      call,file=
+        "acc-models-lhc/toolkit/macro.madx";
+      option, -echo, warn,-info;
+      """)
+    mad.call(path_sequence)
+    mad.input("""
+        ! Set twiss formats for MAD-X parts (macro from opt. toolkit)
+        exec, twiss_opt;
+        """)
@@ -0,0 +1,188 @@
+"""This module contains the generators for the initial particle distribution. Each generator takes
+the config_particles dictionnary and returns typed arrays of amplitudes (in sigma) and angles (in
+degrees in the xy-plane), such that distributions with thousands of particles are built without
+any python loop."""
+
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+import heapq
+
+import numpy as np
+import pandas as pd
+from scipy.stats import qmc
+
+# Names of the columns of the particle distribution files
+COLUMNS = ["particle_id", "normalized amplitude in xy-plane", "angle in xy-plane [deg]"]
+
+# Default tracking throughput (in particle-turns per second) of the LHC lattice with beam-beam for
+# each context (a single core for cpu), and overhead of a job (in seconds) configuring the collider
+# or only loading it (two-stage studies), used to set the number of splits automatically. The
+# throughput of a study can be set from the "Elapsed time per particle per turn" printed by the
+# tracking jobs of a previous one (throughput = 1e6 / time in us).
+dic_throughput = {"cpu": 5e4, "cupy": 1e6, "opencl": 5e5}
+JOB_OVERHEAD = 600.0
+TRACK_JOB_OVERHEAD = 60.0
+
+
+# ==================================================================================================
+# --- Generators of amplitudes and angles
+# ==================================================================================================
+def get_angles(config_particles):
+    # Angles strictly between 0 and 90 degrees
+    n_angles = config_particles["n_angles"]
+    return np.linspace(0, 90, n_angles + 2)[1:-1]
+
+
+def polar_grid(config_particles):
+    # Uniform polar grid, ordered by angle first (same order as the former cartesian product)
+    radial_list = np.linspace(
+        config_particles["r_min"],
+        config_particles["r_max"],
+        config_particles["n_r"],
+        endpoint=False,
+    )
+    theta, r = np.meshgrid(get_angles(config_particles), radial_list, indexing="ij")
+    return r.ravel(), theta.ravel()
+
+
+def quasi_random(config_particles):
+    # Low-discrepancy sequence (sobol or halton) in the amplitude-angle plane
+    n_particles = config_particles.get(
+        "n_particles", config_particles["n_r"] * config_particles["n_angles"]
+    )
+    sequence = config_particles.get("sequence", "sobol")
+    seed = config_particles.get("seed", 0)
+    if sequence == "sobol":
+        sampler = qmc.Sobol(d=2, scramble=True, seed=seed)
+    elif sequence == "halton":
+        sampler = qmc.Halton(d=2, scramble=True, seed=seed)
+    else:
+        raise ValueError(f"Unknown quasi-random sequence {sequence}")
+    sample = qmc.scale(
+        sampler.random(n_particles),
+        [config_particles["r_min"], 0.0],
+        [config_particles["r_max"], 90.0],
+    )
+    return sample[:, 0], sample[:, 1]
+
+
+def non_uniform_radial(config_particles):
+    # Radial spacing denser around the expected DA: the amplitudes are the quantiles of a density
+    # made of a uniform background and a gaussian bump around da_estimate
+    r_min = config_particles["r_min"]
+    r_max = config_particles["r_max"]
+    da_estimate = config_particles.get("da_estimate", 6.0)
+    da_width = config_particles.get("da_width", 1.0)
+    band_weight = config_particles.get("band_weight", 0.5)
+
+    # Invert the cumulative distribution function on a fine grid
+    r_fine = np.linspace(r_min, r_max, 10001)
+    density = (1 - band_weight) / (r_max - r_min) + band_weight * np.exp(
+        -0.5 * ((r_fine - da_estimate) / da_width) ** 2
+    ) / (da_width * np.sqrt(2 * np.pi))
+    cdf = np.concatenate([[0.0], np.cumsum((density[1:] + density[:-1]) / 2 * np.diff(r_fine))])
+    cdf /= cdf[-1]
+    radial_list = np.interp(
+        np.arange(config_particles["n_r"]) / config_particles["n_r"], cdf, r_fine
+    )
+
+    theta, r = np.meshgrid(get_angles(config_particles), radial_list, indexing="ij")
+    return r.ravel(), theta.ravel()
+
+
+# Available generators, selected with the "distribution" parameter of config_particles
+dic_generators = {
+    "polar_grid": polar_grid,
+    "quasi_random": quasi_random,
+    "non_uniform_radial": non_uniform_radial,
+}
+
+
+# ==================================================================================================
+# --- Functions to build and split the distribution
+# ==================================================================================================
+def generate_particle_distribution(config_particles):
+    # Build the full distribution as a dataframe with typed columns
+    distribution = config_particles.get("distribution", "polar_grid")
+    if distribution not in dic_generators:
+        raise ValueError(f"Unknown particle distribution {distribution}")
+    r, theta = dic_generators[distribution](config_particles)
+    return pd.DataFrame(
+        {
+            COLUMNS[0]: np.arange(len(r), dtype=np.int64),
+            COLUMNS[1]: r.astype(np.float64),
+            COLUMNS[2]: theta.astype(np.float64),
+        }
+    )
+
+
+# ==================================================================================================
+# --- Functions to estimate the cost of the particles and split the distribution
+# ==================================================================================================
+def estimate_particles_cost(r_vect, n_turns, da_estimate=6.0, da_width=0.5, min_survival=0.01):
+    # Particles below the expected DA survive all turns, while the ones above are lost within a few
+    # turns. A smooth step is used as the DA is only known approximately. This model is also used
+    # by 002_chronjob.py to submit the longest jobs first.
+    survival = 1 / (1 + np.exp((np.asarray(r_vect, dtype=float) - da_estimate) / da_width))
+    return n_turns * np.maximum(survival, min_survival)
+
+
+def get_particles_cost(particle_df, config_particles):
+    config_cost_model = config_particles.get("cost_model", {})
+    return estimate_particles_cost(
+        particle_df[COLUMNS[1]].values,
+        config_particles["n_turns"],
+        da_estimate=config_cost_model.get("da_estimate", 6.0),
+        da_width=config_cost_model.get("da_width", 0.5),
+    )
+
+
+def get_n_split(
+    particle_df,
+    config_particles,
+    context="cpu",
+    target_job_duration=3600.0,
+    job_overhead=JOB_OVERHEAD,
+):
+    # Number of splits such that each job tracks for about target_job_duration (excluding the
+    # overhead of the job, e.g. the configuration of the collider)
+    throughput = config_particles.get("throughput", dic_throughput[context])
+    tracking_duration = max(target_job_duration - job_overhead, 0.1 * target_job_duration)
+    total_cost = np.sum(get_particles_cost(particle_df, config_particles))
+    return int(
+        min(max(np.ceil(total_cost / (throughput * tracking_duration)), 1), len(particle_df))
+    )
+
+
+def _split_by_cost(cost, n_split):
+    # Longest processing time first: the most expensive particles are assigned one by one to the
+    # chunk with the lowest total cost
+    heap = [(0.0, idx_split) for idx_split in range(n_split)]
+    l_idx_chunks = [[] for _ in range(n_split)]
+    for idx_particle in np.argsort(-cost, kind="stable"):
+        cost_chunk, idx_split = heapq.heappop(heap)
+        l_idx_chunks[idx_split].append(idx_particle)
+        heapq.heappush(heap, (cost_chunk + cost[idx_particle], idx_split))
+    return [np.sort(idx_chunk) for idx_chunk in l_idx_chunks]
+
+
+def split_particle_distribution(particle_df, config_particles):
+    # Split the distribution into chunks for parallelization, either with the same number of
+    # particles ("count") or the same estimated cost ("cost")
+    n_split = config_particles["n_split"]
+    split_method = config_particles.get("split_method", "count")
+    if split_method == "count":
+        l_idx_chunks = np.array_split(np.arange(len(particle_df)), n_split)
+    elif split_method == "cost":
+        l_idx_chunks = _split_by_cost(get_particles_cost(particle_df, config_particles), n_split)
+    else:
+        raise ValueError(f"Unknown split method {split_method}")
+    return [particle_df.iloc[idx].reset_index(drop=True) for idx in l_idx_chunks]
+
+
+def generate_particle_chunk(config_particles, idx_split):
+    # Regenerate a single chunk of the distribution. Generators and splitters are deterministic
+    # (quasi-random sequences are seeded), so this is identical to the chunk of generation 1.
+    particle_df = generate_particle_distribution(config_particles)
+    return split_particle_distribution(particle_df, config_particles)[idx_split]
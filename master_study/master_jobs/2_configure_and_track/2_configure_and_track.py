@@ -7,6 +7,7 @@ simple scripting for reproducibility, to allow rebuilding the collider from a di
 # --- Imports
 # ==================================================================================================
 # Import standard library modules
+import importlib.util
 import json
 import logging
 import os
@@ -23,10 +24,32 @@ import xmask as xm
 import xobjects as xo
 import xtrack as xt
 from misc import (
+    L_STAGES,
+    apply_vars_snapshot,
+    check_response_observables,
     compute_PU,
+    compute_knob_response_matrices_once,
     generate_orbit_correction_setup,
+    get_knob_cache_signature,
+    get_n_stages_cached,
+    get_response_observables,
+    get_stage_keys,
+    get_vars_diff,
+    get_vars_snapshot,
+    get_working_point,
+    load_collider,
+    load_knob_response_matrix,
+    load_knob_solution,
+    load_stage_output,
+    merge_vars_diffs,
     luminosity_leveling,
     luminosity_leveling_ip1_5,
+    predict_knob_changes,
+    run_per_beam_in_fork,
+    save_knob_solution,
+    save_stage_output,
+    twiss_cache,
+    update_nested,
 )
 
 # Initialize yaml reader
@@ -44,6 +67,18 @@ def tree_maker_tagging(config, tag="started"):
         logging.warning("tree_maker loging not available")
 
 
+def has_been_tagged(config, tag):
+    # Check if this job (or another copy of it) has already been tagged
+    if tree_maker is not None and "log_file" in config and os.path.isfile(config["log_file"]):
+        return tag in tree_maker.tag_json.read_json(config["log_file"])
+    return False
+
+
+def has_been_completed(config):
+    # Check if another copy of this job (e.g. resubmitted straggler) has already been completed
+    return has_been_tagged(config, "completed")
+
+
 # ==================================================================================================
 # --- Function to get context
 # ==================================================================================================
@@ -61,18 +96,24 @@ def get_context(configuration):
 
 
 # ==================================================================================================
-# --- Functions to read configuration files and generate configuration files for orbit correction
+# --- Function to read configuration files
 # ==================================================================================================
 def read_configuration(config_path="config.yaml"):
     # Read configuration for simulations
     with open(config_path, "r") as fid:
         config = ryaml.load(fid)
 
-    # Also read configuration from previous generation
-    try:
-        with open("../" + config_path, "r") as fid:
-            config_gen_1 = ryaml.load(fid)
-    except:
+    # Also read configuration from previous generation (walking up the tree, as the configuration
+    # of the base collider is two levels above for the tracking stage of a two-stage study)
+    for prefix in ["../", "../../"]:
+        try:
+            with open(prefix + config_path, "r") as fid:
+                config_gen_1 = ryaml.load(fid)
+        except:
+            continue
+        if "config_mad" in config_gen_1:
+            break
+    else:
         with open("../1_build_distr_and_collider/" + config_path, "r") as fid:
             config_gen_1 = ryaml.load(fid)
 
@@ -80,15 +121,6 @@ def read_configuration(config_path="config.yaml"):
     return config, config_mad
 
 
-def generate_configuration_correction_files(output_folder="correction"):
-    # Generate configuration files for orbit correction
-    correction_setup = generate_orbit_correction_setup()
-    os.makedirs(output_folder, exist_ok=True)
-    for nn in ["lhcb1", "lhcb2"]:
-        with open(f"{output_folder}/corr_co_{nn}.json", "w") as fid:
-            json.dump(correction_setup[nn], fid, indent=4)
-
-
 # ==================================================================================================
 # --- Function to install beam-beam
 # ==================================================================================================
@@ -96,6 +128,31 @@ def install_beam_beam(collider, config_collider):
     # Load config
     config_bb = config_collider["config_beambeam"]
 
+    # The lenses may already have been installed in the base collider, in which case they must have
+    # been installed with the same parameters
+    if "beam_beam_lenses" in (collider.metadata or {}):
+        config_lenses = json.loads(
+            json.dumps(
+                {
+                    key: config_bb[key]
+                    for key in [
+                        "num_long_range_encounters_per_side",
+                        "num_slices_head_on",
+                        "bunch_spacing_buckets",
+                        "sigma_z",
+                    ]
+                }
+            )
+        )
+        if config_lenses != collider.metadata["beam_beam_lenses"]:
+            raise ValueError(
+                "The beam-beam lenses of the base collider were installed with"
+                f" {collider.metadata['beam_beam_lenses']}, which differs from the beam-beam"
+                f" configuration {config_lenses}"
+            )
+        print("Beam-beam lenses already installed in the base collider")
+        return collider, config_bb
+
     # Install beam-beam lenses (inactive and not configured)
     collider.install_beambeam_interactions(
         clockwise_line="lhcb1",
@@ -127,29 +184,132 @@ def set_knobs(config_collider, collider):
     return collider, conf_knobs_and_tuning
 
 
-def match_tune_and_chroma(collider, conf_knobs_and_tuning, match_linear_coupling_to_zero=True):
+def retarget_with_response_matrix(
+    collider,
+    line_name,
+    conf_knobs_and_tuning,
+    targets,
+    match_linear_coupling_to_zero,
+    path_response_matrix,
+    response_signature,
+    correction_setup,
+):
+    # Set the tune and chromaticity knobs from the response matrix, and only correct the closed
+    # orbit. Return False if the result is not within tolerance, in which case a full matching is
+    # needed.
+    knob_names = conf_knobs_and_tuning["knob_names"][line_name]
+    response_matrix = load_knob_response_matrix(line_name, path_response_matrix, response_signature)
+    observables = get_response_observables(collider[line_name])
+    for knob, knob_change in predict_knob_changes(response_matrix, observables, targets).items():
+        collider.vars[knob_names[knob]] = collider.vars[knob_names[knob]]._value + knob_change
+
+    xm.machine_tuning(
+        line=collider[line_name],
+        enable_closed_orbit_correction=True,
+        enable_linear_coupling_correction=False,
+        enable_tune_correction=False,
+        enable_chromaticity_correction=False,
+        knob_names=knob_names,
+        targets=targets,
+        line_co_ref=collider[line_name + "_co_ref"],
+        co_corr_config=correction_setup[line_name],
+    )
+
+    within_tolerance = check_response_observables(
+        get_response_observables(collider[line_name]),
+        targets,
+        check_coupling=match_linear_coupling_to_zero,
+    )
+    if not within_tolerance:
+        print(f"Prediction from the response matrix out of tolerance for {line_name}")
+    return within_tolerance
+
+
+def tune_line(
+    collider,
+    line_name,
+    conf_knobs_and_tuning,
+    match_linear_coupling_to_zero,
+    path_response_matrix,
+    response_signature,
+    correction_setup,
+):
+    knob_names = conf_knobs_and_tuning["knob_names"][line_name]
+
+    targets = {
+        "qx": conf_knobs_and_tuning["qx"][line_name],
+        "qy": conf_knobs_and_tuning["qy"][line_name],
+        "dqx": conf_knobs_and_tuning["dqx"][line_name],
+        "dqy": conf_knobs_and_tuning["dqy"][line_name],
+    }
+
+    # Try to reach the targets with the response matrix first, if requested
+    if path_response_matrix is not None and retarget_with_response_matrix(
+        collider,
+        line_name,
+        conf_knobs_and_tuning,
+        targets,
+        match_linear_coupling_to_zero,
+        path_response_matrix,
+        response_signature,
+        correction_setup,
+    ):
+        return
+
+    xm.machine_tuning(
+        line=collider[line_name],
+        enable_closed_orbit_correction=True,
+        enable_linear_coupling_correction=match_linear_coupling_to_zero,
+        enable_tune_correction=True,
+        enable_chromaticity_correction=True,
+        knob_names=knob_names,
+        targets=targets,
+        line_co_ref=collider[line_name + "_co_ref"],
+        co_corr_config=correction_setup[line_name],
+    )
+
+
+def tune_line_and_get_vars_diff(collider, line_name, *args):
+    # Used in the worker processes: only the variables changed by the tuning are sent back
+    vars_before = get_vars_snapshot(collider)
+    tune_line(collider, line_name, *args)
+    return get_vars_diff(vars_before, get_vars_snapshot(collider))
+
+
+def match_tune_and_chroma(
+    collider,
+    conf_knobs_and_tuning,
+    match_linear_coupling_to_zero=True,
+    path_response_matrix=None,
+    response_signature=None,
+    parallel_beams=False,
+    correction_setup=None,
+):
+    # The orbit correction setup is built in memory, unless provided
+    if correction_setup is None:
+        correction_setup = generate_orbit_correction_setup()
+
     # Tunings
-    for line_name in ["lhcb1", "lhcb2"]:
-        knob_names = conf_knobs_and_tuning["knob_names"][line_name]
-
-        targets = {
-            "qx": conf_knobs_and_tuning["qx"][line_name],
-            "qy": conf_knobs_and_tuning["qy"][line_name],
-            "dqx": conf_knobs_and_tuning["dqx"][line_name],
-            "dqy": conf_knobs_and_tuning["dqy"][line_name],
-        }
-
-        xm.machine_tuning(
-            line=collider[line_name],
-            enable_closed_orbit_correction=True,
-            enable_linear_coupling_correction=match_linear_coupling_to_zero,
-            enable_tune_correction=True,
-            enable_chromaticity_correction=True,
-            knob_names=knob_names,
-            targets=targets,
-            line_co_ref=collider[line_name + "_co_ref"],
-            co_corr_config=conf_knobs_and_tuning["closed_orbit_correction"][line_name],
+    l_args = [
+        (
+            line_name,
+            conf_knobs_and_tuning,
+            match_linear_coupling_to_zero,
+            path_response_matrix,
+            response_signature,
+            correction_setup,
+        )
+        for line_name in ["lhcb1", "lhcb2"]
+    ]
+    if parallel_beams:
+        # Both beams are tuned at the same time in forked processes. Their knobs and correctors are
+        # distinct, so the variables changed by each process can be merged back into the collider.
+        merge_vars_diffs(
+            collider, run_per_beam_in_fork(collider, tune_line_and_get_vars_diff, l_args)
         )
+    else:
+        for args in l_args:
+            tune_line(collider, *args)
 
     return collider
 
@@ -196,6 +356,9 @@ def do_levelling(
     collider,
     n_collisions_ip1_and_5,
     crab,
+    reuse_jacobian=False,
+    path_jacobian=None,
+    jacobian_signature=None,
 ):
     # Read knobs and tuning settings from config file (already updated with the number of collisions)
     config_lumi_leveling = config_collider["config_lumi_leveling"]
@@ -251,6 +414,9 @@ def do_levelling(
         config_beambeam=config_bb,
         additional_targets_lumi=additional_targets_lumi,
         crab=crab,
+        reuse_jacobian=reuse_jacobian,
+        path_jacobian=path_jacobian,
+        jacobian_signature=jacobian_signature,
     )
 
     # Update configuration
@@ -299,7 +465,7 @@ def add_linear_coupling(conf_knobs_and_tuning, collider, config_mad):
 # ==================================================================================================
 def assert_tune_chroma_coupling(collider, conf_knobs_and_tuning):
     for line_name in ["lhcb1", "lhcb2"]:
-        tw = collider[line_name].twiss()
+        tw = twiss_cache.twiss(collider, line_name)
         assert np.isclose(tw.qx, conf_knobs_and_tuning["qx"][line_name], atol=1e-4), (
             f"tune_x is not correct for {line_name}. Expected"
             f" {conf_knobs_and_tuning['qx'][line_name]}, got {tw.qx}"
@@ -386,8 +552,7 @@ def configure_beam_beam(collider, config_bb):
 # ==================================================================================================
 def record_final_luminosity(collider, config_bb, l_n_collisions, crab):
     # Get the final luminoisty in all IPs
-    twiss_b1 = collider["lhcb1"].twiss()
-    twiss_b2 = collider["lhcb2"].twiss()
+    twiss_b1, twiss_b2 = twiss_cache.twiss_beams(collider, ["lhcb1", "lhcb2"])
     l_lumi = []
     l_PU = []
     l_ip = ["ip1", "ip2", "ip5", "ip8"]
@@ -420,6 +585,75 @@ def record_final_luminosity(collider, config_bb, l_n_collisions, crab):
     return config_bb
 
 
+# ==================================================================================================
+# --- Functions to snapshot the collider and rehydrate it
+# ==================================================================================================
+def get_collider_snapshot(collider, config_sim, vars_base_collider, config_bb, configure_bb=True):
+    # Lightweight representation of the collider: the path to the base collider, the variables
+    # changed with respect to it, and the beam-beam configuration from which the lenses are
+    # installed and (if configure_bb is True) configured again
+    config_bb = json.loads(json.dumps(config_bb))
+    config_filling = config_bb.get("mask_with_filling_pattern", {})
+    if config_filling.get("pattern_fname") is not None:
+        config_filling["pattern_fname"] = os.path.abspath(config_filling["pattern_fname"])
+    return {
+        "base_collider": os.path.abspath(config_sim["collider_file"]),
+        "vars": get_vars_diff(vars_base_collider, get_vars_snapshot(collider)),
+        "config_beambeam": config_bb,
+        "configure_beambeam": configure_bb and not config_bb["skip_beambeam"],
+    }
+
+
+def rehydrate_collider(snapshot):
+    # Rebuild the collider from a snapshot (see get_collider_snapshot), or from the path to a
+    # snapshot file
+    if isinstance(snapshot, str):
+        with open(snapshot, "r") as fid:
+            snapshot = json.load(fid)
+    collider = load_collider(snapshot["base_collider"])
+    collider, config_bb = install_beam_beam(
+        collider, {"config_beambeam": snapshot["config_beambeam"]}
+    )
+    collider.build_trackers()
+    apply_vars_snapshot(collider, snapshot["vars"])
+    if snapshot["configure_beambeam"]:
+        collider = configure_beam_beam(collider, config_bb)
+    return collider
+
+
+# ==================================================================================================
+# --- Function to get the configuration inputs of the cached stages (see L_STAGES in misc.py)
+# ==================================================================================================
+def get_stage_inputs(config_collider, conf_knobs_and_tuning, knob_signature, response_matrix_path):
+    # The response matrix shortcut only checks the coupling instead of correcting it, so its output
+    # is not equivalent to the one of a full matching
+    return {
+        "tuning": {
+            "signature": knob_signature,
+            "working_point": list(get_working_point(conf_knobs_and_tuning)),
+            "use_response_matrix": response_matrix_path is not None,
+            "match_linear_coupling_to_zero": True,
+        },
+        "leveling": {
+            key: config_collider.get(key)
+            for key in [
+                "config_lumi_leveling",
+                "config_lumi_leveling_ip1_5",
+                "config_beambeam",
+                "skip_leveling",
+            ]
+        },
+        "coupling": {
+            "delta_cmr": conf_knobs_and_tuning["delta_cmr"],
+            "delta_cmi": conf_knobs_and_tuning["delta_cmi"],
+        },
+        "rematch": {
+            "use_response_matrix": response_matrix_path is not None,
+            "match_linear_coupling_to_zero": False,
+        },
+    }
+
+
 # ==================================================================================================
 # --- Main function for collider configuration
 # ==================================================================================================
@@ -431,16 +665,21 @@ def configure_collider(
     save_config=False,
     return_collider_before_bb=False,
     config_path="config.yaml",
+    snapshot_before_bb=False,
 ):
-    # Generate configuration files for orbit correction
-    generate_configuration_correction_files()
-
     # Get configurations
     config_sim = config["config_simulation"]
     config_collider = config["config_collider"]
 
-    # Rebuild collider
-    collider = xt.Multiline.from_json(config_sim["collider_file"])
+    # Drop the twiss of previous colliders, as the keys rely on object ids that may be reused
+    twiss_cache.clear()
+
+    # Rebuild collider, and keep its variables to snapshot the configured collider
+    collider = load_collider(config_sim["collider_file"])
+    vars_base_collider = get_vars_snapshot(collider)
+
+    # Setup of the orbit correction
+    correction_setup = generate_orbit_correction_setup()
 
     # Install beam-beam
     collider, config_bb = install_beam_beam(collider, config_collider)
@@ -453,10 +692,72 @@ def configure_collider(
     # Set knobs
     collider, conf_knobs_and_tuning = set_knobs(config_collider, collider)
 
-    # Match tune and chromaticity
-    collider = match_tune_and_chroma(
-        collider, conf_knobs_and_tuning, match_linear_coupling_to_zero=True
+    # Signature of the collider before matching, shared by the knob cache and the response matrix
+    knob_signature = get_knob_cache_signature(config_mad, conf_knobs_and_tuning)
+    response_matrix_path = config.get("response_matrix_path")
+
+    # Compute the response matrices on the reference collider, if not done by another job yet
+    if response_matrix_path is not None:
+        compute_knob_response_matrices_once(
+            collider, conf_knobs_and_tuning["knob_names"], response_matrix_path, knob_signature
+        )
+
+    # Tune the two beams and compute their twiss in parallel, if requested
+    parallel_beams = config.get("parallel_beams", False)
+    twiss_cache.parallel_beams = parallel_beams
+
+    # Restore the output of the stages already computed with the same inputs, if any
+    vars_base = get_vars_snapshot(collider)
+    stage_cache_path = config.get("stage_cache_path")
+    dic_stage_keys = get_stage_keys(
+        get_stage_inputs(
+            config_collider, conf_knobs_and_tuning, knob_signature, response_matrix_path
+        )
     )
+    n_stages_cached = 0
+    if stage_cache_path is not None:
+        n_stages_cached = get_n_stages_cached(stage_cache_path, dic_stage_keys)
+    if n_stages_cached > 0:
+        # The variables are stored with respect to the collider before the first stage, while the
+        # configuration updates are stored by the stage that made them
+        print(f"Stages {L_STAGES[:n_stages_cached]} loaded from the stage cache")
+        for stage in L_STAGES[:n_stages_cached]:
+            stage_output = load_stage_output(stage_cache_path, stage, dic_stage_keys[stage])
+            update_nested(config_collider, stage_output["config"])
+        apply_vars_snapshot(collider, stage_output["vars"])
+
+    if n_stages_cached < 1:
+        # Initialise the knobs from the nearest working point already solved, if any
+        knob_cache_path = config.get("knob_cache_path")
+        if knob_cache_path is not None:
+            working_point = get_working_point(conf_knobs_and_tuning)
+            knobs = load_knob_solution(knob_cache_path, knob_signature, working_point)
+            if knobs is not None:
+                apply_vars_snapshot(collider, knobs)
+
+        # Match tune and chromaticity
+        collider = match_tune_and_chroma(
+            collider,
+            conf_knobs_and_tuning,
+            match_linear_coupling_to_zero=True,
+            path_response_matrix=response_matrix_path,
+            response_signature=knob_signature,
+            parallel_beams=parallel_beams,
+            correction_setup=correction_setup,
+        )
+
+        # Store the solution for the next working points
+        if knob_cache_path is not None:
+            save_knob_solution(
+                knob_cache_path,
+                knob_signature,
+                working_point,
+                get_vars_diff(vars_base, get_vars_snapshot(collider)),
+            )
+        if stage_cache_path is not None:
+            save_stage_output(
+                stage_cache_path, "tuning", dic_stage_keys["tuning"], collider, vars_base
+            )
 
     # Compute the number of collisions in the different IPs
     (
@@ -473,7 +774,9 @@ def configure_collider(
             crab = True
 
     # Do the leveling if requested
-    if "config_lumi_leveling" in config_collider and not config_collider["skip_leveling"]:
+    if n_stages_cached >= 2:
+        print("Leveling restored from the stage cache")
+    elif "config_lumi_leveling" in config_collider and not config_collider["skip_leveling"]:
         collider, config_collider = do_levelling(
             config_collider,
             config_bb,
@@ -482,6 +785,9 @@ def configure_collider(
             collider,
             n_collisions_ip1_and_5,
             crab,
+            reuse_jacobian=config.get("reuse_leveling_jacobian", False),
+            path_jacobian=config.get("leveling_jacobian_path"),
+            jacobian_signature=knob_signature,
         )
 
     else:
@@ -490,25 +796,69 @@ def configure_collider(
             " is set to True."
         )
 
+    # Store the leveling, along with the configuration it updated
+    if n_stages_cached < 2 and stage_cache_path is not None:
+        save_stage_output(
+            stage_cache_path,
+            "leveling",
+            dic_stage_keys["leveling"],
+            collider,
+            vars_base,
+            config_updates={
+                key: config_collider[key]
+                for key in [
+                    "config_lumi_leveling",
+                    "config_lumi_leveling_ip1_5",
+                    "config_beambeam",
+                ]
+                if key in config_collider
+            },
+        )
+
     # Add linear coupling
-    collider = add_linear_coupling(conf_knobs_and_tuning, collider, config_mad)
+    if n_stages_cached < 3:
+        collider = add_linear_coupling(conf_knobs_and_tuning, collider, config_mad)
+        if stage_cache_path is not None:
+            save_stage_output(
+                stage_cache_path, "coupling", dic_stage_keys["coupling"], collider, vars_base
+            )
 
     # Rematch tune and chromaticity
-    collider = match_tune_and_chroma(
-        collider, conf_knobs_and_tuning, match_linear_coupling_to_zero=False
-    )
+    if n_stages_cached < 4:
+        collider = match_tune_and_chroma(
+            collider,
+            conf_knobs_and_tuning,
+            match_linear_coupling_to_zero=False,
+            path_response_matrix=response_matrix_path,
+            response_signature=knob_signature,
+            parallel_beams=parallel_beams,
+            correction_setup=correction_setup,
+        )
+        if stage_cache_path is not None:
+            save_stage_output(
+                stage_cache_path, "rematch", dic_stage_keys["rematch"], collider, vars_base
+            )
 
     # Assert that tune, chromaticity and linear coupling are correct one last time
     assert_tune_chroma_coupling(collider, conf_knobs_and_tuning)
 
-    # Return twiss and survey before beam-beam if requested
+    # Return twiss and survey before beam-beam if requested, either as a copy of the collider or (if
+    # snapshot_before_bb is True) as a lightweight snapshot, rehydrated on demand with
+    # rehydrate_collider
     if return_collider_before_bb:
         print("Saving collider before beam-beam configuration")
-        collider_before_bb = xt.Multiline.from_dict(collider.to_dict())
+        if snapshot_before_bb:
+            collider_before_bb = get_collider_snapshot(
+                collider, config_sim, vars_base_collider, config_bb, configure_bb=False
+            )
+        else:
+            collider_before_bb = xt.Multiline.from_dict(collider.to_dict())
 
     if not config_bb["skip_beambeam"]:
-        # Configure beam-beam
+        # Configure beam-beam (the lenses are not configured through the variables, so the twiss
+        # computed so far are outdated)
         collider = configure_beam_beam(collider, config_bb)
+        twiss_cache.clear()
 
     # Update configuration with luminosity now that bb is known
     l_n_collisions = [
@@ -519,11 +869,31 @@ def configure_collider(
     ]
     config_bb = record_final_luminosity(collider, config_bb, l_n_collisions, crab)
 
-    # Drop update configuration
-    with open(config_path, "w") as fid:
-        ryaml.dump(config, fid)
+    # Don't overwrite the outputs of another copy of this job (e.g. resubmitted straggler) that has
+    # already been completed, as they may be read by the children of the node
+    if has_been_completed(config):
+        print("Another copy of this job has already been completed. Collider is not saved.")
+        save_collider = False
+
+    # Drop update configuration (through a temporary file, such that it's always complete)
+    else:
+        with open(f"{config_path}.tmp{os.getpid()}", "w") as fid:
+            ryaml.dump(config, fid)
+        os.replace(f"{config_path}.tmp{os.getpid()}", config_path)
+
+    if save_collider and config.get("dump_collider_format", "full") == "snapshot":
+        # Only save the changes with respect to the base collider
+        print('Saving "collider_snapshot.json')
+        snapshot = get_collider_snapshot(collider, config_sim, vars_base_collider, config_bb)
+        if save_config:
+            snapshot["metadata"] = json.loads(
+                json.dumps({"config_mad": config_mad, "config_collider": config_collider})
+            )
+        with open(f"collider_snapshot.json.tmp{os.getpid()}", "w") as fid:
+            json.dump(snapshot, fid)
+        os.replace(f"collider_snapshot.json.tmp{os.getpid()}", "collider_snapshot.json")
 
-    if save_collider:
+    elif save_collider:
         # Save the final collider before tracking
         print('Saving "collider.json')
         if save_config:
@@ -532,8 +902,9 @@ def configure_collider(
                 "config_collider": config_collider,
             }
             collider.metadata = config_dict
-        # Dump collider
-        collider.to_json("collider.json")
+        # Dump collider (through a temporary file, as the collider may be read by the children)
+        collider.to_json(f"collider.json.tmp{os.getpid()}")
+        os.replace(f"collider.json.tmp{os.getpid()}", "collider.json")
 
     if return_collider_before_bb:
         return collider, config_sim, config_bb, collider_before_bb
@@ -541,13 +912,54 @@ def configure_collider(
         return collider, config_sim, config_bb
 
 
+def load_configured_collider(config, config_path="config.yaml"):
+    # Load the collider configured by the parent node (two-stage mode), along with the beam-beam
+    # configuration updated by the parent (e.g. with the luminosity)
+    config_sim = config["config_simulation"]
+    if config_sim["collider_file"].endswith("_snapshot.json"):
+        collider = rehydrate_collider(config_sim["collider_file"])
+    else:
+        collider = load_collider(config_sim["collider_file"])
+        collider.build_trackers()
+    with open("../" + config_path, "r") as fid:
+        config_parent = ryaml.load(fid)
+    config_bb = config_parent["config_collider"]["config_beambeam"]
+    return collider, config_sim, config_bb
+
+
 # ==================================================================================================
 # --- Function to prepare particles distribution for tracking
 # ==================================================================================================
+def load_particle_distribution(config_sim):
+    particle_file = config_sim["particle_file"]
+
+    # One file per split
+    if "particle_split" not in config_sim:
+        return pd.read_parquet(particle_file)
+
+    # Single file for all splits, only the row group of the current split is read
+    idx_split = config_sim["particle_split"]
+    if particle_file.endswith(".parquet"):
+        particle_df = pd.read_parquet(
+            particle_file, engine="fastparquet", filters=[("split", "==", idx_split)]
+        )
+        return particle_df[particle_df["split"] == idx_split].drop(columns="split")
+
+    # Only the generator parameters are stored, the chunk is regenerated with the generator module
+    # of the first generation
+    with open(particle_file, "r") as fid:
+        config_particles = ryaml.load(fid)
+    path_module = f"{os.path.dirname(os.path.dirname(particle_file))}/particle_distribution.py"
+    spec = importlib.util.spec_from_file_location("particle_distribution", path_module)
+    particle_distribution = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(particle_distribution)
+    return particle_distribution.generate_particle_chunk(config_particles, idx_split)
+
+
 def prepare_particle_distribution(collider, context, config_sim, config_bb):
     beam = config_sim["beam"]
 
-    particle_df = pd.read_parquet(config_sim["particle_file"])
+    particle_df = load_particle_distribution(config_sim)
 
     r_vect = particle_df["normalized amplitude in xy-plane"].values
     theta_vect = particle_df["angle in xy-plane [deg]"].values * np.pi / 180  # [rad]
@@ -555,16 +967,24 @@ def prepare_particle_distribution(collider, context, config_sim, config_bb):
     A1_in_sigma = r_vect * np.cos(theta_vect)
     A2_in_sigma = r_vect * np.sin(theta_vect)
 
+    # On CPU, the closed orbit and the W matrix are taken from the twiss already computed for the
+    # luminosity (on GPU, the trackers have been rebuilt, so a new twiss is needed anyway)
+    kwargs_twiss = {}
+    if isinstance(context, xo.ContextCpu):
+        tw = twiss_cache.twiss(collider, beam)
+        kwargs_twiss = {"particle_on_co": tw.particle_on_co.copy(), "W_matrix": tw.W_matrix[0]}
+    twiss_cache.print_stats()
+
     particles = collider[beam].build_particles(
         x_norm=A1_in_sigma,
         y_norm=A2_in_sigma,
         delta=config_sim["delta_max"],
         scale_with_transverse_norm_emitt=(config_bb["nemitt_x"], config_bb["nemitt_y"]),
         _context=context,
+        **kwargs_twiss,
     )
 
-    particle_id = particle_df.particle_id.values
-    return particles, particle_id
+    return particles, particle_df
 
 
 # ==================================================================================================
@@ -603,18 +1023,40 @@ def configure_and_track(config_path="config.yaml"):
     # Get context
     context = get_context(config)
 
-    # Tag start of the job
-    tree_maker_tagging(config, tag="started")
-
-    # Configure collider (not saved, since it may trigger overload of afs)
-    collider, config_sim, config_bb = configure_collider(
-        config,
-        config_mad,
-        context,
-        save_collider=config["dump_collider"],
-        save_config=config["dump_config_in_collider"],
-        config_path=config_path,
-    )
+    # Nothing to do if another copy of this job (e.g. resubmitted straggler) is already completed
+    if has_been_completed(config):
+        print("Another copy of this job has already been completed.")
+        return
+
+    # Tag start of the job, unless another copy has already started, such that the runtime of the
+    # node (used to calibrate the cost of the jobs) is measured from the first copy
+    if not has_been_tagged(config, "started"):
+        tree_maker_tagging(config, tag="started")
+
+    # Mode of the job: configure and track (default), or, for two-stage studies, only configure the
+    # collider for a working point, or only track a subset of particles with the parent collider
+    mode = config.get("mode", "configure_and_track")
+    if mode not in ["configure_and_track", "configure", "track"]:
+        raise ValueError(f"Unknown mode {mode}")
+
+    if mode == "track":
+        # Load the collider configured by the parent
+        collider, config_sim, config_bb = load_configured_collider(config, config_path)
+    else:
+        # Configure collider (not saved unless requested, since it may trigger overload of afs)
+        collider, config_sim, config_bb = configure_collider(
+            config,
+            config_mad,
+            context,
+            save_collider=config["dump_collider"] or mode == "configure",
+            save_config=config["dump_config_in_collider"],
+            config_path=config_path,
+        )
+
+    # The configured collider is used by the children for the tracking
+    if mode == "configure":
+        tree_maker_tagging(config, tag="completed")
+        return
 
     # Reset the tracker to go to GPU if needed
     if config["context"] in ["cupy", "opencl"]:
@@ -622,7 +1064,7 @@ def configure_and_track(config_path="config.yaml"):
         collider.build_trackers(_context=context)
 
     # Prepare particle distribution
-    particles, particle_id = prepare_particle_distribution(collider, context, config_sim, config_bb)
+    particles, particle_df = prepare_particle_distribution(collider, context, config_sim, config_bb)
 
     # Track
     particles = track(collider, particles, config_sim)
@@ -637,19 +1079,28 @@ def configure_and_track(config_path="config.yaml"):
     # Sort by parent_particle_id
     particles_df = particles_df.sort_values("parent_particle_id")
 
-    # Assign the old id to the sorted dataframe
-    particles_df["particle_id"] = particle_id
+    # Assign the old id to the sorted dataframe, along with the initial amplitude and angle (such
+    # that the distribution doesn't need to be read again in the postprocessing)
+    particles_df["particle_id"] = particle_df.particle_id.values
+    particles_df["normalized amplitude in xy-plane"] = particle_df[
+        "normalized amplitude in xy-plane"
+    ].values
+    particles_df["angle in xy-plane [deg]"] = particle_df["angle in xy-plane [deg]"].values
 
-    # Save output
-    particles_df.to_parquet("output_particles.parquet")
-
-    # Remote the correction folder, and potential C files remaining
+    # Remove potential C files remaining
     try:
-        os.system("rm -rf correction")
         os.system("rm -f *.cc")
     except:
         pass
 
+    # Save output, unless another copy of the job has already done it. The output is written to a
+    # temporary file first, such that the output of a node is always complete.
+    if has_been_completed(config):
+        print("Another copy of this job has already been completed. Output is not saved.")
+        return
+    particles_df.to_parquet("output_particles.parquet.tmp")
+    os.replace("output_particles.parquet.tmp", "output_particles.parquet")
+
     # Tag end of the job
     tree_maker_tagging(config, tag="completed")
 
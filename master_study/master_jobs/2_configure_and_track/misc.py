@@ -1,12 +1,405 @@
 # Imports
+import fcntl
+import hashlib
+import importlib.util
 import json
 import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 import xtrack as xt
 from scipy.constants import c as clight
 from scipy.optimize import minimize_scalar
 
 
+# Function to load a collider saved either as json or in the binary format of the first generation.
+# The binary loader is imported from the folder of the first generation (collider_binary.py), such
+# that the reader is always the one matching the writer.
+def load_collider(path_collider):
+    if path_collider.endswith(".json"):
+        return xt.Multiline.from_json(path_collider)
+    elif not path_collider.endswith(".npz"):
+        raise ValueError(f"Unknown collider format for {path_collider}")
+
+    path_module = (
+        f"{os.path.dirname(os.path.dirname(os.path.abspath(path_collider)))}/collider_binary.py"
+    )
+    spec = importlib.util.spec_from_file_location("collider_binary", path_module)
+    collider_binary = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(collider_binary)
+    return collider_binary.load_collider_binary(path_collider)
+
+
+# Collider shared with the worker processes of run_per_beam_in_fork. It is set before the workers are
+# forked, such that they inherit it instead of receiving a pickled copy.
+_collider_fork = None
+
+
+def _call_in_fork(function, args):
+    return function(_collider_fork, *args)
+
+
+# Function to run function(collider, *args) for each tuple of arguments of l_args in a separate
+# forked process, each working on its own copy of the collider. Only the returned values are sent
+# back, so the changes made to the collider must be merged back by the caller.
+def run_per_beam_in_fork(collider, function, l_args):
+    global _collider_fork
+    _collider_fork = collider
+    try:
+        with ProcessPoolExecutor(
+            max_workers=len(l_args), mp_context=multiprocessing.get_context("fork")
+        ) as executor:
+            return list(executor.map(_call_in_fork, [function] * len(l_args), l_args))
+    finally:
+        _collider_fork = None
+
+
+# Cache of the twiss results, such that repeated twiss on an unchanged lattice are only computed once.
+# A result is reused if the line, the twiss arguments, the tracker and the values of all the
+# variables of the collider are the same. Changes of the elements that don't go through the
+# variables (e.g. the configuration of the beam-beam lenses) are not seen, and the cache must be
+# cleared after them.
+class TwissCache:
+    def __init__(self):
+        self.dic_twiss = {}
+        self.n_hits = 0
+        self.n_misses = 0
+        # If True, the twiss of the lines computed with twiss_beams are done in parallel
+        self.parallel_beams = False
+
+    def get_fingerprint(self, collider):
+        # Values are hashed through their repr, as some variables may not be hashable (e.g. arrays)
+        table = collider.vars.get_table()
+        return hash(tuple(zip(table.name, map(repr, table.value), table.expr)))
+
+    def get_key(self, collider, lines, kwargs):
+        # lines is either a line name or a list of line names (computed as a multi-line twiss)
+        if isinstance(lines, str):
+            tracker_ids = id(collider[lines].tracker)
+        else:
+            tracker_ids = tuple(id(collider[line_name].tracker) for line_name in lines)
+        return (
+            id(collider),
+            lines if isinstance(lines, str) else tuple(lines),
+            repr(sorted(kwargs.items())),
+            tracker_ids,
+            self.get_fingerprint(collider),
+        )
+
+    def twiss(self, collider, lines, **kwargs):
+        key = self.get_key(collider, lines, kwargs)
+        if key in self.dic_twiss:
+            self.n_hits += 1
+            return self.dic_twiss[key]
+
+        self.n_misses += 1
+        if isinstance(lines, str):
+            tw = collider[lines].twiss(**kwargs)
+        else:
+            tw = collider.twiss(lines=list(lines), **kwargs)
+        self.dic_twiss[key] = tw
+        return tw
+
+    def twiss_beams(self, collider, l_lines=("lhcb1", "lhcb2"), **kwargs):
+        # Single-line twiss of each line, the missing ones being computed in parallel if requested
+        if not self.parallel_beams:
+            return [self.twiss(collider, line_name, **kwargs) for line_name in l_lines]
+
+        l_keys = [self.get_key(collider, line_name, kwargs) for line_name in l_lines]
+        l_missing = [
+            line_name for line_name, key in zip(l_lines, l_keys) if key not in self.dic_twiss
+        ]
+        self.n_hits += len(l_lines) - len(l_missing)
+        self.n_misses += len(l_missing)
+        if len(l_missing) > 1:
+            l_tw = run_per_beam_in_fork(
+                collider, _twiss_line, [(line_name, kwargs) for line_name in l_missing]
+            )
+        else:
+            l_tw = [collider[line_name].twiss(**kwargs) for line_name in l_missing]
+        dic_keys = dict(zip(l_lines, l_keys))
+        for line_name, tw in zip(l_missing, l_tw):
+            self.dic_twiss[dic_keys[line_name]] = tw
+        return [self.dic_twiss[key] for key in l_keys]
+
+    def clear(self):
+        self.dic_twiss = {}
+
+    def print_stats(self):
+        n_calls = self.n_hits + self.n_misses
+        hit_rate = self.n_hits / n_calls if n_calls > 0 else 0.0
+        print(f"Twiss cache: {self.n_hits}/{n_calls} hits ({100 * hit_rate:.0f}%)")
+
+
+def _twiss_line(collider, line_name, kwargs):
+    return collider[line_name].twiss(**kwargs)
+
+
+# Twiss cache shared by the functions of the configuration
+twiss_cache = TwissCache()
+
+
+# Function to get the values of the independent variables (i.e. not defined by an expression) of
+# the collider
+def get_vars_snapshot(collider):
+    table = collider.vars.get_table()
+    return {
+        name: value.item() if isinstance(value, np.generic) else value
+        for name, value, expr in zip(table.name, table.value, table.expr)
+        if expr is None and isinstance(value, (int, float, np.number))
+    }
+
+
+# Function to set the independent variables of the collider from a snapshot
+def apply_vars_snapshot(collider, dic_vars):
+    table = collider.vars.get_table()
+    set_dependent_vars = {name for name, expr in zip(table.name, table.expr) if expr is not None}
+    for name, value in dic_vars.items():
+        if name not in set_dependent_vars:
+            collider.vars[name] = value
+
+
+# Function to get the variables that differ between two snapshots
+def get_vars_diff(dic_vars_ref, dic_vars):
+    return {name: value for name, value in dic_vars.items() if dic_vars_ref.get(name) != value}
+
+
+# Function to merge into the collider the variables changed by independent workers (e.g. one per
+# beam), which must not set the same variable to different values
+def merge_vars_diffs(collider, l_vars_diff):
+    dic_vars_merged = {}
+    for dic_vars_diff in l_vars_diff:
+        for name, value in dic_vars_diff.items():
+            if name in dic_vars_merged and dic_vars_merged[name] != value:
+                raise ValueError(f"Variable {name} set to different values by the workers")
+            dic_vars_merged[name] = value
+    apply_vars_snapshot(collider, dic_vars_merged)
+
+
+# Function to get the signature of the knob solutions that can be shared between working points,
+# i.e. everything that impacts the matching except the working point itself
+def get_knob_cache_signature(config_mad, conf_knobs_and_tuning):
+    dic_signature = {
+        "config_mad": {key: value for key, value in config_mad.items() if key != "links"},
+        "knob_settings": conf_knobs_and_tuning["knob_settings"],
+        "knob_names": conf_knobs_and_tuning["knob_names"],
+    }
+    return hashlib.sha256(
+        json.dumps(dic_signature, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+# Function to get the working point (tunes and chromaticities of both beams) as an array
+def get_working_point(conf_knobs_and_tuning):
+    return np.array(
+        [
+            float(conf_knobs_and_tuning[key][line_name])
+            for line_name in ["lhcb1", "lhcb2"]
+            for key in ["qx", "qy", "dqx", "dqy"]
+        ]
+    )
+
+
+# Function to load the knob solution of the nearest working point already solved (tunes are
+# weighted such that a 1e-3 tune shift is as far as a unit of chromaticity)
+def load_knob_solution(path_cache, signature, working_point):
+    if not os.path.isdir(path_cache):
+        return None
+    scale = np.array([1e-3, 1e-3, 1.0, 1.0] * 2)
+    best_distance = np.inf
+    best_knobs = None
+    for filename in os.listdir(path_cache):
+        if not (filename.startswith(signature) and filename.endswith(".json")):
+            continue
+        try:
+            with open(f"{path_cache}/{filename}", "r") as fid:
+                dic_solution = json.load(fid)
+        except (OSError, ValueError):
+            continue
+        distance = np.linalg.norm((np.array(dic_solution["working_point"]) - working_point) / scale)
+        if distance < best_distance:
+            best_distance = distance
+            best_knobs = dic_solution["knobs"]
+    if best_knobs is not None:
+        print(f"Knobs initialised from a solved working point at distance {best_distance:.2f}")
+    return best_knobs
+
+
+# Function to save the knob solution of a working point (written through a temporary file, as many
+# jobs share the same cache)
+def save_knob_solution(path_cache, signature, working_point, knobs):
+    os.makedirs(path_cache, exist_ok=True)
+    key = hashlib.sha256(np.asarray(working_point).tobytes()).hexdigest()[:16]
+    path_solution = f"{path_cache}/{signature}_{key}.json"
+    with open(f"{path_solution}.tmp{os.getpid()}", "w") as fid:
+        json.dump({"working_point": list(working_point), "knobs": knobs}, fid)
+    os.replace(f"{path_solution}.tmp{os.getpid()}", path_solution)
+
+
+# Observables and knobs (as named in knob_names) of the response matrix, along with the steps used
+# to compute it (per type of knob) and the tolerances on the predicted observables
+L_RESPONSE_OBSERVABLES = ["qx", "qy", "dqx", "dqy", "c_minus"]
+L_RESPONSE_KNOBS = [
+    "q_knob_1",
+    "q_knob_2",
+    "dq_knob_1",
+    "dq_knob_2",
+    "c_minus_knob_1",
+    "c_minus_knob_2",
+]
+dic_response_steps = {"q_knob": 1e-6, "dq_knob": 1e-5, "c_minus_knob": 1e-4}
+dic_response_tolerances = {"qx": 1e-5, "qy": 1e-5, "dqx": 1e-2, "dqy": 1e-2, "c_minus": 1e-3}
+
+
+# Function to get the observables of the response matrix for a given line
+def get_response_observables(line):
+    tw = line.twiss()
+    return np.array([tw[observable] for observable in L_RESPONSE_OBSERVABLES])
+
+
+# Function to compute the response matrix (jacobian) of the observables with respect to the knobs,
+# with central finite differences
+def compute_knob_response_matrix(collider, line_name, knob_names):
+    response_matrix = np.zeros((len(L_RESPONSE_OBSERVABLES), len(L_RESPONSE_KNOBS)))
+    for idx_knob, knob in enumerate(L_RESPONSE_KNOBS):
+        var_name = knob_names[knob]
+        step = dic_response_steps[knob.rsplit("_", 1)[0]]
+        value = collider.vars[var_name]._value
+        collider.vars[var_name] = value + step
+        observables_plus = get_response_observables(collider[line_name])
+        collider.vars[var_name] = value - step
+        observables_minus = get_response_observables(collider[line_name])
+        collider.vars[var_name] = value
+        response_matrix[:, idx_knob] = (observables_plus - observables_minus) / (2 * step)
+    return response_matrix
+
+
+# Function to compute and store the response matrices of both lines if they don't exist yet (the
+# signature identifies the reference collider, see get_knob_cache_signature). It must be called on
+# the reference collider, i.e. with the knobs set but before any matching or warm start. A lock
+# ensures that the matrices are only computed by one job, the other ones waiting for the result.
+def compute_knob_response_matrices_once(collider, knob_names, path_response_matrix, signature):
+    os.makedirs(path_response_matrix, exist_ok=True)
+    with open(f"{path_response_matrix}/response_{signature}.lock", "w") as fid_lock:
+        fcntl.flock(fid_lock, fcntl.LOCK_EX)
+        try:
+            for line_name in ["lhcb1", "lhcb2"]:
+                path_file = f"{path_response_matrix}/response_{signature}_{line_name}.json"
+                if os.path.isfile(path_file):
+                    continue
+                print(f"Computing the knob response matrix of {line_name}")
+                response_matrix = compute_knob_response_matrix(
+                    collider, line_name, knob_names[line_name]
+                )
+                with open(f"{path_file}.tmp{os.getpid()}", "w") as fid:
+                    json.dump(
+                        {
+                            "observables": L_RESPONSE_OBSERVABLES,
+                            "knobs": [knob_names[line_name][knob] for knob in L_RESPONSE_KNOBS],
+                            "matrix": response_matrix.tolist(),
+                        },
+                        fid,
+                    )
+                os.replace(f"{path_file}.tmp{os.getpid()}", path_file)
+        finally:
+            fcntl.flock(fid_lock, fcntl.LOCK_UN)
+
+
+# Function to load the response matrix of a line (computed with compute_knob_response_matrices_once)
+def load_knob_response_matrix(line_name, path_response_matrix, signature):
+    with open(f"{path_response_matrix}/response_{signature}_{line_name}.json", "r") as fid:
+        return np.array(json.load(fid)["matrix"])
+
+
+# Function to predict the change of the tune and chromaticity knobs needed to reach the targets.
+# Only the tune and chromaticity block is inverted, as |c_minus| is not differentiable at zero.
+def predict_knob_changes(response_matrix, observables, targets):
+    residuals = np.array([targets[observable] for observable in ["qx", "qy", "dqx", "dqy"]])
+    residuals -= observables[:4]
+    knob_changes = np.linalg.solve(response_matrix[:4, :4], residuals)
+    return dict(zip(L_RESPONSE_KNOBS[:4], knob_changes))
+
+
+# Function to check that the observables are within tolerance of the targets
+def check_response_observables(observables, targets, check_coupling=True):
+    for idx, observable in enumerate(L_RESPONSE_OBSERVABLES[:4]):
+        if abs(observables[idx] - targets[observable]) > dic_response_tolerances[observable]:
+            return False
+    if check_coupling and observables[4] > dic_response_tolerances["c_minus"]:
+        return False
+    return True
+
+
+# Stages of the configuration of the collider whose output (independent variables of the collider
+# and configuration updates) can be cached, in order of execution. Each stage depends on the
+# previous one and on its own configuration inputs, such that changing a parameter only re-runs the
+# stages downstream of it. Beam-beam and luminosity are not cached, as they don't act on the
+# variables.
+L_STAGES = ["tuning", "leveling", "coupling", "rematch"]
+
+
+# Function to get the key of each stage, from the inputs of all the stages (dictionnary with one
+# entry per stage)
+def get_stage_keys(dic_stage_inputs):
+    dic_stage_keys = {}
+    key = ""
+    for stage in L_STAGES:
+        key = hashlib.sha256(
+            json.dumps(
+                {"stage": stage, "parent": key, "inputs": dic_stage_inputs[stage]},
+                sort_keys=True,
+                default=str,
+            ).encode()
+        ).hexdigest()
+        dic_stage_keys[stage] = key
+    return dic_stage_keys
+
+
+# Function to get the number of consecutive stages already in the cache
+def get_n_stages_cached(path_cache, dic_stage_keys):
+    n_stages_cached = 0
+    for stage in L_STAGES:
+        if not os.path.isfile(f"{path_cache}/{stage}_{dic_stage_keys[stage]}.json"):
+            break
+        n_stages_cached += 1
+    return n_stages_cached
+
+
+# Function to load the output of a stage
+def load_stage_output(path_cache, stage, key):
+    with open(f"{path_cache}/{stage}_{key}.json", "r") as fid:
+        return json.load(fid)
+
+
+# Function to save the output of a stage: the variables that differ from the collider before the
+# first stage, and the configuration entries updated by the stage (written through a temporary file,
+# as many jobs share the same cache)
+def save_stage_output(path_cache, stage, key, collider, vars_base, config_updates=None):
+    os.makedirs(path_cache, exist_ok=True)
+    path_file = f"{path_cache}/{stage}_{key}.json"
+    with open(f"{path_file}.tmp{os.getpid()}", "w") as fid:
+        json.dump(
+            {
+                "vars": get_vars_diff(vars_base, get_vars_snapshot(collider)),
+                "config": {} if config_updates is None else config_updates,
+            },
+            fid,
+        )
+    os.replace(f"{path_file}.tmp{os.getpid()}", path_file)
+
+
+# Function to update a nested dictionnary in place (used to restore the configuration updates)
+def update_nested(dic, dic_update):
+    for key, value in dic_update.items():
+        if isinstance(value, dict) and isinstance(dic.get(key), dict):
+            update_nested(dic[key], value)
+        else:
+            dic[key] = value
+
+
 # Function to generate dictionnary containing the orbit correction setup
 def generate_orbit_correction_setup():
     correction_setup = {}
@@ -251,15 +644,121 @@ def generate_orbit_correction_setup():
     return correction_setup
 
 
+# Jacobians of the leveling matches already computed in this job, per IP and configuration family
+dic_leveling_jacobians = {}
+
+
+# Function to get the key of the leveling jacobian of an IP. The jacobian only depends on the
+# reference collider (see get_knob_cache_signature), on the knobs and on the type of targets, not on
+# the value of the target luminosity or separation.
+def get_leveling_jacobian_key(
+    signature, ip_name, config_this_ip, additional_targets_lumi=None, crab=False
+):
+    dic_key = {
+        "signature": signature,
+        "ip_name": ip_name,
+        "bump_range": config_this_ip["bump_range"],
+        "knobs": config_this_ip["knobs"],
+        "corrector_knob_names": config_this_ip["corrector_knob_names"],
+        "luminosity": "luminosity" in config_this_ip,
+        "impose_separation_orthogonal_to_crossing": config_this_ip[
+            "impose_separation_orthogonal_to_crossing"
+        ],
+        # The additional targets are only used with a luminosity target
+        "additional_targets_lumi": (
+            [repr(target) for target in additional_targets_lumi]
+            if "luminosity" in config_this_ip and additional_targets_lumi is not None
+            else []
+        ),
+        "crab": crab,
+    }
+    return hashlib.sha256(json.dumps(dic_key, sort_keys=True, default=str).encode()).hexdigest()
+
+
+# Function to load a leveling jacobian, from memory or from the jacobian folder
+def load_leveling_jacobian(key, path_jacobian):
+    if key in dic_leveling_jacobians:
+        return dic_leveling_jacobians[key]
+    if path_jacobian is None or not os.path.isfile(f"{path_jacobian}/leveling_{key}.json"):
+        return None
+    with open(f"{path_jacobian}/leveling_{key}.json", "r") as fid:
+        jacobian = np.array(json.load(fid)["jacobian"])
+    dic_leveling_jacobians[key] = jacobian
+    return jacobian
+
+
+# Function to store a leveling jacobian (written through a temporary file, as many jobs share the
+# same folder)
+def save_leveling_jacobian(key, path_jacobian, jacobian):
+    dic_leveling_jacobians[key] = jacobian
+    if path_jacobian is None:
+        return
+    os.makedirs(path_jacobian, exist_ok=True)
+    path_file = f"{path_jacobian}/leveling_{key}.json"
+    with open(f"{path_file}.tmp{os.getpid()}", "w") as fid:
+        json.dump({"jacobian": jacobian.tolist()}, fid)
+    os.replace(f"{path_file}.tmp{os.getpid()}", path_file)
+
+
+# Function to check that all the targets of a match are within tolerance (the tolerances apply to the
+# unweighted values of the targets, not to the weighted residuals of the merit function)
+def targets_within_tol(opt):
+    return bool(np.all(opt.target_status(ret=True).tol_met))
+
+
+# Function to run chord iterations (Newton steps with a fixed jacobian) on the merit function of a
+# match. Returns True if all the targets are within tolerance. The knobs are left at the best point
+# found.
+def solve_with_fixed_jacobian(opt, jacobian, n_steps_max=10):
+    merit_function = opt.get_merit_function(return_scalar=False)
+    x = merit_function.get_x()
+    err = merit_function(x)
+    for _ in range(n_steps_max):
+        if targets_within_tol(opt):
+            return True
+        x_new = x - np.linalg.lstsq(jacobian, err, rcond=None)[0]
+        err_new = merit_function(x_new)
+        if np.linalg.norm(err_new) >= np.linalg.norm(err):
+            # Step not improving anymore, go back to the previous point
+            merit_function(x)
+            return False
+        x, err = x_new, err_new
+    return targets_within_tol(opt)
+
+
+# Function to solve a leveling match reusing the jacobian of the same configuration family. If the
+# stored jacobian doesn't converge, a fresh one is computed at the current point, and the standard
+# solver is used as a last resort.
+def solve_leveling_match(opt, key, path_jacobian):
+    merit_function = opt.get_merit_function(return_scalar=False)
+    x = merit_function.get_x()
+    jacobian = load_leveling_jacobian(key, path_jacobian)
+    if jacobian is not None and jacobian.shape == (len(merit_function(x)), len(x)):
+        if solve_with_fixed_jacobian(opt, jacobian):
+            return "stored jacobian"
+
+    jacobian = merit_function.get_jacobian(merit_function.get_x())
+    save_leveling_jacobian(key, path_jacobian, jacobian)
+    if solve_with_fixed_jacobian(opt, jacobian):
+        return "new jacobian"
+
+    opt.solve()
+    return "full match"
+
+
 def luminosity_leveling(
     collider,
     config_lumi_leveling,
     config_beambeam,
     additional_targets_lumi=[],
     crab=False,
+    reuse_jacobian=False,
+    path_jacobian=None,
+    jacobian_signature=None,
 ):
     for ip_name in config_lumi_leveling.keys():
         print(f"\n --- Leveling in {ip_name} ---")
+        start = time.time()
 
         config_this_ip = config_lumi_leveling[ip_name]
         bump_range = config_this_ip["bump_range"]
@@ -311,7 +810,7 @@ def luminosity_leveling(
             raise ValueError("Either `luminosity` or `separation_in_sigmas` must be specified")
 
         if config_this_ip["impose_separation_orthogonal_to_crossing"]:
-            targets.append(xt.TargetSeparationOrthogonalToCrossing(ip_name="ip8"))
+            targets.append(xt.TargetSeparationOrthogonalToCrossing(ip_name=ip_name))
         vary.append(xt.VaryList(config_this_ip["knobs"], step=1e-4))
 
         # Target and knobs to rematch the crossing angles and close the bumps
@@ -342,9 +841,9 @@ def luminosity_leveling(
 
         vary.append(xt.VaryList(config_this_ip["corrector_knob_names"], step=1e-7))
 
-        # Match
-        tw0 = collider.twiss(lines=["lhcb1", "lhcb2"])
-        collider.match(
+        # Match, reusing the jacobian of the previous matches of the same family if requested
+        tw0 = twiss_cache.twiss(collider, ["lhcb1", "lhcb2"])
+        opt = collider.match(
             lines=["lhcb1", "lhcb2"],
             start=[bump_range["lhcb1"][0], bump_range["lhcb2"][0]],
             end=[bump_range["lhcb1"][-1], bump_range["lhcb2"][-1]],
@@ -352,7 +851,18 @@ def luminosity_leveling(
             init_at=xt.START,
             targets=targets,
             vary=vary,
+            solve=not reuse_jacobian,
         )
+        method = "full match"
+        if reuse_jacobian:
+            method = solve_leveling_match(
+                opt,
+                get_leveling_jacobian_key(
+                    jacobian_signature, ip_name, config_this_ip, additional_targets_lumi, crab
+                ),
+                path_jacobian,
+            )
+        print(f"Leveling in {ip_name} done in {time.time() - start:.2f} s ({method})")
 
     return collider
 
@@ -368,8 +878,7 @@ def luminosity_leveling_ip1_5(
     crab=False,
 ):
     # Get Twiss
-    twiss_b1 = collider["lhcb1"].twiss()
-    twiss_b2 = collider["lhcb2"].twiss()
+    twiss_b1, twiss_b2 = twiss_cache.twiss_beams(collider, ["lhcb1", "lhcb2"])
 
     def compute_lumi(I):
         luminosity = xt.lumi.luminosity_from_twiss(
@@ -387,6 +896,28 @@ def luminosity_leveling_ip1_5(
         )
         return luminosity
 
+    # Luminosity is quadratic in the intensity for a given twiss, so the intensity can be computed
+    # directly from the luminosity at a reference intensity
+    config_leveling = config_collider["config_lumi_leveling_ip1_5"]
+    if config_leveling.get("method", "analytical") == "analytical":
+        I_ref = 1e11
+        luminosity_ref = compute_lumi(I_ref)
+        PU_ref = compute_PU(
+            luminosity_ref, config_leveling["num_colliding_bunches"], twiss_b1["T_rev0"]
+        )
+        dic_intensities = {
+            "luminosity": I_ref * np.sqrt(config_leveling["luminosity"] / luminosity_ref),
+            "max_PU": I_ref * np.sqrt(config_leveling["constraints"]["max_PU"] / PU_ref),
+            "max_intensity": float(config_leveling["constraints"]["max_intensity"]),
+        }
+        active_constraint = min(dic_intensities, key=dic_intensities.get)
+        I = dic_intensities[active_constraint]
+        print(
+            f"Leveling in IP 1/5 with I={I:.2e} particles per bunch (limited by"
+            f" {active_constraint})"
+        )
+        return I
+
     def f(I):
         luminosity = compute_lumi(I)
 
@@ -0,0 +1,209 @@
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+import argparse
+import contextlib
+import os
+import runpy
+import subprocess
+import sys
+import time
+import traceback
+
+import tree_maker
+
+try:
+    from mpi4py import MPI
+except ImportError:
+    MPI = None
+
+# Tags for the communication between the master and the workers
+TAG_READY = 1
+TAG_TASK = 2
+TAG_RESULT = 3
+
+
+# ==================================================================================================
+# --- Functions to get the nodes to run
+# ==================================================================================================
+def get_uncompleted_nodes_from_study(study_name, generation):
+    # Get the uncompleted nodes of a given generation of a study
+    fix = "/scans/" + study_name
+    root = tree_maker.tree_from_json(fix[1:] + "/tree_maker.json")
+    root.add_suffix(suffix=fix)
+    return [
+        node.get_abs_path()
+        for node in root.generation(generation)
+        if not node.has_been("completed")
+    ]
+
+
+def get_nodes_from_file(path_nodes_file):
+    # Get the nodes listed (one path per line) in a file
+    with open(path_nodes_file, "r") as fid:
+        return [line.strip() for line in fid if line.strip() != ""]
+
+
+def node_has_been_completed(path_node):
+    # Check the tree_maker log of the node
+    path_log = f"{path_node}/tree_maker.log"
+    if not os.path.isfile(path_log):
+        return False
+    return "completed" in tree_maker.tag_json.read_json(path_log)
+
+
+def get_node_executable(path_node):
+    # Get the python script executed by the run.sh of the node
+    with open(f"{path_node}/run.sh", "r") as fid:
+        for line in fid:
+            if line.startswith("python "):
+                executable = line.split(" ")[1]
+                return executable if os.path.isabs(executable) else f"{path_node}/{executable}"
+    raise ValueError(f"No python executable found in {path_node}/run.sh")
+
+
+# ==================================================================================================
+# --- Function to run a node
+# ==================================================================================================
+def get_node_cleanup_commands(path_node):
+    # Get the cleanup commands (removal of the temporary files) of the run.sh of the node
+    with open(f"{path_node}/run.sh", "r") as fid:
+        return [line.strip() for line in fid if line.startswith("rm ")]
+
+
+def purge_node_modules(path_node):
+    # Remove the modules imported from the node folder (e.g. misc.py), such that the next node
+    # imports its own copy instead of reusing a stale one
+    path_node = os.path.abspath(path_node)
+    for name, module in list(sys.modules.items()):
+        path_module = getattr(module, "__file__", None)
+        if path_module is not None and os.path.abspath(path_module).startswith(f"{path_node}/"):
+            del sys.modules[name]
+
+
+def run_node(path_node, in_process=False):
+    # Jobs completed in the meantime (e.g. by another runner) are skipped
+    if node_has_been_completed(path_node):
+        return path_node, True, 0.0
+
+    start = time.time()
+    if in_process:
+        # Run the job executable in the current python interpreter (saves the interpreter startup
+        # and the imports for each node), with the same outputs and cleanup as its run.sh. The job
+        # tags itself as started and completed.
+        path_executable = get_node_executable(path_node)
+        cwd = os.getcwd()
+        sys.path.insert(0, path_node)
+        try:
+            os.chdir(path_node)
+            with open("output_python.txt", "w") as fid_out, open(
+                "error_python.txt", "w"
+            ) as fid_err, contextlib.redirect_stdout(fid_out), contextlib.redirect_stderr(fid_err):
+                try:
+                    runpy.run_path(path_executable, run_name="__main__")
+                except KeyboardInterrupt:
+                    raise
+                except BaseException:
+                    # Including SystemExit, such that a job exiting doesn't stop the rank
+                    traceback.print_exc()
+                    print(f"Node {path_node} failed", file=sys.__stdout__)
+            for command in get_node_cleanup_commands(path_node):
+                subprocess.run(command, shell=True, cwd=path_node)
+        finally:
+            os.chdir(cwd)
+            sys.path.remove(path_node)
+            purge_node_modules(path_node)
+    else:
+        # Run the job as a subprocess, through its run.sh script
+        subprocess.run(["bash", f"{path_node}/run.sh"], cwd=path_node)
+
+    return path_node, node_has_been_completed(path_node), time.time() - start
+
+
+# ==================================================================================================
+# --- Functions for dynamic distribution of the nodes over the MPI ranks
+# ==================================================================================================
+def master(comm, l_nodes, in_process=False):
+    # Rank 0 distributes the nodes one by one, to the first worker that is ready
+    n_workers = comm.Get_size() - 1
+    l_results = []
+
+    # Run everything on rank 0 if there's no worker
+    if n_workers == 0:
+        return [run_node(path_node, in_process) for path_node in l_nodes]
+
+    idx_node = 0
+    n_workers_done = 0
+    status = MPI.Status()
+    while n_workers_done < n_workers:
+        result = comm.recv(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
+        if status.Get_tag() == TAG_RESULT:
+            l_results.append(result)
+            print(
+                f"Node {result[0]} {'completed' if result[1] else 'failed'} in {result[2]:.1f} s"
+                f" ({len(l_results)}/{len(l_nodes)})"
+            )
+            continue
+
+        # Worker is ready, send next node or None if there's nothing left to do
+        if idx_node < len(l_nodes):
+            comm.send(l_nodes[idx_node], dest=status.Get_source(), tag=TAG_TASK)
+            idx_node += 1
+        else:
+            comm.send(None, dest=status.Get_source(), tag=TAG_TASK)
+            n_workers_done += 1
+
+    return l_results
+
+
+def worker(comm, in_process=False):
+    while True:
+        comm.send(None, dest=0, tag=TAG_READY)
+        path_node = comm.recv(source=0, tag=TAG_TASK)
+        if path_node is None:
+            break
+        comm.send(run_node(path_node, in_process), dest=0, tag=TAG_RESULT)
+
+
+def run_nodes_mpi(l_nodes, in_process=False):
+    if MPI is None:
+        raise ImportError("mpi4py is required to run the nodes with MPI")
+    comm = MPI.COMM_WORLD
+    if comm.Get_rank() == 0:
+        print(f"Running {len(l_nodes)} nodes over {comm.Get_size()} ranks")
+        start = time.time()
+        l_results = master(comm, l_nodes, in_process)
+        n_completed = len([result for result in l_results if result[1]])
+        print(f"{n_completed}/{len(l_nodes)} nodes completed in {time.time() - start:.1f} s")
+    else:
+        worker(comm, in_process)
+
+
+# ==================================================================================================
+# --- Script for execution
+# ==================================================================================================
+# Run all the uncompleted nodes of a generation inside a single allocation, e.g. locally with:
+# mpirun -n 4 python mpi_runner.py --study example_tunescan --generation 2
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the nodes of a generation with MPI")
+    parser.add_argument("--study", help="Name of the study (in the scans folder)")
+    parser.add_argument("--generation", type=int, default=2, help="Generation to run")
+    parser.add_argument("--nodes-file", help="File listing the paths of the nodes to run")
+    parser.add_argument(
+        "--in-process",
+        action="store_true",
+        help="Run the jobs in the python interpreter of the rank instead of a subprocess",
+    )
+    args = parser.parse_args()
+
+    # Only rank 0 needs the list of nodes
+    l_nodes = []
+    if MPI is None or MPI.COMM_WORLD.Get_rank() == 0:
+        if args.nodes_file is not None:
+            l_nodes = get_nodes_from_file(args.nodes_file)
+        elif args.study is not None:
+            l_nodes = get_uncompleted_nodes_from_study(args.study, args.generation)
+        else:
+            raise ValueError("Either --study or --nodes-file must be provided")
+
+    run_nodes_mpi(l_nodes, in_process=args.in_process)
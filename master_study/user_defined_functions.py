@@ -21,6 +21,10 @@ def generate_run_sh_htc(node, generation_number):
     if generation_number == 1:
         # No need to move to HTC as gen 1 is never IO intensive
         return generate_run_sh(node, generation_number)
+    if node.parameters.get("mode") == "configure":
+        # The configured collider of a two-stage study is read by the children as soon as the node
+        # is tagged as completed, so it must be written in the node folder directly
+        return generate_run_sh(node, generation_number)
     if generation_number == 2:
         # Get local path and abs path to gen 2
         abs_path = node.get_abs_path()
@@ -32,7 +36,7 @@ def generate_run_sh_htc(node, generation_number):
 
         # Get paths to mutate
         path_collider = config["config_simulation"]["collider_file"]
-        path_particles = config["config_simulation"]["particle_file"]
+        path_particles = config["config_simulation"].get("particle_file") or ""
         path_log = config["log_file"]
         new_path_collider = f"{abs_path}/{path_collider}"
         new_path_particles = f"{abs_path}/{path_particles}"
@@ -46,6 +50,13 @@ def generate_run_sh_htc(node, generation_number):
         new_path_particles = new_path_particles.replace("/", "\/")
         new_path_log = new_path_log.replace("/", "\/")
 
+        # The particle file is absent if the node doesn't track any particle
+        sed_particles = (
+            f'sed -i "s/{path_particles}/{new_path_particles}/g" config.yaml\n'
+            if path_particles != ""
+            else ""
+        )
+
         # Return final run script
         return (
             f"#!/bin/bash\n"
@@ -58,15 +69,16 @@ def generate_run_sh_htc(node, generation_number):
             f"cd {local_path}\n"
             # Mutate the paths in config to be absolute
             f'sed -i "s/{path_collider}/{new_path_collider}/g" config.yaml\n'
-            f'sed -i "s/{path_particles}/{new_path_particles}/g" config.yaml\n'
+            f"{sed_particles}"
             f'sed -i "s/{path_log}/{new_path_log}/g" config.yaml\n'
             # Run the job
             f"python {node.get_abs_path()}/{python_command} > output_python.txt 2>"
             " error_python.txt\n"
             # Delete the config so it's not copied back
             f"rm -f ../config.yaml\n"
-            # Copy back output
-            f"cp -f *.txt *.parquet *.yaml {abs_path}\n"
+            # Copy back output (through a temporary file, such that each file is replaced atomically)
+            f'for f in *.txt *.parquet *.yaml *.json; do [ -e "$f" ] || continue; cp -f $f'
+            f" {abs_path}/$f.tmp && mv -f {abs_path}/$f.tmp {abs_path}/$f; done\n"
         )
 
     if generation_number >= 3:
@@ -0,0 +1,113 @@
+# ==================================================================================================
+# --- Fixtures loading the modules of the study (the job folders are not python packages)
+# ==================================================================================================
+import importlib.util
+import os
+import sys
+
+import pytest
+
+PATH_MASTER_STUDY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "master_study")
+PATH_GEN_1 = os.path.join(PATH_MASTER_STUDY, "master_jobs", "1_build_distr_and_collider")
+PATH_GEN_2 = os.path.join(PATH_MASTER_STUDY, "master_jobs", "2_configure_and_track")
+
+
+def load_module(name, relative_path):
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(PATH_MASTER_STUDY, relative_path)
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="session")
+def particle_distribution():
+    pytest.importorskip("scipy")
+    return load_module(
+        "particle_distribution", "master_jobs/1_build_distr_and_collider/particle_distribution.py"
+    )
+
+
+@pytest.fixture(scope="session")
+def chronjob():
+    pytest.importorskip("psutil")
+    pytest.importorskip("tree_maker")
+    return load_module("chronjob", "002_chronjob.py")
+
+
+@pytest.fixture(scope="session")
+def mpi_runner():
+    pytest.importorskip("tree_maker")
+    return load_module("mpi_runner", "mpi_runner.py")
+
+
+@pytest.fixture(scope="session")
+def misc():
+    pytest.importorskip("xtrack")
+    return load_module("misc", "master_jobs/2_configure_and_track/misc.py")
+
+
+@pytest.fixture
+def collider():
+    # Small collider with two FODO rings, the focusing of beam 2 being defined by an expression
+    xt = pytest.importorskip("xtrack")
+    env = xt.Environment()
+    env["kf"] = 0.05
+    env["kd"] = -0.05
+    env["on_knob"] = 1.0
+    env["kf_b2"] = "kf * on_knob"
+
+    def get_fodo(line_name, kf):
+        return env.new_line(
+            name=line_name,
+            components=[
+                env.new(f"qf_{line_name}", xt.Quadrupole, k1=kf, length=1.0),
+                env.new(f"d1_{line_name}", xt.Drift, length=5.0),
+                env.new(f"qd_{line_name}", xt.Quadrupole, k1="kd", length=1.0),
+                env.new(f"ms_{line_name}", xt.Multipole, knl=[0.0, 0.0, 0.1]),
+                env.new(f"ip_{line_name}", xt.Marker),
+                env.new(f"d2_{line_name}", xt.Drift, length=5.0),
+            ],
+        )
+
+    collider = xt.Multiline(
+        lines={"lhcb1": get_fodo("lhcb1", "kf"), "lhcb2": get_fodo("lhcb2", "kf_b2")}
+    )
+    for line_name in ["lhcb1", "lhcb2"]:
+        collider[line_name].particle_ref = xt.Particles(p0c=7e12)
+    collider.build_trackers()
+    return collider
+
+
+@pytest.fixture(scope="session")
+def collider_binary():
+    pytest.importorskip("xtrack")
+    return load_module(
+        "collider_binary", "master_jobs/1_build_distr_and_collider/collider_binary.py"
+    )
+
+
+@pytest.fixture(scope="session")
+def build_distr_and_collider():
+    for module_name in ["xmask", "cpymad", "tree_maker", "scipy"]:
+        pytest.importorskip(module_name)
+
+    # The script imports the other modules of its folder
+    sys.path.insert(0, PATH_GEN_1)
+    return load_module(
+        "build_distr_and_collider",
+        "master_jobs/1_build_distr_and_collider/1_build_distr_and_collider.py",
+    )
+
+
+@pytest.fixture(scope="session")
+def configure_and_track():
+    for module_name in ["xmask", "tree_maker", "ruamel.yaml"]:
+        pytest.importorskip(module_name)
+
+    # The script imports the other modules of its folder
+    sys.path.insert(0, PATH_GEN_2)
+    return load_module(
+        "configure_and_track", "master_jobs/2_configure_and_track/2_configure_and_track.py"
+    )
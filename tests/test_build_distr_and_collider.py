@@ -0,0 +1,223 @@
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+
+# ==================================================================================================
+# --- Fake MAD-X, recording the sequences built, loaded and saved
+# ==================================================================================================
+class FakeMadx:
+    def __init__(self, command_log=None):
+        self.command_log = command_log
+        self.l_built = []
+        self.l_loaded = []
+
+    def use(self, sequence):
+        pass
+
+    def twiss(self):
+        pass
+
+
+@pytest.fixture
+def fake_mad(build_distr_and_collider, monkeypatch, tmp_path):
+    # Sequences are "saved" as a file containing the beam and the steps applied
+    ost = build_distr_and_collider.ost
+
+    def build_sequence(mad, mylhcbeam, **kwargs_build):
+        mad.l_built.append(mylhcbeam)
+
+    def apply_optics(mad, optics_file):
+        mad.l_built.append(optics_file)
+
+    def save_sequence(mad, path_sequence, mylhcbeam):
+        with open(path_sequence, "w") as fid:
+            fid.write(" ".join(map(str, [mylhcbeam] + mad.l_built)))
+
+    def load_sequence(mad, path_sequence, mylhcbeam):
+        with open(path_sequence, "r") as fid:
+            mad.l_loaded.append(fid.read())
+
+    monkeypatch.setattr(build_distr_and_collider, "Madx", FakeMadx)
+    monkeypatch.setattr(ost, "build_sequence", build_sequence)
+    monkeypatch.setattr(ost, "apply_optics", apply_optics)
+    monkeypatch.setattr(ost, "save_sequence", save_sequence)
+    monkeypatch.setattr(ost, "load_sequence", load_sequence)
+    monkeypatch.chdir(tmp_path)
+    return build_distr_and_collider
+
+
+# ==================================================================================================
+# --- Parallel build of the sequences
+# ==================================================================================================
+def test_build_madx_sequences_parallel(fake_mad, monkeypatch):
+    # Threads instead of processes, such that the fake MAD-X is used by the workers
+    monkeypatch.setattr(fake_mad, "ProcessPoolExecutor", ThreadPoolExecutor)
+    config_mad = {"optics_file": "opt.madx"}
+    mad_b1b2, mad_b4 = fake_mad.build_madx_sequences_parallel(config_mad, sanity_checks=False)
+
+    # Each beam is built in its own worker, and reloaded from its own file
+    assert mad_b1b2.l_loaded == ["1 1 opt.madx"]
+    assert mad_b4.l_loaded == ["4 4 opt.madx"]
+    assert mad_b1b2.command_log == "mad_collider_load.log"
+    assert mad_b4.command_log == "mad_b4_load.log"
+
+    # Same sequences as the sequential build
+    mad_b1b2, mad_b4 = fake_mad.build_madx_sequences(config_mad, sanity_checks=False)
+    assert mad_b1b2.l_built == [1, "opt.madx"]
+    assert mad_b4.l_built == [4, "opt.madx"]
+
+
+# ==================================================================================================
+# --- Cache of the base collider
+# ==================================================================================================
+def test_collider_cache_key(build_distr_and_collider, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for folder in ["models_1", "models_2"]:
+        (tmp_path / folder / "toolkit").mkdir(parents=True)
+        for path in build_distr_and_collider.L_SEQUENCE_FILES:
+            (tmp_path / folder / path.split("/", 1)[1]).write_text(path)
+        (tmp_path / folder / "opt.madx").write_text("betx_ip1 = 0.15;")
+    config_mad = {"optics_file": "acc-models-lhc/opt.madx", "links": {"acc-models-lhc": "models_1"}}
+    key = build_distr_and_collider.get_collider_cache_key(config_mad)
+
+    # The location of the files doesn't matter, only their content
+    config_mad["links"] = {"acc-models-lhc": "models_2"}
+    assert build_distr_and_collider.get_collider_cache_key(config_mad) == key
+    (tmp_path / "models_2" / "opt.madx").write_text("betx_ip1 = 0.30;")
+    assert build_distr_and_collider.get_collider_cache_key(config_mad) != key
+
+    # But a change of configuration does
+    config_mad["links"] = {"acc-models-lhc": "models_1"}
+    config_mad["ver_hllhc_optics"] = 1.6
+    assert build_distr_and_collider.get_collider_cache_key(config_mad) != key
+
+    # And so does a new version of the xsuite packages
+    del config_mad["ver_hllhc_optics"]
+    monkeypatch.setattr(build_distr_and_collider.xt, "__version__", "0.0.0", raising=False)
+    assert build_distr_and_collider.get_collider_cache_key(config_mad) != key
+
+
+def test_collider_cache(build_distr_and_collider, tmp_path):
+    path_cache = str(tmp_path / "cache")
+    path_collider = str(tmp_path / "node" / "collider" / "collider.json")
+    path_collider_new = str(tmp_path / "node_new" / "collider" / "collider.json")
+    assert not build_distr_and_collider.get_collider_from_cache(path_cache, "key", path_collider)
+
+    # A collider added to the cache is shared with the next nodes
+    (tmp_path / "node" / "collider").mkdir(parents=True)
+    (tmp_path / "node" / "collider" / "collider.json").write_text("{}")
+    build_distr_and_collider.add_collider_to_cache(path_cache, "key", path_collider)
+    assert build_distr_and_collider.get_collider_from_cache(path_cache, "key", path_collider_new)
+    assert (tmp_path / "node_new" / "collider" / "collider.json").read_text() == "{}"
+    assert os.listdir(f"{path_cache}/key") == ["collider.json"]
+
+    # The least recently used colliders are evicted above the maximum size
+    for key in ["key_old", "key_new"]:
+        build_distr_and_collider.add_collider_to_cache(path_cache, key, path_collider)
+    os.utime(f"{path_cache}/key_old", (0, 0))
+    build_distr_and_collider.evict_collider_cache(path_cache, max_size_gb=4.5e-9)
+    assert sorted(os.listdir(path_cache)) == ["key", "key_new"]
+
+
+# ==================================================================================================
+# --- Cache of the sliced sequences
+# ==================================================================================================
+def test_sequence_cache(fake_mad, tmp_path):
+    path_sequence_cache = str(tmp_path / "sequence_cache")
+
+    # The first build of each beam is stored, the next ones are loaded
+    for mylhcbeam in [1, 4, 1]:
+        fake_mad.build_sequence_cached(FakeMadx(), mylhcbeam, path_sequence_cache)
+    mad = FakeMadx()
+    fake_mad.build_sequence_cached(mad, 4, path_sequence_cache)
+    assert mad.l_built == []
+    assert mad.l_loaded == ["4 4"]
+    assert len(os.listdir(path_sequence_cache)) == 2
+
+    # Sequences built with other options have their own entry
+    fake_mad.build_sequence_cached(FakeMadx(), 1, path_sequence_cache, ignore_cycling=True)
+    assert len(os.listdir(path_sequence_cache)) == 3
+
+
+# ==================================================================================================
+# --- Deferred sanity checks
+# ==================================================================================================
+def test_run_deferred_sanity_checks(build_distr_and_collider, collider, tmp_path, monkeypatch):
+    # The collider has no IP, so the report only contains the tunes, and fails for beam 2
+    def get_xsuite_lattice_report(line):
+        if line.element_names[0] == "qf_lhcb2":
+            raise ValueError("beam 2 is broken")
+        return {"qx": float(line.twiss(method="4d").qx)}
+
+    monkeypatch.setattr(build_distr_and_collider, "ProcessPoolExecutor", ThreadPoolExecutor)
+    monkeypatch.setattr(
+        build_distr_and_collider.ost, "get_xsuite_lattice_report", get_xsuite_lattice_report
+    )
+    path_collider = str(tmp_path / "collider.json")
+    path_report = str(tmp_path / "sanity_checks.json")
+    collider.to_json(path_collider)
+
+    # The checks are run on the collider loaded from file, and written to the report
+    dic_report = build_distr_and_collider.run_deferred_sanity_checks(path_collider, path_report)
+    with open(path_report, "r") as fid:
+        assert json.load(fid) == dic_report
+    assert dic_report["lhcb1"] == {
+        "passed": True,
+        "qx": pytest.approx(collider["lhcb1"].twiss(method="4d").qx),
+    }
+    assert dic_report["lhcb2"] == {"passed": False, "error": "beam 2 is broken"}
+    assert not dic_report["passed"]
+
+
+def test_sequence_and_optics_cache(fake_mad, tmp_path):
+    path_sequence_cache = str(tmp_path / "sequence_cache")
+    (tmp_path / "opt.madx").write_text("betx_ip1 = 0.15;")
+
+    # The sequence with optics is built once, and shared with the next jobs
+    for _ in range(2):
+        mad = FakeMadx()
+        fake_mad.build_sequence_and_optics_cached(mad, 1, "opt.madx", path_sequence_cache)
+    assert mad.l_built == []
+    assert mad.l_loaded == ["1 1 opt.madx"]
+
+    # A new optics reuses the sliced sequence
+    (tmp_path / "opt.madx").write_text("betx_ip1 = 0.30;")
+    mad = FakeMadx()
+    fake_mad.build_sequence_and_optics_cached(mad, 1, "opt.madx", path_sequence_cache)
+    assert mad.l_built == ["opt.madx"]
+    assert mad.l_loaded == ["1 1"]
+
+    # No temporary file is left behind
+    assert not any(".tmp" in filename for filename in os.listdir(path_sequence_cache))
+
+
+def test_sequence_and_optics_lock(fake_mad, tmp_path, monkeypatch):
+    # Concurrent seed jobs wait for the first one to build the sequence with optics
+    path_sequence_cache = str(tmp_path / "sequence_cache")
+    (tmp_path / "opt.madx").write_text("betx_ip1 = 0.15;")
+    apply_optics = fake_mad.ost.apply_optics
+
+    def apply_optics_slow(mad, optics_file):
+        time.sleep(0.5)
+        apply_optics(mad, optics_file)
+
+    monkeypatch.setattr(fake_mad.ost, "apply_optics", apply_optics_slow)
+    l_mads = [FakeMadx() for _ in range(4)]
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        l_futures = [
+            executor.submit(
+                fake_mad.build_sequence_and_optics_cached, mad, 1, "opt.madx", path_sequence_cache
+            )
+            for mad in l_mads
+        ]
+        for future in l_futures:
+            future.result()
+    assert sorted(len(mad.l_built) for mad in l_mads) == [0, 0, 0, 2]
+    assert sorted(len(mad.l_loaded) for mad in l_mads) == [0, 1, 1, 1]
@@ -0,0 +1,397 @@
+import types
+
+import pytest
+
+
+# ==================================================================================================
+# --- Sharing of the job budget between studies
+# ==================================================================================================
+def share_budget(chronjob, in_flight, pending, weights, priorities, max_jobs_in_flight):
+    l_studies = [f"study_{idx}" for idx in range(len(pending))]
+    dic_allocated = chronjob.share_budget(
+        dict(zip(l_studies, in_flight)),
+        dict(zip(l_studies, pending)),
+        dict(zip(l_studies, weights)),
+        dict(zip(l_studies, priorities)),
+        max_jobs_in_flight,
+    )
+    return [dic_allocated[study_name] for study_name in l_studies]
+
+
+def test_share_budget_weights(chronjob):
+    assert share_budget(chronjob, [0, 0], [100, 100], [1.0, 3.0], [0, 0], 40) == [10, 30]
+
+
+def test_share_budget_in_flight(chronjob):
+    # Jobs already in flight count towards the share of a study
+    assert share_budget(chronjob, [20, 0], [100, 100], [1.0, 1.0], [0, 0], 40) == [0, 20]
+
+
+def test_share_budget_pending(chronjob):
+    # Slots that can't be used by a study are given to the others
+    assert share_budget(chronjob, [0, 0], [5, 100], [1.0, 1.0], [0, 0], 40) == [5, 35]
+
+
+def test_share_budget_priorities(chronjob):
+    assert share_budget(chronjob, [0, 0, 0], [10, 100, 100], [1.0, 1.0, 1.0], [1, 0, 0], 30) == [
+        10,
+        10,
+        10,
+    ]
+    assert share_budget(chronjob, [0, 0], [100, 100], [1.0, 1.0], [1, 0], 30) == [30, 0]
+
+
+def test_share_budget_full(chronjob):
+    assert share_budget(chronjob, [30, 20], [100, 100], [1.0, 1.0], [0, 0], 40) == [0, 0]
+
+
+# ==================================================================================================
+# --- Generations to submit
+# ==================================================================================================
+class FakeNode:
+    # Minimal tree_maker node, with a path in the scans folder of a study
+    def __init__(self, completed=False, parent=None, parameters=None):
+        self.completed = completed
+        self.parent = parent
+        self.parameters = {} if parameters is None else parameters
+        self.children = []
+        self.name = "root"
+        if parent is not None:
+            self.name = f"node_{len(parent.children):02}"
+            parent.children.append(self)
+
+    def has_been(self, tag):
+        return tag == "completed" and self.completed
+
+    def get_abs_path(self):
+        if self.parent is None:
+            return "/home/master_study/scans/study"
+        return f"{self.parent.get_abs_path()}/{self.name}"
+
+
+class FakeRoot(FakeNode):
+    def __init__(self, n_generations):
+        super().__init__()
+        self.parameters = {"generations": {f"{idx}": {} for idx in range(1, n_generations + 1)}}
+
+    def generation(self, generation):
+        list_of_nodes = [self]
+        for _ in range(generation):
+            list_of_nodes = [child for node in list_of_nodes for child in node.children]
+        return list_of_nodes
+
+
+def test_generations_to_submit(chronjob):
+    # Two working points, only the first one being configured
+    root = FakeRoot(3)
+    node_gen_1 = FakeNode(completed=True, parent=root)
+    node_configured = FakeNode(completed=True, parent=node_gen_1)
+    node_configuring = FakeNode(parent=node_gen_1)
+    l_nodes_ready = [FakeNode(parent=node_configured) for _ in range(2)]
+    for _ in range(2):
+        FakeNode(parent=node_configuring)
+
+    # The tracking of the configured working point doesn't wait for the other one
+    assert chronjob.get_generations_to_submit(root) == [2, 3]
+    assert chronjob.get_ready_nodes(root, 3) == l_nodes_ready
+
+    # Nothing is submitted once all the nodes are completed
+    for node in [node_configuring] + root.generation(3):
+        node.completed = True
+    assert chronjob.get_generations_to_submit(root) == []
+
+
+def test_generations_to_submit_first_generation(chronjob):
+    root = FakeRoot(2)
+    node_gen_1 = FakeNode(parent=root)
+    FakeNode(parent=node_gen_1)
+    assert chronjob.get_generations_to_submit(root) == [1]
+
+
+def test_count_jobs_in_flight(chronjob, tmp_path):
+    # Each copy of a job counts, and MPI batches count for the nodes of the study they run
+    path_batch = tmp_path / "second_generation.sub"
+    (tmp_path / "second_generation.sub.nodes").write_text(
+        "/a/master_study/scans/study_1/base_collider/xtrack_0000\n"
+        "/a/master_study/scans/study_1/base_collider/xtrack_0001\n"
+        "/a/master_study/scans/study_2/base_collider/xtrack_0000\n"
+    )
+    l_jobs = [
+        "/scans/study_1/base_collider/xtrack_0002/",
+        "/scans/study_1/base_collider/xtrack_0002/",
+        "/scans/study_2/base_collider/xtrack_0001/",
+        f"mpi_batch:{path_batch}",
+    ]
+    assert chronjob.count_jobs_in_flight(l_jobs, "study_1") == 4
+    assert chronjob.count_jobs_in_flight(l_jobs, "study_2") == 2
+
+
+def test_load_studies_weights(chronjob, monkeypatch):
+    class FakeStudyRoot:
+        def add_suffix(self, suffix):
+            pass
+
+    monkeypatch.setattr(
+        chronjob, "tree_maker", types.SimpleNamespace(tree_from_json=lambda path: FakeStudyRoot())
+    )
+    dic_roots = chronjob.load_studies({"study_1": {"weight": 2}, "study_2": {}})
+    assert [dic_roots[study]["weight"] for study in ["study_1", "study_2"]] == [2.0, 1.0]
+    with pytest.raises(ValueError):
+        chronjob.load_studies({"study_1": {"weight": 0}})
+
+
+# ==================================================================================================
+# --- Cost of the jobs
+# ==================================================================================================
+def test_estimate_node_cost(chronjob, tmp_path):
+    pd = pytest.importorskip("pandas")
+    pd.DataFrame(
+        {"normalized amplitude in xy-plane": [2.0, 2.0, 10.0, 10.0], "split": [0, 0, 1, 1]}
+    ).to_parquet(tmp_path / "particles.parquet")
+    dic_amplitudes = {}
+    l_costs = []
+    for idx_split in [0, 1]:
+        config_simulation = {
+            "n_turns": 1000,
+            "particle_file": str(tmp_path / "particles.parquet"),
+            "particle_split": idx_split,
+        }
+        node = FakeNode(parameters={"config_simulation": config_simulation})
+        l_costs.append(chronjob.estimate_node_cost(node, {}, dic_amplitudes))
+
+    # The surviving (low-amplitude) particles are the most expensive, and the file is read once
+    assert l_costs[0] == pytest.approx(2000, rel=1e-2)
+    assert l_costs[1] < 0.1 * l_costs[0]
+    assert list(dic_amplitudes) == [str(tmp_path / "particles.parquet")]
+
+    # Without readable particles, the cost is the number of turns
+    node = FakeNode(parameters={"config_simulation": {"n_turns": 1000, "particle_file": None}})
+    assert chronjob.estimate_node_cost(node, {}, {}) == 1000.0
+    assert chronjob.estimate_node_cost(FakeNode(), {}, {}) == 0.0
+
+
+def test_sort_nodes_by_cost(chronjob, monkeypatch):
+    # Two parents whose jobs have the same model cost, but run at different speeds
+    root = FakeRoot(2)
+    parent_slow = FakeNode(completed=True, parent=root)
+    parent_fast = FakeNode(completed=True, parent=root)
+    dic_runtimes = {}
+    for parent, runtime in [(parent_slow, 100.0), (parent_fast, 10.0)]:
+        for n_turns in [1000, 2000]:
+            FakeNode(parent=parent, parameters={"config_simulation": {"n_turns": n_turns}})
+        node_completed = FakeNode(
+            completed=True, parent=parent, parameters={"config_simulation": {"n_turns": 1000}}
+        )
+        dic_runtimes[node_completed.get_abs_path()] = runtime
+    monkeypatch.setattr(
+        chronjob, "get_node_runtime", lambda node: dic_runtimes.get(node.get_abs_path())
+    )
+
+    # The model cost is calibrated with the runtime of the completed siblings
+    l_nodes_sorted = chronjob.sort_nodes_by_cost(root.generation(2), {})
+    assert [node.get_abs_path().split("/study/")[1] for node in l_nodes_sorted[:4]] == [
+        "node_00/node_01",
+        "node_00/node_00",
+        "node_00/node_02",
+        "node_01/node_01",
+    ]
+
+
+# ==================================================================================================
+# --- Stragglers
+# ==================================================================================================
+class FakeClusterSubmission:
+    # Records the cancelled and submitted jobs instead of calling the scheduler
+    run_on = "htc"
+
+    def __init__(self, running_jobs, dic_id_to_job, get_path_job):
+        self.running_jobs = running_jobs
+        self.dic_id_to_job = dic_id_to_job
+        self._get_path_job = get_path_job
+        self.l_cancelled = []
+        self.l_submitted = []
+
+    def _get_state_jobs(self, verbose=False):
+        return self.running_jobs, []
+
+    def cancel(self, l_ids):
+        self.l_cancelled += l_ids
+
+    def write_sub_files(self, l_nodes, path_file, force=False):
+        return [path_file], [self._get_path_job(node.get_abs_path()) for node in l_nodes]
+
+    def submit(self, l_filenames, l_path_jobs):
+        self.l_submitted += l_path_jobs
+
+
+@pytest.fixture
+def stragglers(chronjob, monkeypatch):
+    # Three siblings completed in 100 s, one completed but with two copies still running, and
+    # three running jobs: a straggler, a recent one, and a straggler already duplicated
+    root = FakeRoot(2)
+    parent = FakeNode(completed=True, parent=root)
+    l_nodes = [FakeNode(completed=idx < 4, parent=parent) for idx in range(7)]
+    get_path_job = chronjob.ClusterSubmission._get_path_job
+    l_path_jobs = [get_path_job(node.get_abs_path()) for node in l_nodes]
+    dic_id_to_job = {
+        "1.0": l_path_jobs[3],
+        "2.0": l_path_jobs[3],
+        "3.0": l_path_jobs[4],
+        "4.0": l_path_jobs[5],
+        "5.0": l_path_jobs[6],
+        "6.0": l_path_jobs[6],
+    }
+    cluster_submission = FakeClusterSubmission(l_path_jobs[3:], dic_id_to_job, get_path_job)
+
+    now = chronjob.time.time()
+    dic_elapsed = {l_path_jobs[4]: 1000.0, l_path_jobs[5]: 100.0, l_path_jobs[6]: 1000.0}
+    monkeypatch.setattr(
+        chronjob,
+        "get_node_tag_time",
+        lambda node, tag: now - dic_elapsed.get(get_path_job(node.get_abs_path()), 0.0),
+    )
+    monkeypatch.setattr(
+        chronjob, "get_node_runtime", lambda node: 100.0 if node.has_been("completed") else None
+    )
+    return root, cluster_submission, l_path_jobs
+
+
+def test_cancel_redundant_copies(chronjob, stragglers):
+    root, cluster_submission, _ = stragglers
+    chronjob.cancel_redundant_copies(root, 2, cluster_submission)
+    assert cluster_submission.l_cancelled == ["1.0", "2.0"]
+    assert cluster_submission.l_submitted == []
+
+
+def test_handle_stragglers(chronjob, stragglers):
+    root, cluster_submission, l_path_jobs = stragglers
+    chronjob.handle_stragglers(root, 2, cluster_submission, "first_generation.sub")
+    assert cluster_submission.l_cancelled == ["1.0", "2.0"]
+    assert cluster_submission.l_submitted == [l_path_jobs[4]]
+
+    # Not enough completed siblings to estimate the runtime
+    cluster_submission.l_submitted = []
+    chronjob.handle_stragglers(root, 2, cluster_submission, "first_generation.sub", min_siblings=5)
+    assert cluster_submission.l_submitted == []
+
+    # No room left in the budget of jobs
+    chronjob.handle_stragglers(
+        root, 2, cluster_submission, "first_generation.sub", max_duplicates=0
+    )
+    assert cluster_submission.l_submitted == []
+
+    # Jobs without id can't be tracked
+    cluster_submission.run_on = "local_pc"
+    cluster_submission.l_cancelled = []
+    chronjob.handle_stragglers(root, 2, cluster_submission, "first_generation.sub")
+    assert cluster_submission.l_cancelled == []
+
+
+# ==================================================================================================
+# --- Federated submission
+# ==================================================================================================
+def get_federated_config(**dic_backends):
+    return {"run_on": "federated", "context": "cpu", "backends": dic_backends}
+
+
+def test_federated_split(chronjob, tmp_path, monkeypatch):
+    config = get_federated_config(htc={"max_jobs": 4}, slurm={"max_jobs": 2})
+    federated_submission = chronjob.FederatedSubmission(config, str(tmp_path))
+    root = FakeRoot(1)
+    l_nodes = [FakeNode(parent=root) for _ in range(6)]
+
+    # Without history, the backends share the jobs in proportion to their free slots
+    dic_state = {"htc": (["job_running"], []), "slurm": ([], [])}
+    dic_nodes = federated_submission.split_nodes(l_nodes, l_nodes, dic_state)
+    assert dic_nodes == {"htc": l_nodes[:3], "slurm": l_nodes[3:5]}
+
+    # With as many free slots, a backend twice as fast gets twice as many jobs, and the most
+    # expensive ones
+    l_completed = [FakeNode(completed=True, parent=root) for _ in range(2)]
+    federated_submission.job_store = {
+        federated_submission._get_path_job(node.get_abs_path()): {"backend": backend}
+        for node, backend in zip(l_completed, ["htc", "slurm"])
+    }
+    dic_runtimes = {node.get_abs_path(): runtime for node, runtime in zip(l_completed, [20, 10])}
+    monkeypatch.setattr(
+        chronjob, "get_node_runtime", lambda node: dic_runtimes[node.get_abs_path()]
+    )
+    dic_state = {"htc": (["job"] * 2, []), "slurm": ([], [])}
+    dic_nodes = federated_submission.split_nodes(l_nodes + l_completed, l_nodes[:3], dic_state)
+    assert dic_nodes == {"slurm": l_nodes[:2], "htc": l_nodes[2:3]}
+
+    # Nothing is submitted when all the backends are full
+    dic_state = {"htc": ([], ["job"] * 4), "slurm": (["job"] * 2, [])}
+    dic_nodes = federated_submission.split_nodes(l_nodes, l_nodes, dic_state)
+    assert dic_nodes == {"htc": [], "slurm": []}
+
+
+def test_federated_config(chronjob, tmp_path):
+    with pytest.raises(ValueError):
+        chronjob.FederatedSubmission(
+            get_federated_config(htc={"max_jobs": 4, "context": "cupy"}), str(tmp_path)
+        )
+    with pytest.raises(ValueError):
+        chronjob.FederatedSubmission(
+            get_federated_config(htc={"run_on": "federated"}), str(tmp_path)
+        )
+
+    # Each backend has its own file of job ids
+    federated_submission = chronjob.FederatedSubmission(
+        get_federated_config(htc={}, slurm={"max_jobs": 10}), str(tmp_path)
+    )
+    assert federated_submission.dic_max_jobs == {"htc": 100, "slurm": 10}
+    assert federated_submission.dic_cluster_submission["slurm"].path_dic_id_to_job == (
+        f"{tmp_path}/id_job_slurm.yaml"
+    )
+
+
+# ==================================================================================================
+# --- MPI submission
+# ==================================================================================================
+def test_write_sub_file_mpi(chronjob, tmp_path):
+    config = {"run_on": "slurm_mpi", "context": "cpu", "mpi_ntasks": 8}
+    cluster_submission = chronjob.ClusterSubmission(config, str(tmp_path))
+    root = FakeRoot(1)
+    l_nodes = [FakeNode(completed=idx == 0, parent=root) for idx in range(4)]
+    running_jobs = [cluster_submission._get_path_job(l_nodes[1].get_abs_path())]
+
+    # A single submission file for the uncompleted nodes not already running
+    filename = str(tmp_path / "first_generation.sub")
+    l_filenames, l_path_jobs = cluster_submission._write_sub_files(
+        filename, running_jobs, [], l_nodes
+    )
+    assert l_filenames == [filename]
+    assert l_path_jobs == [f"mpi_batch:{filename}"]
+    with open(f"{filename}.nodes", "r") as fid:
+        assert fid.read().split() == [node.get_abs_path() for node in l_nodes[2:]]
+    with open(filename, "r") as fid:
+        content = fid.read()
+    assert "#SBATCH --ntasks=8" in content
+    assert f"--nodes-file {filename}.nodes" in content
+
+    # The batch is not submitted again while in flight
+    assert cluster_submission._write_sub_files(filename, l_path_jobs, [], l_nodes) == ([], [])
+
+
+def test_run_node_in_process(mpi_runner, tmp_path, monkeypatch):
+    # Two nodes with their own copy of a helper module, and a temporary file removed by run.sh
+    monkeypatch.setattr(mpi_runner, "node_has_been_completed", lambda path_node: False)
+    for idx, path_node in enumerate([tmp_path / "node_00", tmp_path / "node_01"]):
+        path_node.mkdir()
+        (path_node / "run.sh").write_text(
+            f"#!/bin/bash\ncd {path_node}\npython job.py > output_python.txt\nrm -rf tmp_file\n"
+        )
+        (path_node / "helper_node.py").write_text(f"VALUE = {idx}\n")
+        (path_node / "job.py").write_text(
+            "import helper_node\n"
+            "open('tmp_file', 'w').close()\n"
+            "open('result.txt', 'w').write(str(helper_node.VALUE))\n"
+        )
+        assert mpi_runner.get_node_cleanup_commands(str(path_node)) == ["rm -rf tmp_file"]
+        mpi_runner.run_node(str(path_node), in_process=True)
+
+        # Each node imports its own module, and the cleanup of run.sh is done
+        assert (path_node / "result.txt").read_text() == str(idx)
+        assert not (path_node / "tmp_file").exists()
+    assert "helper_node" not in mpi_runner.sys.modules
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+
+# ==================================================================================================
+# --- Binary collider format
+# ==================================================================================================
+def test_round_trip(collider_binary, collider, tmp_path):
+    path_collider = str(tmp_path / "collider.npz")
+    collider_binary.save_collider_binary(collider, path_collider)
+    collider_loaded = collider_binary.load_collider_binary(path_collider)
+
+    # The elements are stored in tables, not in the json skeleton
+    with np.load(path_collider) as data:
+        assert len(data.files) > 1
+        assert b"qf_lhcb1" in data["skeleton"].tobytes()
+
+    for line_name in ["lhcb1", "lhcb2"]:
+        line = collider[line_name]
+        line_loaded = collider_loaded[line_name]
+        assert list(line_loaded.element_names) == list(line.element_names)
+        for element_name in line.element_names:
+            dic_element = line[element_name].to_dict()
+            dic_element_loaded = line_loaded[element_name].to_dict()
+            assert dic_element_loaded.keys() == dic_element.keys()
+            for key, value in dic_element.items():
+                if isinstance(value, (str, dict)):
+                    assert dic_element_loaded[key] == value
+                else:
+                    np.testing.assert_array_equal(dic_element_loaded[key], value)
+
+    # The expressions are kept
+    collider_loaded.build_trackers()
+    tw = collider.lhcb2.twiss(method="4d")
+    tw_loaded = collider_loaded.lhcb2.twiss(method="4d")
+    assert tw_loaded.qx == pytest.approx(tw.qx)
+    collider_loaded.vars["on_knob"] = 1.02
+    assert collider_loaded.lhcb2.twiss(method="4d").qx != pytest.approx(tw.qx)
+
+
+def test_element_owners(collider_binary):
+    # Elements shared by the lines (environment) or stored per line (older xtrack versions)
+    dic_env = {"elements": {}, "lines": {"lhcb1": {"element_names": []}}}
+    dic_per_line = {"lines": {"lhcb1": {"elements": {}}, "lhcb2": {"elements": {}}}}
+    assert [prefix for prefix, _ in collider_binary._get_element_owners(dic_env)] == ["elements"]
+    assert [prefix for prefix, _ in collider_binary._get_element_owners(dic_per_line)] == [
+        "lines.lhcb1",
+        "lines.lhcb2",
+    ]
+
+
+def test_group_elements(collider_binary):
+    dic_elements = {
+        "q1": {"__class__": "Quadrupole", "k1": 0.1, "length": 1.0},
+        "q2": {"__class__": "Quadrupole", "k1": 0.2, "length": 1.0},
+        "m1": {"__class__": "Multipole", "knl": [0.0, 0.1], "name": "m"},
+        "m2": {"__class__": "Multipole", "knl": [0.0, 0.1, 0.2], "name": "m"},
+    }
+    l_groups = collider_binary._group_elements(dic_elements)
+    assert [group["names"] for group in l_groups] == [["q1", "q2"], ["m1"], ["m2"]]
+    assert l_groups[0]["columns"]["k1"] == [0.1, 0.2]
+    assert l_groups[1]["others"] == [{"__class__": "Multipole", "name": "m"}]
@@ -0,0 +1,91 @@
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+import shutil
+
+import pytest
+
+from conftest import PATH_GEN_1
+
+config_particles = {"r_min": 2.0, "r_max": 10.0, "n_r": 16, "n_angles": 5, "n_split": 4}
+
+
+# ==================================================================================================
+# --- Storage of the particle distribution
+# ==================================================================================================
+@pytest.mark.parametrize(
+    "storage, particle_file",
+    [
+        ("split_files", "particles/02.parquet"),
+        ("single_file", "particles/particles.parquet"),
+        ("generator", "particles/distribution.yaml"),
+    ],
+)
+def test_particle_storage(
+    build_distr_and_collider, configure_and_track, tmp_path, monkeypatch, storage, particle_file
+):
+    # Generation 1 writes the distribution in the node folder, next to the generator module
+    monkeypatch.chdir(tmp_path)
+    shutil.copy(f"{PATH_GEN_1}/particle_distribution.py", tmp_path)
+    config = {**config_particles, "storage": storage}
+    particle_list = build_distr_and_collider.build_particle_distribution(config)
+    build_distr_and_collider.write_particle_distribution(particle_list, config)
+
+    # Each tracking job reads (or regenerates) its own chunk only
+    config_sim = {"particle_file": str(tmp_path / particle_file)}
+    if storage != "split_files":
+        config_sim["particle_split"] = 2
+    particle_df = configure_and_track.load_particle_distribution(config_sim)
+    assert particle_df.reset_index(drop=True).equals(particle_list[2])
+
+
+def test_unknown_particle_storage(build_distr_and_collider, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    config = {**config_particles, "storage": "unknown"}
+    particle_list = build_distr_and_collider.build_particle_distribution(config)
+    with pytest.raises(ValueError):
+        build_distr_and_collider.write_particle_distribution(particle_list, config)
+
+
+# ==================================================================================================
+# --- Beam-beam lenses installed in the base collider
+# ==================================================================================================
+config_beambeam = {
+    "num_long_range_encounters_per_side": {"ip1": 25, "ip2": 20, "ip5": 25, "ip8": 20},
+    "num_slices_head_on": 11,
+    "bunch_spacing_buckets": 10,
+    "sigma_z": 0.0761,
+}
+
+
+def test_beam_beam_lenses_reuse(
+    build_distr_and_collider, configure_and_track, collider, tmp_path, monkeypatch
+):
+    # The collider has no IP, so only the calls to the installation of the lenses are recorded
+    l_installations = []
+    monkeypatch.setattr(
+        collider,
+        "install_beambeam_interactions",
+        lambda **kwargs: l_installations.append(kwargs),
+        raising=False,
+    )
+    config_collider = {"config_beambeam": {**config_beambeam, "num_particles_per_bunch": 1.4e11}}
+
+    # Without lenses in the base collider, they are installed by the second generation
+    configure_and_track.install_beam_beam(collider, config_collider)
+    assert len(l_installations) == 1
+
+    # Lenses installed in the base collider are recorded in the metadata, which is saved with it
+    build_distr_and_collider.install_beam_beam_lenses(collider, config_beambeam)
+    collider.to_json(tmp_path / "collider.json")
+    collider_loaded = pytest.importorskip("xtrack").Multiline.from_json(tmp_path / "collider.json")
+    assert collider_loaded.metadata["beam_beam_lenses"] == config_beambeam
+
+    # They are not installed again by the second generation, unless the parameters differ
+    assert configure_and_track.install_beam_beam(collider_loaded, config_collider)[0] is (
+        collider_loaded
+    )
+    assert len(l_installations) == 2
+    config_collider["config_beambeam"]["num_slices_head_on"] = 5
+    with pytest.raises(ValueError):
+        configure_and_track.install_beam_beam(collider_loaded, config_collider)
@@ -0,0 +1,241 @@
+import numpy as np
+import pytest
+
+conf_knobs_and_tuning = {
+    "qx": {"lhcb1": 62.31, "lhcb2": 62.31},
+    "qy": {"lhcb1": 60.32, "lhcb2": 60.32},
+    "dqx": {"lhcb1": 15.0, "lhcb2": 15.0},
+    "dqy": {"lhcb1": 15.0, "lhcb2": 15.0},
+}
+
+
+# ==================================================================================================
+# --- Warm start of the matching
+# ==================================================================================================
+def test_vars_diff(misc):
+    dic_vars_ref = {"a": 1.0, "b": 2.0}
+    assert misc.get_vars_diff(dic_vars_ref, {"a": 1.0, "b": 3.0, "c": 0.0}) == {"b": 3.0, "c": 0.0}
+    assert misc.get_vars_diff(dic_vars_ref, dic_vars_ref) == {}
+
+
+def test_load_knob_solution_nearest(misc, tmp_path):
+    working_point = misc.get_working_point(conf_knobs_and_tuning)
+    assert misc.load_knob_solution(str(tmp_path / "missing"), "sig", working_point) is None
+
+    # A tune shift of 1e-3 is as far as a unit of chromaticity
+    for idx, shift in enumerate([[2e-3, 0, 0, 0], [0, 0, 1.5, 0], [0, 0, 0, 0.5]]):
+        misc.save_knob_solution(
+            str(tmp_path), "sig", working_point + np.array(shift * 2), {"knob": idx}
+        )
+    misc.save_knob_solution(str(tmp_path), "other", working_point, {"knob": -1})
+    assert misc.load_knob_solution(str(tmp_path), "sig", working_point) == {"knob": 2}
+    assert misc.load_knob_solution(str(tmp_path), "other", working_point) == {"knob": -1}
+
+
+# ==================================================================================================
+# --- Knob response matrix
+# ==================================================================================================
+def test_predict_knob_changes(misc):
+    rng = np.random.default_rng(0)
+    response_matrix = np.eye(5, 6) + 0.1 * rng.standard_normal((5, 6))
+    observables = np.array([62.30, 60.31, 10.0, 12.0, 0.01])
+    targets = {"qx": 62.31, "qy": 60.32, "dqx": 15.0, "dqy": 15.0}
+
+    # The predicted changes cancel the residuals of the linear model, coupling being left apart
+    dic_knob_changes = misc.predict_knob_changes(response_matrix, observables, targets)
+    assert list(dic_knob_changes) == misc.L_RESPONSE_KNOBS[:4]
+    knob_changes = np.array(list(dic_knob_changes.values()))
+    observables_predicted = observables[:4] + response_matrix[:4, :4] @ knob_changes
+    assert np.allclose(observables_predicted, [62.31, 60.32, 15.0, 15.0])
+    assert misc.check_response_observables(
+        np.append(observables_predicted, 0.0), targets, check_coupling=True
+    )
+    assert not misc.check_response_observables(observables, targets, check_coupling=False)
+
+
+# ==================================================================================================
+# --- Cache of the configuration stages
+# ==================================================================================================
+dic_stage_inputs = {
+    "tuning": {"qx": 62.31},
+    "leveling": {"luminosity": 2e34},
+    "coupling": {"c_minus": 0.0},
+    "rematch": {"qx": 62.31},
+}
+
+
+def test_stage_keys_downstream(misc):
+    dic_stage_keys = misc.get_stage_keys(dic_stage_inputs)
+    assert list(dic_stage_keys) == misc.L_STAGES
+    assert misc.get_stage_keys(dic_stage_inputs) == dic_stage_keys
+
+    # Identical inputs give different keys for different stages
+    assert dic_stage_keys["tuning"] != dic_stage_keys["rematch"]
+
+    # Changing the inputs of a stage changes its key and the ones downstream only
+    dic_stage_keys_changed = misc.get_stage_keys(
+        {**dic_stage_inputs, "leveling": {"luminosity": 1e34}}
+    )
+    assert dic_stage_keys_changed["tuning"] == dic_stage_keys["tuning"]
+    for stage in ["leveling", "coupling", "rematch"]:
+        assert dic_stage_keys_changed[stage] != dic_stage_keys[stage]
+
+
+def test_n_stages_cached(misc, tmp_path):
+    dic_stage_keys = misc.get_stage_keys(dic_stage_inputs)
+    assert misc.get_n_stages_cached(str(tmp_path), dic_stage_keys) == 0
+
+    # Only consecutive stages from the first one are used
+    for stage in ["tuning", "leveling", "rematch"]:
+        (tmp_path / f"{stage}_{dic_stage_keys[stage]}.json").write_text("{}")
+    assert misc.get_n_stages_cached(str(tmp_path), dic_stage_keys) == 2
+
+
+def test_update_nested(misc):
+    dic = {"a": {"b": 1, "c": {"d": 2}}, "e": 3}
+    misc.update_nested(dic, {"a": {"c": {"d": 4, "f": 5}}, "e": {"g": 6}})
+    assert dic == {"a": {"b": 1, "c": {"d": 4, "f": 5}}, "e": {"g": 6}}
+
+
+# ==================================================================================================
+# --- Snapshots of the variables and twiss cache
+# ==================================================================================================
+def test_vars_snapshot(misc, collider):
+    dic_vars = misc.get_vars_snapshot(collider)
+    assert dic_vars["kf"] == 0.05 and dic_vars["on_knob"] == 1.0
+    assert "kf_b2" not in dic_vars
+
+    # Dependent variables are not overwritten by a snapshot
+    collider.vars["kf"] = 0.051
+    misc.apply_vars_snapshot(collider, {**dic_vars, "kf_b2": 0.0})
+    assert misc.get_vars_snapshot(collider) == dic_vars
+    assert collider.vars["kf_b2"]._value == pytest.approx(0.05)
+
+
+def test_merge_vars_diffs(misc, collider):
+    misc.merge_vars_diffs(collider, [{"kf": 0.051, "kf_b2": 0.0}, {"kf": 0.051, "on_knob": 0.9}])
+    assert collider.vars["kf"]._value == 0.051
+    assert collider.vars["kf_b2"]._value == pytest.approx(0.051 * 0.9)
+
+    # The workers must not set the same variable to different values
+    with pytest.raises(ValueError):
+        misc.merge_vars_diffs(collider, [{"kf": 0.05}, {"kf": 0.052}])
+
+
+def test_twiss_cache(misc, collider):
+    twiss_cache = misc.TwissCache()
+    tw_b1, tw_b2 = twiss_cache.twiss_beams(collider, method="4d")
+    assert tw_b1.qx == pytest.approx(tw_b2.qx)
+    assert twiss_cache.twiss(collider, "lhcb1", method="4d") is tw_b1
+    assert (twiss_cache.n_hits, twiss_cache.n_misses) == (1, 2)
+
+    # A change of any variable invalidates the cached twiss
+    collider.vars["on_knob"] = 1.02
+    tw_b1_new, tw_b2_new = twiss_cache.twiss_beams(collider, method="4d")
+    assert tw_b1_new.qx == pytest.approx(tw_b1.qx)
+    assert tw_b2_new.qx != pytest.approx(tw_b2.qx)
+    assert twiss_cache.n_misses == 4
+
+    # Without any change, the twiss are reused, also when computed in parallel
+    twiss_cache.parallel_beams = True
+    assert twiss_cache.twiss_beams(collider, method="4d") == [tw_b1_new, tw_b2_new]
+
+
+# ==================================================================================================
+# --- Reuse of the leveling jacobians
+# ==================================================================================================
+def get_bump_match(x_target):
+    # Small line with two orbit correctors, matching the orbit at a marker
+    xt = pytest.importorskip("xtrack")
+    env = xt.Environment()
+    env["k1"] = 0.0
+    env["k2"] = 0.0
+    line = env.new_line(
+        components=[
+            env.new("d0", xt.Drift, length=1.0),
+            env.new("c1", xt.Multipole, knl=["k1"]),
+            env.new("d1", xt.Drift, length=2.0),
+            env.new("c2", xt.Multipole, knl=["k2"]),
+            env.new("d2", xt.Drift, length=3.0),
+            env.new("m", xt.Marker),
+            env.new("d3", xt.Drift, length=1.0),
+        ]
+    )
+    line.particle_ref = xt.Particles(p0c=7e12)
+    opt = line.match(
+        solve=False,
+        start="d0",
+        end="d3",
+        init_at=xt.START,
+        betx=1.0,
+        bety=1.0,
+        x=0.0,
+        px=0.0,
+        vary=xt.VaryList(["k1", "k2"], step=1e-6),
+        targets=[xt.TargetSet(x=x_target, px=0.0, at="m", tol=1e-9)],
+    )
+    return line, opt
+
+
+def test_solve_leveling_match(misc, tmp_path):
+    line, opt = get_bump_match(1e-3)
+    assert misc.solve_leveling_match(opt, "bump", str(tmp_path)) == "new jacobian"
+    assert misc.targets_within_tol(opt)
+    assert (tmp_path / "leveling_bump.json").is_file()
+
+    # The jacobian is reused (from the folder) for another target of the same family
+    misc.dic_leveling_jacobians.clear()
+    line, opt = get_bump_match(2e-3)
+    assert misc.solve_leveling_match(opt, "bump", str(tmp_path)) == "stored jacobian"
+    tw = line.twiss(start="d0", end="d3", init_at="d0", betx=1.0, bety=1.0)
+    assert tw["x", "m"] == pytest.approx(2e-3, abs=1e-9)
+    assert tw["px", "m"] == pytest.approx(0.0, abs=1e-9)
+
+
+# ==================================================================================================
+# --- Leveling in IP 1/5
+# ==================================================================================================
+@pytest.fixture
+def leveling_ip1_5(misc, collider, monkeypatch):
+    # The collider has no IP, so the luminosity is taken exactly quadratic in the intensity
+    tw_b1, tw_b2 = [collider[beam].twiss(method="4d") for beam in ["lhcb1", "lhcb2"]]
+    monkeypatch.setattr(
+        misc.twiss_cache, "twiss_beams", lambda collider, l_beams, **kwargs: (tw_b1, tw_b2)
+    )
+    monkeypatch.setattr(
+        misc.xt.lumi,
+        "luminosity_from_twiss",
+        lambda num_particles_per_bunch, **kwargs: 2e34 * (num_particles_per_bunch / 1e11) ** 2,
+    )
+
+    def get_intensity(method, max_PU=1e3, max_intensity=2.3e11):
+        config_leveling = {
+            "method": method,
+            "num_colliding_bunches": 2748,
+            "luminosity": 5e34,
+            "constraints": {"max_PU": max_PU, "max_intensity": max_intensity},
+        }
+        config_collider = {"config_lumi_leveling_ip1_5": config_leveling}
+        config_bb = {"nemitt_x": 2.5e-6, "nemitt_y": 2.5e-6, "sigma_z": 0.076}
+        return misc.luminosity_leveling_ip1_5(collider, config_collider, config_bb)
+
+    return get_intensity, tw_b1["T_rev0"]
+
+
+def test_leveling_ip1_5_analytical(misc, leveling_ip1_5):
+    get_intensity, T_rev0 = leveling_ip1_5
+
+    # Limited by the luminosity target
+    I_lumi = 1e11 * np.sqrt(5 / 2)
+    assert get_intensity("analytical") == pytest.approx(I_lumi)
+
+    # Limited by the pile-up, or the maximum intensity
+    PU_lumi = misc.compute_PU(5e34, 2748, T_rev0)
+    assert get_intensity("analytical", max_PU=PU_lumi / 4) == pytest.approx(I_lumi / 2)
+    assert get_intensity("analytical", max_intensity=1.2e11) == 1.2e11
+
+
+def test_leveling_ip1_5_numerical(leveling_ip1_5):
+    # Same solution as the penalised optimization
+    get_intensity, _ = leveling_ip1_5
+    assert get_intensity("analytical") == pytest.approx(get_intensity("numerical"), rel=1e-3)
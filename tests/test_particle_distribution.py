@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+
+config_particles = {"r_min": 2.0, "r_max": 10.0, "n_r": 16, "n_angles": 5, "n_turns": 1000}
+
+
+# ==================================================================================================
+# --- Generators
+# ==================================================================================================
+@pytest.mark.parametrize("distribution", ["polar_grid", "quasi_random", "non_uniform_radial"])
+def test_generator_bounds(particle_distribution, distribution):
+    particle_df = particle_distribution.generate_particle_distribution(
+        {**config_particles, "distribution": distribution}
+    )
+    r = particle_df[particle_distribution.COLUMNS[1]].values
+    theta = particle_df[particle_distribution.COLUMNS[2]].values
+    assert len(particle_df) == 16 * 5
+    assert list(particle_df.columns) == particle_distribution.COLUMNS
+    assert np.array_equal(particle_df[particle_distribution.COLUMNS[0]].values, np.arange(80))
+    assert np.all((r >= 2.0) & (r <= 10.0))
+    assert np.all((theta >= 0.0) & (theta <= 90.0))
+
+
+def test_polar_grid_ordered_by_angle(particle_distribution):
+    r, theta = particle_distribution.polar_grid(config_particles)
+    assert np.allclose(theta[:16], 15.0)
+    assert np.allclose(r[:16], np.linspace(2.0, 10.0, 16, endpoint=False))
+    assert np.all(np.diff(theta) >= 0)
+
+
+def test_quasi_random_deterministic(particle_distribution):
+    config = {**config_particles, "distribution": "quasi_random", "sequence": "halton"}
+    r_1, theta_1 = particle_distribution.quasi_random(config)
+    r_2, theta_2 = particle_distribution.quasi_random(config)
+    assert np.array_equal(r_1, r_2) and np.array_equal(theta_1, theta_2)
+
+
+def test_non_uniform_radial_denser_around_da(particle_distribution):
+    config = {**config_particles, "n_r": 100, "da_estimate": 6.0, "da_width": 0.5}
+    r, _ = particle_distribution.non_uniform_radial(config)
+    r = r[:100]
+    assert np.sum(np.abs(r - 6.0) < 1.0) > np.sum(np.abs(r - 3.0) < 1.0)
+
+
+def test_unknown_generator(particle_distribution):
+    with pytest.raises(ValueError):
+        particle_distribution.generate_particle_distribution(
+            {**config_particles, "distribution": "unknown"}
+        )
+
+
+# ==================================================================================================
+# --- Cost model and split
+# ==================================================================================================
+def test_cost_decreases_beyond_da(particle_distribution):
+    cost = particle_distribution.estimate_particles_cost(np.array([2.0, 6.0, 10.0]), 1000)
+    assert cost[0] == pytest.approx(1000, rel=1e-3)
+    assert cost[1] == pytest.approx(500)
+    assert cost[2] == pytest.approx(10)
+    assert np.all(np.diff(cost) < 0)
+
+
+def test_split_by_cost_balanced(particle_distribution):
+    cost = np.array([10.0, 8.0, 7.0, 5.0, 4.0, 3.0, 2.0, 1.0])
+    l_idx_chunks = particle_distribution._split_by_cost(cost, 3)
+    assert np.array_equal(np.sort(np.concatenate(l_idx_chunks)), np.arange(8))
+    assert sorted(cost[idx].sum() for idx in l_idx_chunks) == [13.0, 13.0, 14.0]
+
+
+@pytest.mark.parametrize("split_method", ["count", "cost"])
+def test_split_particle_distribution(particle_distribution, split_method):
+    config = {**config_particles, "n_split": 4, "split_method": split_method}
+    particle_df = particle_distribution.generate_particle_distribution(config)
+    l_chunks = particle_distribution.split_particle_distribution(particle_df, config)
+    assert len(l_chunks) == 4
+    l_ids = np.concatenate([chunk[particle_distribution.COLUMNS[0]].values for chunk in l_chunks])
+    assert np.array_equal(np.sort(l_ids), np.arange(len(particle_df)))
+
+    # The chunks regenerated by the tracking jobs are the ones of generation 1
+    chunk = particle_distribution.generate_particle_chunk(config, 2)
+    assert chunk.equals(l_chunks[2])
+
+
+def get_imbalance(particle_distribution, split_method):
+    config = {**config_particles, "n_split": 4, "split_method": split_method}
+    particle_df = particle_distribution.generate_particle_distribution(config)
+    cost = particle_distribution.get_particles_cost(particle_df, config)
+    l_chunks = particle_distribution.split_particle_distribution(particle_df, config)
+    l_costs = [cost[chunk[particle_distribution.COLUMNS[0]].values].sum() for chunk in l_chunks]
+    return max(l_costs) / min(l_costs)
+
+
+def test_split_by_cost_reduces_imbalance(particle_distribution):
+    assert get_imbalance(particle_distribution, "cost") < 1.05
+    assert get_imbalance(particle_distribution, "count") > 1.05
+
+
+def test_unknown_split_method(particle_distribution):
+    config = {**config_particles, "n_split": 2, "split_method": "unknown"}
+    particle_df = particle_distribution.generate_particle_distribution(config)
+    with pytest.raises(ValueError):
+        particle_distribution.split_particle_distribution(particle_df, config)
+
+
+def test_n_split(particle_distribution):
+    particle_df = particle_distribution.generate_particle_distribution(config_particles)
+    n_split = particle_distribution.get_n_split(
+        particle_df, {**config_particles, "throughput": 1.0}, target_job_duration=3600.0
+    )
+    total_cost = particle_distribution.get_particles_cost(particle_df, config_particles).sum()
+    assert n_split == int(np.ceil(total_cost / 3000.0))
+    assert particle_distribution.get_n_split(particle_df, config_particles, context="cupy") == 1
+
+    # Jobs that only load the collider (two-stage studies) track for longer
+    n_split_track = particle_distribution.get_n_split(
+        particle_df,
+        {**config_particles, "throughput": 1.0},
+        target_job_duration=3600.0,
+        job_overhead=particle_distribution.TRACK_JOB_OVERHEAD,
+    )
+    assert n_split_track == int(np.ceil(total_cost / 3540.0))